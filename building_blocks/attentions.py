@@ -1,5 +1,12 @@
 """
 Re-invent functions for attentions. Why not?
+
+All attention functions take query, key and value matrices (with optional
+leading batch axes) and a causal flag, and return the attention output:
+    attention: exact softmax attention, O(n^2) time and memory.
+    linear_attention: kernelized attention with a feature map, O(n).
+    linformer_attention: softmax attention over keys and values projected to a
+        fixed number of rows, O(n).
 """
 import math
 
@@ -11,40 +18,206 @@ def softmax(matrix: np.ndarray) -> np.ndarray:
     Compute the softmax of a matrix along the last axis.
     
     Args:
-        matrix (2D np.ndarray): Input matrix.
+        matrix (np.ndarray): Input matrix, or a stack of matrices with leading
+            batch axes.
         
     Returns:
-        2D np.ndarray: Softmax of the input matrix.
+        np.ndarray: Softmax of the input matrix.
 
     NOTE: scipy.special.softmax does same thing.
     """
-    assert matrix.ndim == 2, "Input matrix must be 2-dimensional."
+    assert matrix.ndim >= 2, "Input matrix must be at least 2-dimensional."
 
-    matrix_exp = np.exp(matrix)
+    # Subtracting the row maximum keeps exp() from overflowing and lets masked
+    # entries be -inf.
+    matrix_exp = np.exp(matrix - matrix.max(axis=-1, keepdims=True))
     row_sum = matrix_exp.sum(axis=-1, keepdims=True)
     return matrix_exp / row_sum
 
 
+def causal_mask(num_queries: int, num_keys: int) -> np.ndarray:
+    """
+    Mask that lets every query attend to its own and the earlier positions.
+
+    The queries are the last num_queries of the num_keys positions, e.g. new
+    tokens that follow num_keys - num_queries cached ones.
+
+    Returns:
+        2D np.ndarray: Boolean [num_queries, num_keys] mask, True where
+            attention is allowed.
+    """
+    return np.tri(num_queries, num_keys, k=num_keys - num_queries, dtype=bool)
+
+
 def attention(
     query_matrix: np.ndarray,
     key_matrix: np.ndarray,
-    value_matrix: np.ndarray
+    value_matrix: np.ndarray,
+    mask: np.ndarray = None,
+    causal: bool = False
 ) -> np.ndarray:
     """
-    Compute the attention output given query, key, and value matrices.
+    Compute the scaled dot-product attention output given query, key, and value matrices.
     
     Args:
-        query_matrix (2D np.ndarray): Query matrix.
-        key_matrix (2D np.ndarray): Key matrix.
-        value_matrix (2D np.ndarray): Value matrix.
+        query_matrix (np.ndarray): Query matrix [num queries, dim].
+        key_matrix (np.ndarray): Key matrix [num keys, dim].
+        value_matrix (np.ndarray): Value matrix [num keys, value dim].
+        mask (np.ndarray, optional): Boolean [num queries, num keys] mask, True
+            where attention is allowed.
+        causal (bool): Let every query attend only to its own and the earlier keys,
+            a shorthand for mask=causal_mask(num queries, num keys).
+        All of them may have the same leading batch axes, e.g. batch and head.
         
     Returns:
-        2D np.ndarray: Attention output.
+        np.ndarray: Attention output [num queries, value dim].
+    """
+    assert query_matrix.ndim >= 2, "Query matrix must be at least 2-dimensional."
+    assert key_matrix.ndim >= 2, "Key matrix must be at least 2-dimensional."
+    assert value_matrix.ndim >= 2, "Value matrix must be at least 2-dimensional."
+
+    # The scores are scaled before the softmax, as in "Attention Is All You Need".
+    scores = query_matrix @ np.swapaxes(key_matrix, -1, -2) / math.sqrt(key_matrix.shape[-1])
+    if causal:
+        mask = causal_mask(*scores.shape[-2:]) if mask is None else mask & causal_mask(*scores.shape[-2:])
+    if mask is not None:
+        scores = np.where(mask, scores, -np.inf)
+    attention_weights = softmax(scores)
+    return attention_weights @ value_matrix
+
+
+def elu_feature_map(matrix: np.ndarray) -> np.ndarray:
+    """
+    Feature map elu(x) + 1 of "Transformers are RNNs" (Katharopoulos et al. 2020).
+
+    Args:
+        matrix (np.ndarray): Queries or keys [..., dim].
+
+    Returns:
+        np.ndarray: Positive features [..., dim].
     """
-    assert query_matrix.ndim == 2, "Query matrix must be 2-dimensional."
-    assert key_matrix.ndim == 2, "Key matrix must be 2-dimensional."
-    assert value_matrix.ndim == 2, "Value matrix must be 2-dimensional."
+    return np.where(matrix > 0, matrix + 1, np.exp(np.minimum(matrix, 0)))
+
+
+def linear_attention(
+    query_matrix: np.ndarray,
+    key_matrix: np.ndarray,
+    value_matrix: np.ndarray,
+    causal: bool = False,
+    feature_map=elu_feature_map,
+    chunk_size: int = 64,
+    eps: float = 1e-6
+) -> np.ndarray:
+    """
+    Compute kernelized linear attention.
+
+    The similarity exp(q.k) of softmax attention is replaced by phi(q).phi(k), so
+    the keys and values can be summed before the queries see them:
+        output_i = phi(q_i) @ sum_j phi(k_j)^T v_j / phi(q_i) @ sum_j phi(k_j)
+    This takes O(n dim value dim) time instead of O(n^2 dim). With causal=True the
+    sums run over j <= i: the sequence is split into chunks, the sums of the
+    earlier chunks are cumulative sums and the positions within a chunk attend to
+    each other like masked quadratic attention, O(n chunk_size dim) more time.
+
+    Args:
+        query_matrix (np.ndarray): Query matrix [num queries, dim].
+        key_matrix (np.ndarray): Key matrix [num keys, dim].
+        value_matrix (np.ndarray): Value matrix [num keys, value dim].
+        causal (bool): Let query i attend only to the keys up to i, needs as
+            many queries as keys.
+        feature_map: Function mapping queries and keys to positive features.
+        chunk_size (int): Chunk length of the causal variant.
+        eps (float): Keeps the normalizer away from zero.
+        All matrices may have the same leading batch axes.
 
-    scores = query_matrix @ key_matrix.T
-    attention_weights = softmax(scores) / math.sqrt(key_matrix.shape[-1])
-    return attention_weights @ value_matrix
\ No newline at end of file
+    Returns:
+        np.ndarray: Attention output [num queries, value dim].
+    """
+    query_features = feature_map(query_matrix)
+    key_features = feature_map(key_matrix)
+    if not causal:
+        numerator = query_features @ (np.swapaxes(key_features, -1, -2) @ value_matrix)
+        normalizer = query_features @ key_features.sum(axis=-2)[..., None]
+        return numerator / (normalizer + eps)
+
+    assert query_matrix.shape[-2] == key_matrix.shape[-2], "Causal linear attention needs as many queries as keys."
+    length = query_matrix.shape[-2]
+    num_chunks = -(-length // chunk_size)
+    # Zero padding to whole chunks adds nothing to the sums.
+    padding = [(0, 0)] * (query_matrix.ndim - 2) + [(0, num_chunks * chunk_size - length), (0, 0)]
+    chunks = lambda m: np.pad(m, padding).reshape(m.shape[:-2] + (num_chunks, chunk_size, m.shape[-1]))
+    # Value [..., chunks, chunk size, value dim] with a column of ones, which sums up the normalizer.
+    values = chunks(np.concatenate([value_matrix, np.ones(value_matrix.shape[:-1] + (1,), value_matrix.dtype)], axis=-1))
+    query_features, key_features = chunks(query_features), chunks(key_features)
+
+    # Sum of phi(k_j)^T v_j over the chunks before every chunk.
+    chunk_sums = np.swapaxes(key_features, -1, -2) @ values
+    earlier_sums = np.cumsum(chunk_sums, axis=-3) - chunk_sums
+    within = (query_features @ np.swapaxes(key_features, -1, -2)) * np.tri(chunk_size, dtype=bool)
+    output = query_features @ earlier_sums + within @ values
+    output = output.reshape(output.shape[:-3] + (-1, output.shape[-1]))[..., :length, :]
+    return output[..., :-1] / (output[..., -1:] + eps)
+
+
+def linformer_projection(rank: int, num_keys: int) -> np.ndarray:
+    """
+    Projection from num_keys rows to rank rows for linformer_attention.
+
+    Linformer learns the projections. Without training, averaging consecutive
+    blocks of keys (and values) is a better default than a random projection,
+    which would scale the projected values by sqrt(num_keys / rank).
+
+    Args:
+        rank (int): Number of projected keys.
+        num_keys (int): Sequence length.
+
+    Returns:
+        2D np.ndarray: [min(rank, num keys), num keys] matrix whose row i averages block i
+            of the keys. With rank >= num keys it is the identity.
+    """
+    # More rows than keys would leave empty rows, zero keys that still take softmax weight.
+    rank = min(rank, num_keys)
+    blocks = np.arange(num_keys) * rank // num_keys
+    projection = (blocks == np.arange(rank)[:, None]).astype(np.float32)
+    return projection / np.maximum(projection.sum(axis=1, keepdims=True), 1)
+
+
+def linformer_attention(
+    query_matrix: np.ndarray,
+    key_matrix: np.ndarray,
+    value_matrix: np.ndarray,
+    causal: bool = False,
+    key_projection: np.ndarray = None,
+    value_projection: np.ndarray = None,
+    rank: int = 64
+) -> np.ndarray:
+    """
+    Compute low-rank projected attention of "Linformer" (Wang et al. 2020).
+
+    The keys and values are projected along the sequence axis to rank rows, E K
+    and F V, and the queries attend to those with exact softmax attention, which
+    takes O(n rank) time and memory instead of O(n^2).
+
+    Args:
+        query_matrix (np.ndarray): Query matrix [num queries, dim].
+        key_matrix (np.ndarray): Key matrix [num keys, dim].
+        value_matrix (np.ndarray): Value matrix [num keys, value dim].
+        causal (bool): Not supported, every projected key mixes all positions.
+        key_projection (np.ndarray, optional): E [rank, num keys], learned in
+            Linformer. Defaults to linformer_projection(rank, num keys).
+        value_projection (np.ndarray, optional): F [rank, num keys]. Defaults to
+            key_projection.
+        rank (int): Number of projected keys when no projection is given, at most
+            the number of keys (then the attention is exact).
+        All matrices may have the same leading batch axes.
+
+    Returns:
+        np.ndarray: Attention output [num queries, value dim].
+    """
+    if causal:
+        raise ValueError("Linformer attention can not be causal, the projections mix all positions.")
+    if key_projection is None:
+        key_projection = linformer_projection(rank, key_matrix.shape[-2])
+    if value_projection is None:
+        value_projection = key_projection
+    return attention(query_matrix, key_projection @ key_matrix, value_projection @ value_matrix)
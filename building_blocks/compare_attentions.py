@@ -0,0 +1,71 @@
+"""
+Compare the approximate attention kernels against exact softmax attention.
+
+For every sequence length, prints the time of each kernel and the relative error
+of its output against attention(), on random queries, keys and values:
+
+    python -m building_blocks.compare_attentions --lengths 40 256 1024 4096
+"""
+import argparse
+import time
+
+import numpy as np
+
+from .attentions import attention, linear_attention, linformer_attention
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Compare approximate attention kernels with exact attention')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[40, 256, 1024, 4096],
+                        help='sequence lengths to compare, lengths up to --rank make linformer_attention exact')
+    parser.add_argument('--dim', type=int, default=64,
+                        help='query, key and value dimension')
+    parser.add_argument('--heads', type=int, default=4,
+                        help='number of attention heads (batch axis)')
+    parser.add_argument('--rank', type=int, default=128,
+                        help='projected length of linformer_attention')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='the best of this many runs is reported')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed of the inputs')
+    return parser.parse_args()
+
+
+def best_time(function, repeat):
+    """Returns the output of function() and its fastest run time in seconds."""
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        output = function()
+        times.append(time.perf_counter() - start_time)
+    return output, min(times)
+
+
+def relative_error(output: np.ndarray, expected: np.ndarray) -> float:
+    return float(np.linalg.norm(output - expected) / np.linalg.norm(expected))
+
+
+def main():
+    args = get_args()
+    rng = np.random.default_rng(args.seed)
+    print('{:>6s} | {:24s} | {:>10s} | {:>9s}'.format('length', 'kernel', 'time (ms)', 'rel error'))
+    for length in args.lengths:
+        query, key, value = [rng.standard_normal((args.heads, length, args.dim)).astype(np.float32)
+                             for _ in range(3)]
+        kernels = [
+            ('attention', lambda: attention(query, key, value), None),
+            ('linear_attention', lambda: linear_attention(query, key, value), 'attention'),
+            ('linformer_attention', lambda: linformer_attention(query, key, value, rank=args.rank), 'attention'),
+            ('attention causal', lambda: attention(query, key, value, causal=True), None),
+            ('linear_attention causal', lambda: linear_attention(query, key, value, causal=True),
+             'attention causal'),
+        ]
+        outputs = {}
+        for name, function, reference in kernels:
+            outputs[name], seconds = best_time(function, args.repeat)
+            error = relative_error(outputs[name], outputs[reference]) if reference else 0.
+            print('{:6d} | {:24s} | {:10.2f} | {:9.3f}'.format(length, name, seconds * 1000, error))
+
+
+if __name__ == '__main__':
+    main()
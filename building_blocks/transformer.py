@@ -0,0 +1,186 @@
+"""
+Torch-free inference for the word_language_model_transformer TransformerModel.
+
+The weights come from an .npz written by word_language_model_transformer/export_numpy.py,
+the attention is the NumPy attention of building_blocks.attentions.
+"""
+import json
+
+import numpy as np
+
+from .attentions import attention, causal_mask
+
+
+def layer_norm(x: np.ndarray, weight: np.ndarray, bias: np.ndarray, eps: float = 1e-5) -> np.ndarray:
+    """
+    Normalize the last axis of x to zero mean and unit variance, then scale and shift it.
+
+    Args:
+        x (np.ndarray): Input [..., dim].
+        weight (np.ndarray): Scale [dim].
+        bias (np.ndarray): Shift [dim].
+        eps (float): Added to the variance, same default as torch.nn.LayerNorm.
+
+    Returns:
+        np.ndarray: Normalized input [..., dim].
+    """
+    mean = x.mean(axis=-1, keepdims=True)
+    var = ((x - mean) ** 2).mean(axis=-1, keepdims=True)
+    return (x - mean) / np.sqrt(var + eps) * weight + bias
+
+
+def log_softmax(x: np.ndarray) -> np.ndarray:
+    """
+    Compute the log of the softmax along the last axis.
+
+    Args:
+        x (np.ndarray): Input [..., num classes].
+
+    Returns:
+        np.ndarray: Log-probabilities [..., num classes].
+    """
+    x = x - x.max(axis=-1, keepdims=True)
+    return x - np.log(np.exp(x).sum(axis=-1, keepdims=True))
+
+
+def apply_rotary(x: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    Rotate queries or keys by their positions, the same rotary embedding as model.apply_rotary.
+
+    Args:
+        x (np.ndarray): Queries or keys [..., sequence length, head dim].
+        positions (np.ndarray): Integer positions [sequence length].
+
+    Returns:
+        np.ndarray: Rotated x.
+    """
+    half = x.shape[-1] // 2
+    inv_freq = np.exp(np.arange(half, dtype=np.float32) * np.float32(-np.log(10000.0) / half))
+    angles = positions.astype(np.float32)[:, None] * inv_freq
+    cos, sin = np.cos(angles), np.sin(angles)
+    x1, x2 = x[..., :half], x[..., half:]
+    return np.concatenate([x1 * cos - x2 * sin, x1 * sin + x2 * cos], axis=-1)
+
+
+class TransformerLM(object):
+    """
+    NumPy version of TransformerModel for inference.
+
+    Runs embedding, PositionalEncoding (or rotary positions), the post-norm encoder
+    layers with causal multi-head attention, the final layer norm and the decoder,
+    all in float32. Dropout is left out, as in eval mode.
+
+    Examples:
+        >>> model = TransformerLM.load('model.npz')
+        >>> log_probs = model(np.array([[4], [12], [7]]))  # [sequence length, batch size, ntoken]
+    """
+
+    def __init__(self, weights: dict, config: dict):
+        self.weights = weights
+        self.ninp = config['ninp']
+        self.nhead = config['nhead']
+        self.nlayers = config['nlayers']
+        self.positions = config.get('positions', 'absolute')
+        self.mem_len = config.get('mem_len', 0)
+        self.ntoken = weights['decoder.weight'].shape[0]
+
+    @classmethod
+    def load(cls, path: str) -> 'TransformerLM':
+        """
+        Load the weights and config exported to the .npz at path.
+
+        Args:
+            path (str): File written by export_numpy.py.
+
+        Returns:
+            TransformerLM: The model.
+        """
+        with np.load(path) as f:
+            weights = {name: f[name] for name in f.files if name != 'config'}
+            config = json.loads(str(f['config']))
+        return cls(weights, config)
+
+    def embed(self, src: np.ndarray, offset: int = 0) -> np.ndarray:
+        """
+        Embed token ids, and add the positional encoding of their positions.
+
+        Args:
+            src (np.ndarray): Token ids [sequence length, batch size].
+            offset (int): Position of the first token.
+
+        Returns:
+            np.ndarray: Embeddings [sequence length, batch size, ninp].
+        """
+        x = self.weights['input_emb.weight'][src] * np.float32(np.sqrt(self.ninp))
+        if self.positions == 'rotary':
+            return x
+        return x + self.weights['pos_encoder.pe'][offset:offset + src.shape[0]]
+
+    def layer(self, i: int, x: np.ndarray, past: tuple = None) -> tuple:
+        """
+        Run x [sequence length, batch size, ninp] through encoder layer i.
+
+        Args:
+            i (int): Layer index.
+            x (np.ndarray): Layer input [sequence length, batch size, ninp].
+            past (tuple, optional): Keys and values [batch size, nhead, past length, head dim]
+                of the tokens before x, as returned by the previous call.
+
+        Returns:
+            tuple: The layer output and the keys and values extended by x.
+        """
+        w = lambda name: self.weights['encoder.layers.{}.{}'.format(i, name)]
+        seq_len, bsz = x.shape[:2]
+        head_dim = self.ninp // self.nhead
+        # [sequence length, batch size, ninp] -> [batch size, nhead, sequence length, head dim]
+        qkv = x @ w('self_attn.in_proj_weight').T + w('self_attn.in_proj_bias')
+        q, k, v = [t.reshape(seq_len, bsz, self.nhead, head_dim).transpose(1, 2, 0, 3)
+                   for t in np.split(qkv, 3, axis=-1)]
+        if past is not None:
+            k = np.concatenate([past[0], k], axis=2)
+            v = np.concatenate([past[1], v], axis=2)
+        present = (k, v)
+        past_len = k.shape[2] - seq_len
+        if self.positions == 'rotary':
+            # As in TransformerModel._attend, the keys are kept before the rotation.
+            positions = np.arange(past_len + seq_len)
+            q = apply_rotary(q, positions[past_len:])
+            k = apply_rotary(k, positions)
+        out = attention(q, k, v, causal_mask(seq_len, past_len + seq_len))
+        out = out.transpose(2, 0, 1, 3).reshape(seq_len, bsz, self.ninp)
+        out = out @ w('self_attn.out_proj.weight').T + w('self_attn.out_proj.bias')
+        # Post-norm encoder layer with ReLU, as nn.TransformerEncoderLayer's defaults.
+        x = layer_norm(x + out, w('norm1.weight'), w('norm1.bias'))
+        hidden = np.maximum(x @ w('linear1.weight').T + w('linear1.bias'), 0)
+        out = hidden @ w('linear2.weight').T + w('linear2.bias')
+        return layer_norm(x + out, w('norm2.weight'), w('norm2.bias')), present
+
+    def forward(self, src: np.ndarray, past: list = None) -> tuple:
+        """
+        Causal forward pass, the counterpart of TransformerModel.forward_with_cache.
+
+        Args:
+            src (np.ndarray): Token ids [sequence length, batch size].
+            past (list, optional): Per-layer keys and values of the tokens before src,
+                as returned by the previous call.
+
+        Returns:
+            tuple: Log-probabilities [sequence length, batch size, ntoken] and past
+                extended by src.
+        """
+        past_len = past[0][0].shape[2] if past else 0
+        x = self.embed(np.asarray(src), past_len)
+        present = []
+        for i in range(self.nlayers):
+            x, layer_present = self.layer(i, x, past[i] if past else None)
+            if self.mem_len:
+                # Models with a segment memory only attend to the last mem_len positions.
+                layer_present = tuple(t[:, :, -self.mem_len:] for t in layer_present)
+            present.append(layer_present)
+        if 'encoder.norm.weight' in self.weights:
+            x = layer_norm(x, self.weights['encoder.norm.weight'], self.weights['encoder.norm.bias'])
+        logits = x @ self.weights['decoder.weight'].T + self.weights['decoder.bias']
+        return log_softmax(logits), present
+
+    def __call__(self, src: np.ndarray) -> np.ndarray:
+        return self.forward(src)[0]
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+###############################################################################
+# Language Modeling on Wikitext-2
+#
+# This file compresses the word embedding and the decoder of a trained model,
+# the two [ntoken, ninp] matrices that hold most of its weights. They are
+# factorized to a low rank with an SVD and/or structurally pruned to their
+# largest features, optionally fine-tuned for a few steps, and the compact
+# checkpoint is compared against the original one:
+#
+#   python compress.py --checkpoint model.pt --rank 64 --finetune-steps 200
+#
+# The saved checkpoint loads in generate.py, score.py and quantize.py like any other.
+#
+###############################################################################
+import argparse
+import copy
+import io
+import math
+import time
+
+import torch
+import torch.nn as nn
+
+import data
+import distillation
+import evaluation
+from generate import get_model
+from main import batchify, repackage_hidden
+from model import LowRankEmbedding, LowRankLinear, PrunedEmbedding, PrunedLinear
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Low-rank / pruned compression of a Wikitext-2 Language Model')
+    parser.add_argument('--data', type=str, default='../data/wikitext-2',
+                        help='location of the data corpus')
+    parser.add_argument('--corpus-cache', type=str, default='',
+                        help='file with the tokenized corpus, see main.py')
+    parser.add_argument('--checkpoint', type=str, default='./model.pt',
+                        help='model checkpoint to compress')
+    parser.add_argument('--save', type=str, default='./model_compressed.pt',
+                        help='path to save the compressed model')
+    parser.add_argument('--targets', type=str, default='both', choices=['both', 'decoder', 'embedding'],
+                        help='matrices to compress (tied weights are always compressed together)')
+    parser.add_argument('--rank', type=int, default=0,
+                        help='rank of the SVD factorization (0 = no factorization)')
+    parser.add_argument('--keep', type=float, default=1.0,
+                        help='fraction of the features (columns) with the largest norms to keep (1.0 = no pruning)')
+    parser.add_argument('--finetune-steps', type=int, default=0,
+                        help='number of SGD steps on the training data after compressing')
+    parser.add_argument('--lr', type=float, default=1.0,
+                        help='learning rate of the fine-tuning')
+    parser.add_argument('--clip', type=float, default=0.25,
+                        help='gradient clipping of the fine-tuning')
+    parser.add_argument('--batch_size', type=int, default=20,
+                        help='batch size of the fine-tuning')
+    parser.add_argument('--bptt', type=int, default=35,
+                        help='sequence length of the fine-tuning')
+    parser.add_argument('--distill-alpha', type=float, default=0.0,
+                        help='weight of the uncompressed model\'s soft targets in the fine-tuning loss')
+    parser.add_argument('--eval-context', type=int, default=35,
+                        help='context length of the evaluation windows')
+    parser.add_argument('--eval-batch-size', type=int, default=10,
+                        help='number of windows evaluated together')
+    parser.add_argument('--eval-windows', type=int, default=0,
+                        help='score only this many evenly spaced validation windows (0 = all)')
+    parser.add_argument('--seed', type=int, default=1111,
+                        help='random seed')
+    args = parser.parse_args()
+
+    if args.rank < 0:
+        parser.error("--rank has to be greater or equal 0.")
+    if not 0 < args.keep <= 1:
+        parser.error("--keep has to be in (0, 1].")
+    if not args.rank and args.keep == 1:
+        parser.error("Nothing to do, set --rank and/or --keep.")
+
+    return args
+
+
+def svd_factors(weight, rank):
+    """Returns (left [rows, rank], right [rank, cols]) with left @ right the best rank-`rank` approximation of weight."""
+    u, s, vh = torch.linalg.svd(weight.detach().float(), full_matrices=False)
+    # The singular values are split evenly, so that both factors have similar scales.
+    root = s[:rank].sqrt()
+    return (u[:, :rank] * root).to(weight.dtype), (root[:, None] * vh[:rank]).to(weight.dtype)
+
+
+def kept_features(weights, keep):
+    # Structured magnitude pruning: the features (columns) with the largest L2 norm over all `weights`.
+    norms = sum(weight.detach().float().norm(dim=0) ** 2 for weight in weights)
+    num_kept = max(1, round(keep * norms.numel()))
+    return norms.topk(num_kept).indices.sort().values
+
+
+def compress_embedding(embedding, index, factors):
+    weight = embedding.weight.detach() if index is None else embedding.weight.detach()[:, index]
+    if factors is None:
+        compressed = nn.Embedding.from_pretrained(weight.clone(), freeze=False)
+    else:
+        left, right = factors
+        compressed = LowRankEmbedding(weight.size(0), weight.size(1), left.size(1))
+        compressed.embedding.weight.data.copy_(left)
+        compressed.up.weight.data.copy_(right.t())
+    if index is None:
+        return compressed
+    return PrunedEmbedding(embedding.embedding_dim, index, compressed)
+
+
+def compress_linear(linear, index, factors):
+    weight = linear.weight.detach() if index is None else linear.weight.detach()[:, index]
+    if factors is None:
+        compressed = nn.Linear(weight.size(1), weight.size(0), bias=linear.bias is not None)
+        compressed.weight.data.copy_(weight)
+    else:
+        left, right = factors
+        compressed = LowRankLinear(weight.size(1), weight.size(0), left.size(1), bias=linear.bias is not None)
+        compressed.up.weight.data.copy_(left)
+        compressed.down.weight.data.copy_(right)
+    if linear.bias is not None:
+        (compressed.up if factors is not None else compressed).bias.data.copy_(linear.bias.detach())
+    if index is None:
+        return compressed
+    return PrunedLinear(linear.in_features, index, compressed)
+
+
+def compress_model(model, targets='both', rank=0, keep=1.0):
+    """Returns a copy of `model` with a low-rank and/or pruned word embedding and decoder.
+
+    Pruning keeps the `keep` fraction of the features with the largest norms,
+    then the kept columns are factorized to `rank`. With tied weights (RNNModel
+    --tied) the embedding and the decoder stay tied: they keep the same features
+    and share the [ntoken, rank] factor.
+    """
+    model = copy.deepcopy(model).cpu()
+    transformer = getattr(model, 'model_type', None) == 'Transformer'
+    embedding = model.input_emb if transformer else model.encoder
+    decoder = model.decoder
+    tied = decoder.weight is embedding.weight
+    if tied and targets != 'both':
+        raise ValueError('The embedding and decoder weights are tied, they can only be compressed together')
+    compressed_embedding = compressed_decoder = None
+
+    if targets in ['both', 'embedding']:
+        index = kept_features([embedding.weight], keep) if keep < 1 else None
+        weight = embedding.weight if index is None else embedding.weight[:, index]
+        factors = svd_factors(weight, rank) if rank else None
+        compressed_embedding = compress_embedding(embedding, index, factors)
+    if targets in ['both', 'decoder']:
+        if not tied:
+            index = kept_features([decoder.weight], keep) if keep < 1 else None
+            weight = decoder.weight if index is None else decoder.weight[:, index]
+            factors = svd_factors(weight, rank) if rank else None
+        compressed_decoder = compress_linear(decoder, index, factors)
+        if tied:
+            inner_embedding = compressed_embedding.embedding if index is not None else compressed_embedding
+            inner_decoder = compressed_decoder.linear if index is not None else compressed_decoder
+            if rank:
+                inner_decoder.up.weight = inner_embedding.embedding.weight
+            else:
+                inner_decoder.weight = inner_embedding.weight
+
+    if compressed_embedding is not None:
+        if transformer:
+            model.input_emb = compressed_embedding
+        else:
+            model.encoder = compressed_embedding
+    if compressed_decoder is not None:
+        model.decoder = compressed_decoder
+    return model
+
+
+def finetune(model, train_data, steps, lr, clip, bptt, teacher=None, distill_alpha=0.):
+    """Trains `model` for `steps` SGD steps on consecutive batches of the batchified train_data."""
+    transformer = getattr(model, 'model_type', None) == 'Transformer'
+    optimizer = torch.optim.SGD(model.parameters(), lr=lr)
+    criterion = nn.NLLLoss()
+    model.train()
+    if not transformer:
+        hidden = model.init_hidden(train_data.size(1))
+    i = 0
+    for step in range(steps):
+        if i >= train_data.size(0) - 1:
+            i = 0
+        seq_len = min(bptt, train_data.size(0) - 1 - i)
+        data, targets = train_data[i:i + seq_len], train_data[i + 1:i + 1 + seq_len].reshape(-1)
+        optimizer.zero_grad()
+        if transformer:
+            output = model(data).view(targets.numel(), -1)
+        else:
+            hidden = repackage_hidden(hidden)
+            output, hidden = model(data, hidden)
+        loss = criterion(output, targets)
+        if teacher is not None and distill_alpha:
+            indices, teacher_log_probs = distillation.soft_targets(teacher, data)
+            loss = distillation.distillation_loss(output, loss, indices, teacher_log_probs, distill_alpha, 1.0)
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
+        optimizer.step()
+        i += seq_len
+    model.eval()
+    return model
+
+
+def checkpoint_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def output_layer_time(model, tokens=700, repeat=20):
+    # Time of the decoder alone on `tokens` hidden states, the output projection over the vocabulary.
+    in_features = model.decoder.in_features
+    x = torch.randn(tokens, in_features)
+    with torch.no_grad():
+        model.decoder(x)
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            model.decoder(x)
+    return (time.perf_counter() - start_time) / repeat
+
+
+def main():
+    args = get_args()
+    torch.manual_seed(args.seed)
+    device = torch.device('cpu')
+    original_model = get_model(args.checkpoint, device)
+    if getattr(original_model, 'quantized', False):
+        raise ValueError('Compress the float checkpoint, quantize.py can quantize the compressed one afterwards')
+    model = compress_model(original_model, args.targets, args.rank, args.keep)
+
+    corpus = data.load_corpus(args.data, args.corpus_cache)
+    if args.finetune_steps:
+        train_data = batchify(corpus.train, args.batch_size, device)
+        finetune(model, train_data, args.finetune_steps, args.lr, args.clip, args.bptt,
+                 original_model if args.distill_alpha else None, args.distill_alpha)
+    model.eval()
+    with open(args.save, 'wb') as f:
+        torch.save(model, f)
+    corpus.dictionary.save(data.vocab_path(args.save))
+    print('Compressed model saved to {}'.format(args.save))
+
+    print('=' * 89)
+    for name, m in [('original', original_model), ('compressed', model)]:
+        start_time = time.time()
+        loss = evaluation.sliding_window_loss(m, corpus.valid, args.eval_context, args.eval_context,
+                                              args.eval_batch_size, args.eval_windows or None)
+        elapsed = time.time() - start_time
+        print('| {:10s} | size {:8.2f} MB | valid loss {:5.2f} | valid ppl {:8.2f} | time {:6.2f}s | '
+              'decoder {:6.2f} ms'.format(name, checkpoint_size(m) / 2**20, loss, math.exp(loss), elapsed,
+                                           output_layer_time(m) * 1000))
+    print('=' * 89)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+###############################################################################
+# Language Modeling on Wikitext-2
+#
+# This file picks the CPU threading of training and inference runs. It
+# benchmarks a few steps of the model for every combination of intra-op
+# threads, inter-op threads and core pinning, and saves the fastest one:
+#
+#   python cpu_threads.py --model LSTM --emsize 650 --nhid 650 --output threads.json
+#   python main.py --model LSTM --emsize 650 --nhid 650 --thread-config threads.json
+#
+# main.py --autotune-threads runs the benchmark itself when threads.json has
+# no entry for its model and batch shape yet.
+#
+###############################################################################
+import argparse
+import json
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from model import RNNModel, TransformerModel
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Tune the CPU threads of a Wikitext-2 Language Model')
+    parser.add_argument('--output', type=str, default='threads.json',
+                        help='JSON file the best thread config is added to')
+    parser.add_argument('--mode', type=str, default='train', choices=['train', 'inference'],
+                        help='benchmark training steps or inference forward passes')
+    parser.add_argument('--checkpoint', type=str, default='',
+                        help='take the model shape from this checkpoint instead of the options below')
+    parser.add_argument('--model', type=str, default='Transformer',
+                        help='type of network (RNN_TANH, RNN_RELU, LSTM, GRU, Transformer)')
+    parser.add_argument('--ntokens', type=int, default=33278,
+                        help='vocabulary size (33278 for Wikitext-2)')
+    parser.add_argument('--emsize', type=int, default=200,
+                        help='size of word embeddings')
+    parser.add_argument('--nhid', type=int, default=200,
+                        help='number of hidden units per layer')
+    parser.add_argument('--nlayers', type=int, default=2,
+                        help='number of layers')
+    parser.add_argument('--nhead', type=int, default=2,
+                        help='the number of heads of the transformer model')
+    parser.add_argument('--positions', type=str, default='absolute', choices=['absolute', 'rotary'],
+                        help='position information of the transformer, see main.py (ignored with --checkpoint)')
+    parser.add_argument('--mem-len', type=int, default=0,
+                        help='segment memory of the transformer, see main.py (ignored with --checkpoint)')
+    parser.add_argument('--checkpoint-every', type=int, default=0,
+                        help='activation checkpointing of the transformer, see main.py')
+    parser.add_argument('--sparse-embedding', action='store_true',
+                        help='sparse embedding gradients, see main.py')
+    parser.add_argument('--accum-steps', type=int, default=1,
+                        help='batches per update, see main.py')
+    parser.add_argument('--batch_size', type=int, default=20,
+                        help='batch size')
+    parser.add_argument('--bptt', type=int, default=35,
+                        help='sequence length')
+    parser.add_argument('--steps', type=int, default=10,
+                        help='timed steps per config')
+    parser.add_argument('--pin', action='store_true',
+                        help='also try pinning the process to as many cores as it has intra-op threads')
+    args = parser.parse_args()
+    return args
+
+
+def available_cores():
+    # The cores this process may run on, fewer than os.cpu_count() under taskset or a container quota.
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def apply_config(config, local_rank=0):
+    """Applies a thread config {'intra': n, 'inter': n, 'pin': bool} to this process.
+
+    With pin, the process is bound to `intra` cores of the available ones, the
+    local_rank-th block of them, so that processes on one host (e.g. the ranks of
+    torchrun) don't share cores. The inter-op thread count can only be set before
+    the first inter-op parallel work of the process, later calls keep the current one.
+    """
+    if config.get('pin') and hasattr(os, 'sched_setaffinity'):
+        cores = available_cores()
+        start = local_rank * config['intra'] % len(cores)
+        os.sched_setaffinity(0, (cores + cores)[start:start + min(config['intra'], len(cores))])
+    if config.get('intra'):
+        torch.set_num_threads(config['intra'])
+    if config.get('inter'):
+        try:
+            torch.set_num_interop_threads(config['inter'])
+        except RuntimeError:
+            print('WARNING: the inter-op threads are already running, keeping {}.'.format(
+                torch.get_num_interop_threads()))
+
+
+def candidate_configs(num_cores, pin=False):
+    intra = sorted({1 << i for i in range(num_cores.bit_length()) if 1 << i <= num_cores} | {num_cores})
+    configs = [{'intra': n, 'inter': inter, 'pin': False} for n in intra for inter in [1, 2]]
+    if pin:
+        configs += [dict(config, pin=True) for config in configs]
+    return configs
+
+
+def make_workload(model, ntokens, emsize, nhid, nlayers, nhead, mode, batch_size, bptt, positions='absolute',
+                  mem_len=0, checkpoint_every=0, sparse_embedding=False, accum_steps=1):
+    """Returns the workload dict that benchmark() runs and the saved configs are looked up by.
+
+    Everything that changes the cost of a step is part of it: the rotary positions,
+    the segment memory and, when training, the activation checkpointing, the sparse
+    embedding gradients and the number of batches per update.
+    """
+    is_transformer = model == 'Transformer'
+    train = mode == 'train'
+    return {'model': model, 'ntokens': ntokens, 'emsize': emsize, 'nhid': nhid, 'nlayers': nlayers,
+            'nhead': nhead if is_transformer else 0, 'mode': mode, 'batch_size': batch_size, 'bptt': bptt,
+            'positions': positions if is_transformer else 'absolute', 'mem_len': mem_len if is_transformer else 0,
+            'checkpoint_every': checkpoint_every if is_transformer and train else 0,
+            'sparse_embedding': bool(sparse_embedding) and train, 'accum_steps': accum_steps if train else 1}
+
+
+def model_workload(model, mode, batch_size, bptt, checkpoint_every=0, sparse_embedding=False, accum_steps=1):
+    """Returns the workload of `model` (a RNNModel or TransformerModel) for the shape [bptt, batch_size]."""
+    if getattr(model, 'model_type', None) == 'Transformer':
+        layer = model.encoder.layers[0]
+        return make_workload('Transformer', model.decoder.out_features, model.ninp, layer.linear1.out_features,
+                             len(model.encoder.layers), layer.self_attn.num_heads, mode, batch_size, bptt,
+                             getattr(model, 'positions', 'absolute'), getattr(model, 'mem_len', 0),
+                             checkpoint_every, sparse_embedding, accum_steps)
+    return make_workload(model.rnn_type, model.decoder.out_features, model.encoder.embedding_dim, model.nhid,
+                         model.nlayers, 0, mode, batch_size, bptt, sparse_embedding=sparse_embedding,
+                         accum_steps=accum_steps)
+
+
+def workload_key(workload):
+    # Configs are only reused on hosts with the same number of cores.
+    return json.dumps(dict(workload, cores=len(available_cores())), sort_keys=True)
+
+
+def benchmark(workload, config, steps=10, warmup=3):
+    """Returns the tokens per second of `workload` with thread `config`, measured in this process."""
+    apply_config(config)
+    torch.manual_seed(0)
+    is_transformer = workload['model'] == 'Transformer'
+    if is_transformer:
+        model = TransformerModel(workload['ntokens'], workload['emsize'], workload['nhead'], workload['nhid'],
+                                 workload['nlayers'], positions=workload['positions'],
+                                 mem_len=workload['mem_len']).enable_fastpath()
+        model.set_checkpointing(workload['checkpoint_every'])
+        embedding = model.input_emb
+    else:
+        model = RNNModel(workload['model'], workload['ntokens'], workload['emsize'], workload['nhid'],
+                         workload['nlayers'])
+        embedding = model.encoder
+    embedding.sparse = workload['sparse_embedding']
+    data = torch.randint(workload['ntokens'], (workload['bptt'] + 1, workload['batch_size']))
+    inputs, targets = data[:-1], data[1:].reshape(-1)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    criterion = nn.NLLLoss()
+
+    def forward():
+        nonlocal mems
+        if is_transformer and workload['mem_len']:
+            output, mems = model(inputs, mems=mems)
+            return output
+        if is_transformer:
+            return model(inputs)
+        output, _ = model(inputs, hidden)
+        return output
+
+    def step():
+        # An update covers accum_steps batches, the tokens are counted per batch.
+        if workload['mode'] != 'train':
+            with torch.no_grad():
+                forward()
+            return
+        optimizer.zero_grad()
+        for _ in range(workload['accum_steps']):
+            criterion(forward().view(-1, workload['ntokens']), targets).backward()
+        optimizer.step()
+
+    model.train(workload['mode'] == 'train')
+    hidden = None if is_transformer else model.init_hidden(workload['batch_size'])
+    mems = model.init_mems() if is_transformer else None
+    for _ in range(warmup):
+        step()
+    start_time = time.perf_counter()
+    for _ in range(steps):
+        step()
+    return steps * workload['accum_steps'] * inputs.numel() / (time.perf_counter() - start_time)
+
+
+def tune(workload, steps=10, pin=False):
+    """Benchmarks every candidate config and returns (best config, [(config, tokens per second)]).
+
+    Every config runs in a fresh process: the inter-op threads and the affinity of
+    a process can't be reset once set.
+    """
+    import multiprocessing as mp
+    context = mp.get_context('spawn')
+    results = []
+    for config in candidate_configs(len(available_cores()), pin):
+        with context.Pool(1) as pool:
+            tokens_per_sec = pool.apply(benchmark, (workload, config, steps))
+        print('| intra {:3d} | inter {:2d} | pin {:5s} | {:10.0f} tokens/s'.format(
+            config['intra'], config['inter'], str(config['pin']), tokens_per_sec))
+        results.append((config, tokens_per_sec))
+    return max(results, key=lambda result: result[1])[0], results
+
+
+def load_config(path, workload):
+    """Returns the config saved for `workload` in the JSON file at `path`, or None."""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        entry = json.load(f).get(workload_key(workload))
+    return entry and entry['config']
+
+
+def save_config(path, workload, config, results):
+    configs = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            configs = json.load(f)
+    configs[workload_key(workload)] = {
+        'config': config,
+        'results': [dict(c, tokens_per_sec=tokens_per_sec) for c, tokens_per_sec in results],
+    }
+    # Write-then-rename, so that concurrent jobs never read a half written file.
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(configs, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def main():
+    args = get_args()
+    if args.checkpoint:
+        from generate import get_model
+        workload = model_workload(get_model(args.checkpoint, torch.device('cpu')), args.mode,
+                                  args.batch_size, args.bptt, args.checkpoint_every, args.sparse_embedding,
+                                  args.accum_steps)
+    else:
+        workload = make_workload(args.model, args.ntokens, args.emsize, args.nhid, args.nlayers, args.nhead,
+                                 args.mode, args.batch_size, args.bptt, args.positions, args.mem_len,
+                                 args.checkpoint_every, args.sparse_embedding, args.accum_steps)
+    config, results = tune(workload, args.steps, args.pin)
+    save_config(args.output, workload, config, results)
+    print('Best config {} saved to {}'.format(json.dumps(config), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,55 @@ class Dictionary(object):
     def __len__(self):
         return len(self.idx2word)
 
+    def save(self, path):
+        """Writes the vocabulary to a text file, one word per line in index order."""
+        with open(path, 'w', encoding="utf8") as f:
+            for word in self.idx2word:
+                f.write(word + '\n')
+
+    @classmethod
+    def load(cls, path):
+        """Reads a vocabulary written by save, without touching the corpus."""
+        dictionary = cls()
+        with open(path, 'r', encoding="utf8") as f:
+            dictionary.idx2word = f.read().splitlines()
+        dictionary.word2idx = {word: idx for idx, word in enumerate(dictionary.idx2word)}
+        return dictionary
+
+    def encode(self, text, final_eos=True):
+        """Returns the ids of the words in `text` as a 1-D tensor, tokenized like Corpus.
+
+        Every line ends with <eos>, except the last one with final_eos=False, e.g. for a
+        prompt that is continued on the same line. Words that are not in the
+        vocabulary become <unk>.
+        """
+        unk = self.word2idx.get('<unk>', 0)
+        # Only '\n' ends a line, as when Corpus reads a file (str.splitlines also splits on \x0c, \u2028, ...).
+        lines = text.split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        words = [word for line in lines for word in line.split() + ['<eos>']]
+        if lines and not final_eos:
+            words.pop()
+        return torch.tensor([self.word2idx.get(word, unk) for word in words], dtype=torch.long)
+
+
+def vocab_path(checkpoint):
+    # The vocabulary is saved next to the checkpoint, e.g. model.pt -> model.vocab.
+    return os.path.splitext(checkpoint)[0] + '.vocab'
+
+
+def checkpoint_identity(checkpoint):
+    # Identifies the weights of a checkpoint file in caches derived from it, a retrained
+    # or replaced file at the same path changes its modification time and size.
+    stat = os.stat(checkpoint)
+    return {'path': os.path.abspath(checkpoint), 'mtime': stat.st_mtime, 'size': stat.st_size}
+
+
+def corpus_identity(path):
+    # Like checkpoint_identity, for the train/valid/test files of the corpus at `path`.
+    return {split: checkpoint_identity(os.path.join(path, split + '.txt')) for split in ['train', 'valid', 'test']}
+
 
 class Corpus(object):
     def __init__(self, path):
@@ -46,3 +95,30 @@ class Corpus(object):
             ids = torch.cat(idss)
 
         return ids
+
+
+def load_corpus(path, cache=''):
+    """Returns Corpus(path), using the tokenized copy in `cache` if one exists.
+
+    A missing cache file is written after tokenizing, a cache of another corpus
+    (see corpus_identity) is rebuilt. Cached token tensors are memory-mapped, so
+    processes that load the same cache share one copy of them in the page cache
+    instead of each tokenizing and holding the corpus.
+    """
+    identity = corpus_identity(path) if cache else None
+    state = torch.load(cache, mmap=True) if cache and os.path.exists(cache) else None
+    if state is not None and state.get('identity') == identity:
+        corpus = Corpus.__new__(Corpus)
+        corpus.dictionary = Dictionary()
+        corpus.dictionary.idx2word = state['idx2word']
+        corpus.dictionary.word2idx = {word: idx for idx, word in enumerate(state['idx2word'])}
+        corpus.train, corpus.valid, corpus.test = state['train'], state['valid'], state['test']
+        return corpus
+    corpus = Corpus(path)
+    if cache:
+        # Write to a temporary file first, so that other processes never see half a cache.
+        tmp_path = '{}.{}.tmp'.format(cache, os.getpid())
+        torch.save({'identity': identity, 'idx2word': corpus.dictionary.idx2word, 'train': corpus.train,
+                    'valid': corpus.valid, 'test': corpus.test}, tmp_path)
+        os.replace(tmp_path, cache)
+    return corpus
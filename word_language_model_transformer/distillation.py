@@ -0,0 +1,95 @@
+import os
+
+import torch
+import torch.nn.functional as F
+
+import evaluation
+
+
+def teacher_log_probs(teacher, data):
+    """Returns the log-probabilities [sequence length, batch size, ntoken] of a frozen teacher for `data`.
+
+    RNN teachers start every call from a zero hidden state.
+    """
+    with torch.no_grad():
+        if getattr(teacher, 'model_type', None) == 'Transformer':
+            return teacher(data)
+        output, _ = teacher(data, teacher.init_hidden(data.size(1)))
+        return output.view(data.size(0), data.size(1), -1)
+
+
+def soft_targets(teacher, data, topk=0):
+    """Returns (indices, log_probs) of the teacher's predictions for `data`, one row per token.
+
+    With topk only the k most likely words of every prediction are kept, the
+    indices are None otherwise and the log-probabilities cover the vocabulary.
+    """
+    log_probs = teacher_log_probs(teacher, data).view(data.numel(), -1)
+    if not topk:
+        return None, log_probs
+    log_probs, indices = log_probs.topk(topk, dim=-1)
+    return indices, log_probs
+
+
+def build_teacher_cache(teacher, source, context_len, stride, topk, path, identity=None, data_identity=None):
+    """Writes the top-k teacher predictions for every position of the batchified `source` to `path`.
+
+    Every column of `source` [num tokens, batch size] is an independent stream, the
+    predictions are made with sliding windows of `context_len` tokens over the
+    streams, so every token sees at least context_len - stride tokens of context.
+    Row t holds the prediction of source[t + 1] in a compact form: int32 word
+    indices and float16 log-probabilities of shape [num tokens - 1, batch size, topk].
+    The teacher's `identity` (e.g. data.checkpoint_identity()), the `data_identity`
+    of the training data (e.g. data.corpus_identity() and the batch size) and the
+    window settings are saved with them for load_teacher_cache().
+    """
+    num_tokens, batch_size = source.shape
+    indices = torch.zeros(num_tokens - 1, batch_size, topk, dtype=torch.int32)
+    log_probs = torch.zeros(num_tokens - 1, batch_size, topk, dtype=torch.float16)
+    for begin, length, num_scored in evaluation.sliding_windows(num_tokens, context_len, stride):
+        window_indices, window_log_probs = soft_targets(teacher, source[begin:begin + length], topk)
+        scored = slice(length - num_scored, length)
+        rows = slice(begin + length - num_scored, begin + length)
+        indices[rows] = window_indices.view(length, batch_size, topk)[scored].to('cpu', torch.int32)
+        log_probs[rows] = window_log_probs.view(length, batch_size, topk)[scored].to('cpu', torch.float16)
+    # Write to a temporary file first, so that other processes never see half a cache.
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    torch.save({'indices': indices, 'log_probs': log_probs, 'context_len': context_len, 'stride': stride,
+                'identity': identity, 'data_identity': data_identity}, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_teacher_cache(path, source, context_len, stride, topk, identity=None, data_identity=None):
+    """Returns the memory-mapped (indices, log_probs) cached for `source` at `path`, or None if they don't match.
+
+    A cache built by another teacher (`identity`), for other training data
+    (`data_identity`) or with other windows is not used.
+    """
+    if not os.path.exists(path):
+        return None
+    cache = torch.load(path, mmap=True)
+    if (cache['indices'].shape != (source.size(0) - 1, source.size(1), topk)
+            or cache['context_len'] != context_len or cache.get('stride') != stride
+            or cache.get('identity') != identity or cache.get('data_identity') != data_identity):
+        return None
+    return cache['indices'], cache['log_probs']
+
+
+def distillation_loss(output, hard_loss, indices, teacher_log_probs, alpha, temperature):
+    """Mixes the hard target loss with the cross entropy against the teacher's soft targets.
+
+    `output` are the student log-probabilities [tokens, ntoken], `indices` and
+    `teacher_log_probs` the soft targets of soft_targets(). Both distributions are
+    softened by `temperature` and the soft loss is scaled by temperature ** 2, so
+    that its gradients keep their size (Hinton et al. 2015,
+    https://arxiv.org/abs/1503.02531). With top-k soft targets, both the teacher
+    and the student distributions are renormalized over the teacher's k words.
+    """
+    teacher_probs = F.softmax(teacher_log_probs.float() / temperature, dim=-1)
+    if indices is not None:
+        # The rest of the vocabulary has no soft target, it is left to the hard loss
+        # instead of being pushed towards zero probability.
+        output = output.gather(1, indices.long())
+    student_log_probs = F.log_softmax(output / temperature, dim=-1)
+    soft_loss = -(teacher_probs * student_log_probs).sum(-1).mean() * temperature ** 2
+    return alpha * soft_loss + (1 - alpha) * hard_loss
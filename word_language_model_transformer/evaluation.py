@@ -0,0 +1,326 @@
+import copy
+import math
+
+import torch
+
+
+# Sliding-window evaluation scores a flat token stream with overlapping windows,
+# so that every scored token sees up to `context_len` tokens of history.
+# With a context of 4 and a stride of 2 over the stream a b c d e f g h, we get
+# the windows below (x marks the targets that are scored in each window):
+#   inputs  a b c d     c d e f     e f g
+#   targets b c d e     d e f g     f g h
+#           x x x x         x x         x
+# The first window scores all of its targets, every later window only scores
+# the targets that the previous windows have not covered yet. A stride equal to
+# the context length gives disjoint chunks, which is what the classic bptt
+# evaluation does and is a lot cheaper. With disjoint chunks, RNN models are
+# evaluated exactly like that: the stream is split into batch_size columns and
+# the hidden state is carried from every chunk to the next, see stream_loss_sum.
+# Transformers with a segment memory (mem_len > 0) carry their memory the same
+# way, as they do in training.
+
+def sliding_windows(num_tokens, context_len, stride, offset=0):
+    """Returns a list of (begin, length, num_scored) windows covering a stream of num_tokens tokens.
+
+    Every window reads the inputs source[begin:begin+length] and scores the last
+    num_scored of its targets. All windows have the same length (shorter only if
+    the stream itself is shorter), the last one is shifted back so that it ends on
+    the last target. `offset` is added to every begin, for streams that start in
+    the middle of a larger tensor.
+    """
+    assert 0 < stride <= context_len, 'stride must be in (0, context_len]'
+    num_targets = num_tokens - 1
+    context_len = min(context_len, num_targets)
+    windows = []
+    scored = 0
+    begin = 0
+    while scored < num_targets:
+        begin = min(begin, num_targets - context_len)
+        end = begin + context_len
+        windows.append((offset + begin, context_len, end - scored))
+        scored = end
+        begin += stride
+    return windows
+
+
+def select_windows(num_tokens, context_len, stride, max_windows=None):
+    """Like sliding_windows, but keeps only `max_windows` evenly spaced windows if given."""
+    windows = sliding_windows(num_tokens, context_len, stride)
+    if max_windows and max_windows < len(windows):
+        step = len(windows) / max_windows
+        windows = [windows[int(i * step)] for i in range(max_windows)]
+    return windows
+
+
+def transformer_log_probs(model, data, padding_mask):
+    """Runs a Transformer on the right-padded [sequence length, batch] `data`, padding_mask[b, p] marking padding.
+
+    The causal mask already keeps the real tokens from attending to the padding
+    after them; the padding mask also keeps it out of the padding's own positions.
+    Rotary models attend in TransformerModel._attend, which takes no padding mask.
+    """
+    if getattr(model, 'positions', 'absolute') == 'rotary':
+        return model(data)
+    return model(data, src_key_padding_mask=padding_mask)
+
+
+def window_log_probs(model, source, windows, batch_size):
+    """Yields (windows, log_probs, scored) for every batch of `batch_size` windows.
+
+    log_probs[p, b] is the log-probability of target source[begin_b + p + 1] and
+    scored[p, b] tells whether that target counts for window b. Shorter windows are
+    right-padded, which doesn't change the scores since both model types only look
+    backwards (Transformers also get the padding as src_key_padding_mask). RNN
+    models start every window from a zero hidden state and memory Transformers
+    from an empty memory, so the window prefix is their only context (see
+    stream_loss_sum for disjoint windows).
+    """
+    model.eval()
+    is_transformer = getattr(model, 'model_type', None) == 'Transformer'
+    context_len = max(length for _, length, _ in windows)
+    offsets = torch.arange(context_len, device=source.device).unsqueeze(1)
+
+    with torch.no_grad():
+        for i in range(0, len(windows), batch_size):
+            chunk = windows[i:i+batch_size]
+            begins, lengths, num_scored = torch.tensor(chunk, device=source.device).t()
+            valid = offsets < lengths
+            index = (begins + offsets).clamp(max=source.size(0) - 2)
+            data = source[index].masked_fill(~valid, 0)
+            targets = source[index + 1].masked_fill(~valid, 0)
+            if is_transformer:
+                output = transformer_log_probs(model, data, ~valid.t())
+            else:
+                hidden = model.init_hidden(len(chunk))
+                output, _ = model(data, hidden)
+            output = output.view(context_len, len(chunk), -1)
+            log_probs = output.gather(2, targets.unsqueeze(2)).squeeze(2)
+            # Only the last num_scored positions of every window are counted.
+            scored = valid & (offsets >= lengths - num_scored)
+            yield chunk, log_probs, scored
+
+
+def window_loss_sum(model, source, windows, batch_size):
+    """Returns the summed negative log-likelihood and the number of scored tokens over `windows`."""
+    total_loss = 0.
+    total_scored = 0
+    for _, log_probs, scored in window_log_probs(model, source, windows, batch_size):
+        total_loss -= log_probs[scored].sum().item()
+        total_scored += int(scored.sum())
+    return total_loss, total_scored
+
+
+def carries_state(model):
+    # RNNs carry their hidden state from chunk to chunk, memory Transformers their segment memory.
+    return getattr(model, 'model_type', None) != 'Transformer' or bool(getattr(model, 'mem_len', 0))
+
+
+def carries_hidden(model, context_len, stride, max_windows=None):
+    # The state is kept across disjoint chunks, unless only a subset of them is scored.
+    return carries_state(model) and stride == context_len and not max_windows
+
+
+def stream_columns(source, batch_size):
+    """Splits the 1-D `source` into [num tokens // batch_size, batch_size] columns, like main.batchify."""
+    num_rows = source.size(0) // batch_size
+    return source[:num_rows * batch_size].view(batch_size, -1).t().contiguous()
+
+
+def stream_loss_sum(model, columns, context_len):
+    """Returns the summed negative log-likelihood and the number of targets of a model over the `columns`.
+
+    Every column of `columns` [num tokens, batch size] is read in disjoint chunks of
+    context_len tokens, each chunk starting from the hidden state (or, for a
+    Transformer with a segment memory, the memory) the previous one ended with,
+    as the bptt evaluation of the original main.py did.
+    """
+    model.eval()
+    total_loss = 0.
+    is_transformer = getattr(model, 'model_type', None) == 'Transformer'
+    hidden = model.init_mems() if is_transformer else model.init_hidden(columns.size(1))
+    with torch.no_grad():
+        for i in range(0, columns.size(0) - 1, context_len):
+            seq_len = min(context_len, columns.size(0) - 1 - i)
+            if is_transformer:
+                output, hidden = model(columns[i:i + seq_len], mems=hidden)
+            else:
+                output, hidden = model(columns[i:i + seq_len], hidden)
+            targets = columns[i + 1:i + 1 + seq_len].reshape(-1)
+            total_loss -= output.view(-1, output.size(-1)).gather(1, targets.unsqueeze(1)).sum().item()
+    return total_loss, (columns.size(0) - 1) * columns.size(1)
+
+
+def sliding_window_loss(model, source, context_len, stride, batch_size, max_windows=None):
+    """Average negative log-likelihood per scored token of the 1-D token tensor `source`.
+
+    If `max_windows` is given, only that many evenly spaced windows are scored,
+    which gives a quick approximation of the full result. RNN and memory models
+    evaluated on disjoint windows carry their state over batch_size columns of the
+    stream instead (see stream_loss_sum), which drops the last
+    len(source) % batch_size tokens.
+    """
+    if carries_hidden(model, context_len, stride, max_windows):
+        columns = stream_columns(source, batch_size)
+        check_scored(columns.size(0) - 1, source)
+        total_loss, total_scored = stream_loss_sum(model, columns, context_len)
+        return total_loss / total_scored
+    check_scored(source.size(0) - 1, source)
+    windows = select_windows(source.size(0), context_len, stride, max_windows)
+    total_loss, total_scored = window_loss_sum(model, source, windows, batch_size)
+    return total_loss / total_scored
+
+
+def check_scored(num_targets, source):
+    # Raised instead of dividing by zero scored tokens.
+    if num_targets < 1:
+        raise ValueError('{} tokens are too few to evaluate, every stream needs at least 2'.format(source.size(0)))
+
+
+def document_log_probs(model, documents, context_len, stride, batch_size):
+    """Returns, for each 1-D token tensor in `documents`, the log-probabilities of its tokens 1..n-1.
+
+    Each document is scored with its own sliding windows, but windows of different
+    documents share batches, so many short documents still make large batches.
+    """
+    source = torch.cat(documents)
+    starts = [0]
+    for document in documents:
+        starts.append(starts[-1] + len(document))
+    windows = []
+    for document, start in zip(documents, starts):
+        if len(document) > 1:
+            windows += sliding_windows(len(document), context_len, stride, offset=start)
+    # The log-probability of target source[k + 1] is stored at out[k].
+    out = torch.zeros(source.size(0), device=source.device)
+    if windows:
+        for chunk, log_probs, scored in window_log_probs(model, source, windows, batch_size):
+            begins = torch.tensor([begin for begin, _, _ in chunk], device=source.device)
+            positions = begins + torch.arange(log_probs.size(0), device=source.device).unsqueeze(1)
+            out[positions[scored]] = log_probs[scored]
+    # max() keeps an empty document at start 0 from slicing out[0:-1].
+    return [out[start:start + max(len(document) - 1, 0)] for document, start in zip(documents, starts)]
+
+
+def sequence_log_probs(model, sequences):
+    """Returns, for each 1-D token tensor in `sequences`, the log-probabilities of its tokens 1..n-1.
+
+    The sequences are right-padded into one [max length, batch] tensor and scored
+    in a single forward pass. Both model types only look backwards, so the padding
+    doesn't change the scores of the real tokens; Transformers also get it as
+    src_key_padding_mask.
+    """
+    model.eval()
+    device = sequences[0].device
+    lengths = [len(seq) for seq in sequences]
+    data = torch.zeros(max(lengths), len(sequences), dtype=torch.long, device=device)
+    for i, seq in enumerate(sequences):
+        data[:len(seq), i] = seq
+    with torch.no_grad():
+        if getattr(model, 'model_type', None) == 'Transformer':
+            positions = torch.arange(data.size(0) - 1, device=device)
+            padding_mask = positions >= torch.tensor(lengths, device=device).unsqueeze(1) - 1
+            output = transformer_log_probs(model, data[:-1], padding_mask)
+        else:
+            output, _ = model(data[:-1], model.init_hidden(len(sequences)))
+        output = output.view(data.size(0) - 1, len(sequences), -1)
+        log_probs = output.gather(2, data[1:].unsqueeze(2)).squeeze(2)
+    return [log_probs[:length - 1, i] for i, length in enumerate(lengths)]
+
+
+###############################################################################
+# Evaluation in worker processes
+###############################################################################
+
+def weights_snapshot(model):
+    """Returns a copy of `model` with its weights but without its gradients."""
+    params = list(model.parameters())
+    grads = [param.grad for param in params]
+    for param in params:
+        param.grad = None
+    try:
+        return copy.deepcopy(model)
+    finally:
+        for param, grad in zip(params, grads):
+            param.grad = grad
+
+
+def _evaluate_shard(num_threads, loss_sum, *args):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    return loss_sum(*args)
+
+
+class PendingLoss(object):
+    """Result of ParallelEvaluator.submit, reduces the per-shard losses once they are ready."""
+
+    def __init__(self, futures, snapshot):
+        self.futures = futures
+        # The weights that are being evaluated, e.g. to checkpoint them if they turn out best.
+        self.snapshot = snapshot
+
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    def result(self):
+        total_loss = 0.
+        total_scored = 0
+        for future in self.futures:
+            loss, scored = future.result()
+            total_loss += loss
+            total_scored += scored
+        return total_loss / total_scored
+
+
+class ParallelEvaluator(object):
+    """Runs sliding-window evaluation on a pool of CPU worker processes.
+
+    Every submit() takes a snapshot of the model weights, so training can carry on
+    while the snapshot is evaluated. The windows (or, for models that carry their
+    state, the columns of the stream) are split into one shard per worker
+    and the per-shard losses are summed when the result is requested.
+    Workers are spawned, not forked: a fork after the parent's intra-op thread
+    pool has run can deadlock in the child. The snapshot and the data reach them
+    through shared memory.
+    """
+
+    def __init__(self, num_workers, num_threads=None):
+        self.num_workers = num_workers
+        if num_threads is None:
+            num_threads = max(1, torch.get_num_threads() // num_workers)
+        self.num_threads = num_threads
+        self.pool = None
+
+    def _get_pool(self):
+        if self.pool is None:
+            # Importing torch.multiprocessing lets tensors travel to the workers through shared memory.
+            import torch.multiprocessing as mp
+            from concurrent.futures import ProcessPoolExecutor
+            self.pool = ProcessPoolExecutor(self.num_workers, mp_context=mp.get_context('spawn'))
+        return self.pool
+
+    def submit(self, model, source, context_len, stride, batch_size, max_windows=None):
+        snapshot = weights_snapshot(model).cpu().eval()
+        snapshot.share_memory()
+        source = source.cpu().share_memory_()
+        pool = self._get_pool()
+        if carries_hidden(snapshot, context_len, stride, max_windows):
+            columns = stream_columns(source, batch_size)
+            check_scored(columns.size(0) - 1, source)
+            shard_size = math.ceil(batch_size / self.num_workers)
+            futures = [pool.submit(_evaluate_shard, self.num_threads, stream_loss_sum, snapshot,
+                                   columns[:, i:i+shard_size].contiguous().share_memory_(), context_len)
+                       for i in range(0, batch_size, shard_size)]
+            return PendingLoss(futures, snapshot)
+        check_scored(source.size(0) - 1, source)
+        windows = select_windows(source.size(0), context_len, stride, max_windows)
+        shard_size = math.ceil(len(windows) / self.num_workers)
+        futures = [pool.submit(_evaluate_shard, self.num_threads, window_loss_sum, snapshot, source,
+                               windows[i:i+shard_size], batch_size)
+                   for i in range(0, len(windows), shard_size)]
+        return PendingLoss(futures, snapshot)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
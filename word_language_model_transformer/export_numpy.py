@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+###############################################################################
+# Language Modeling on Wikitext-2
+#
+# This file exports the weights of a trained TransformerModel to an .npz file
+# for the torch-free inference in building_blocks/transformer.py and checks
+# that the NumPy log-probabilities match the torch model:
+#
+#   python export_numpy.py --checkpoint model.pt --output model.npz
+#
+# The exported model then only needs NumPy:
+#
+#   from building_blocks.transformer import TransformerLM
+#   log_probs = TransformerLM.load('model.npz')(token_ids)
+#
+###############################################################################
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+from generate import get_model
+
+# building_blocks lives next to this directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from building_blocks.transformer import TransformerLM
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Export a Wikitext-2 Transformer Language Model to NumPy')
+    parser.add_argument('--checkpoint', type=str, default='./model.pt',
+                        help='model checkpoint to export')
+    parser.add_argument('--output', type=str, default='',
+                        help='.npz file to write (default: the checkpoint with an .npz extension)')
+    parser.add_argument('--check-len', type=int, default=35,
+                        help='sequence length of the random batch compared against torch (0 = no check)')
+    parser.add_argument('--check-batch-size', type=int, default=10,
+                        help='batch size of the random batch compared against torch')
+    parser.add_argument('--atol', type=float, default=1e-3,
+                        help='largest allowed difference between the torch and NumPy log-probabilities')
+    parser.add_argument('--seed', type=int, default=1111,
+                        help='random seed of the check batch')
+    args = parser.parse_args()
+    return args
+
+
+def export_weights(model, path):
+    """Saves the float32 weights of a TransformerModel and its config to the .npz at `path`."""
+    if getattr(model, 'model_type', None) != 'Transformer':
+        raise ValueError('Only Transformer models can be exported to NumPy')
+    if getattr(model, 'quantized', False):
+        raise ValueError('Quantized models can not be exported to NumPy, export the float checkpoint')
+    if type(model.decoder) is not torch.nn.Linear or type(model.input_emb) is not torch.nn.Embedding:
+        raise ValueError('Compressed models can not be exported to NumPy, export the uncompressed checkpoint')
+    layer = model.encoder.layers[0]
+    if layer.norm_first or layer.activation_relu_or_gelu != 1:
+        raise ValueError('Only post-norm encoder layers with ReLU are supported')
+    config = {
+        'ninp': model.ninp,
+        'nhead': layer.self_attn.num_heads,
+        'nlayers': len(model.encoder.layers),
+        'positions': getattr(model, 'positions', 'absolute'),
+        'mem_len': getattr(model, 'mem_len', 0),
+    }
+    weights = {name: tensor.detach().float().cpu().numpy() for name, tensor in model.state_dict().items()}
+    np.savez(path, config=json.dumps(config), **weights)
+
+
+def main():
+    args = get_args()
+    output = args.output or os.path.splitext(args.checkpoint)[0] + '.npz'
+    model = get_model(args.checkpoint, torch.device('cpu'))
+    export_weights(model, output)
+    print('NumPy weights saved to {} ({:.1f} MB)'.format(output, os.path.getsize(output) / 2**20))
+    if not args.check_len:
+        return
+
+    numpy_model = TransformerLM.load(output)
+    torch.manual_seed(args.seed)
+    src = torch.randint(numpy_model.ntoken, (args.check_len, args.check_batch_size))
+    start_time = time.time()
+    with torch.no_grad():
+        expected = model(src).numpy()
+    torch_time = time.time() - start_time
+    start_time = time.time()
+    log_probs = numpy_model(src.numpy())
+    numpy_time = time.time() - start_time
+    error = float(np.abs(log_probs - expected).max())
+    print('| max abs difference {:.2e} | torch {:5.1f} ms | numpy {:5.1f} ms'.format(
+        error, torch_time * 1000, numpy_time * 1000))
+    if not error <= args.atol:
+        sys.exit('The NumPy log-probabilities differ from torch by more than --atol {}'.format(args.atol))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,22 +5,31 @@
 #
 ###############################################################################
 import argparse
+import os
+import sys
 
 import torch
 
 import data
-from model import PositionalEncoding, RNNModel, TransformerModel
+import prefix_cache
+import sampling
+from model import (LowRankEmbedding, LowRankLinear, PositionalEncoding, PrunedEmbedding, PrunedLinear, RNNModel,
+                   TransformerModel)
 
 
 def get_args():
     parser = argparse.ArgumentParser(description='PyTorch Wikitext-2 Language Model')
     # Model parameters.
     parser.add_argument('--data', type=str, default='../data/wikitext-2',
-                        help='location of the data corpus')
+                        help='location of the data corpus, only read if there is no vocabulary file')
+    parser.add_argument('--vocab', type=str, default='',
+                        help='vocabulary file saved by main.py (default: next to the checkpoint)')
     parser.add_argument('--checkpoint', type=str, default='./model.pt',
                         help='model checkpoint to use')
     parser.add_argument('--outf', type=str, default='generated.txt',
-                        help='output file for generated text')
+                        help='output file for generated text (- for stdout)')
+    parser.add_argument('--prompt', type=str, default='',
+                        help='words to start the generation from (default: a random word)')
     parser.add_argument('--words', type=int, default='1000',
                         help='number of words to generate')
     parser.add_argument('--seed', type=int, default=1111,
@@ -31,12 +40,47 @@ def get_args():
                             help='enables macOS GPU training')
     parser.add_argument('--temperature', type=float, default=1.0,
                         help='temperature - higher will increase diversity')
+    parser.add_argument('--top-k', type=int, default=0,
+                        help='sample among the k most likely words (0 = whole vocabulary)')
+    parser.add_argument('--top-p', type=float, default=1.0,
+                        help='sample among the most likely words covering this probability mass (1.0 = all)')
+    parser.add_argument('--greedy', action='store_true',
+                        help='always pick the most likely word')
+    parser.add_argument('--draft-checkpoint', type=str, default='',
+                        help='RNN model checkpoint that drafts words for speculative decoding of a Transformer')
+    parser.add_argument('--draft-tokens', type=int, default=4,
+                        help='number of words drafted per speculative decoding step')
+    parser.add_argument('--prefix-cache', type=str, default='',
+                        help='file that keeps the model states of earlier prompts across runs (ignored when saved for another checkpoint)')
+    parser.add_argument('--prefix-cache-mb', type=float, default=256,
+                        help='memory budget of the prefix cache in MB')
     parser.add_argument('--log-interval', type=int, default=100,
                         help='reporting interval')
+    parser.add_argument('--onnx', type=str, default='',
+                        help='generate with this ONNX model (from main.py --onnx-export) on ONNX Runtime instead of --checkpoint '
+                             '(needs onnxruntime)')
+    parser.add_argument('--quantize', action='store_true',
+                        help='apply dynamic int8 quantization to the model before generating (CPU only)')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='intra-op CPU threads (0 = the --thread-config or PyTorch default)')
+    parser.add_argument('--thread-config', type=str, default='',
+                        help='JSON file of thread configs tuned with cpu_threads.py --mode inference --batch_size 1 --bptt 1')
     args = parser.parse_args()
 
     if args.temperature < 1e-3:
         parser.error("--temperature has to be greater or equal 1e-3.")
+    if args.top_k < 0:
+        parser.error("--top-k has to be greater or equal 0.")
+    if not 0 < args.top_p <= 1:
+        parser.error("--top-p has to be in (0, 1].")
+    if args.draft_tokens < 1:
+        parser.error("--draft-tokens has to be greater or equal 1.")
+    if args.prefix_cache and args.draft_checkpoint:
+        # Speculative decoding rescores the whole sequence with the target, it has no use for cached states.
+        parser.error("--prefix-cache can not be used with --draft-checkpoint.")
+    if args.quantize and args.onnx:
+        # quantize_model converts PyTorch modules, the ONNX Runtime session has none.
+        parser.error("--quantize can not be used with --onnx.")
 
     return args
 
@@ -81,49 +125,299 @@ def get_model(checkpoint, device):
         torch.nn.modules.rnn.RNN,
         torch.nn.modules.transformer.TransformerEncoder,
         torch.nn.modules.transformer.TransformerEncoderLayer,
+        # Checkpoints written by compress.py.
+        LowRankEmbedding,
+        LowRankLinear,
+        PrunedEmbedding,
+        PrunedLinear,
+        # Checkpoints written by quantize.py.
+        torch.ScriptObject,
+        torch.ao.nn.quantized.dynamic.modules.linear.Linear,
+        torch.ao.nn.quantized.dynamic.modules.rnn.GRU,
+        torch.ao.nn.quantized.dynamic.modules.rnn.LSTM,
+        torch.ao.nn.quantized.dynamic.modules.rnn.PackedParameter,
+        torch.ao.nn.quantized.modules.linear.LinearPackedParams,
     ]
 
     with torch.serialization.safe_globals(safe_globals):
         model = torch.load(f, map_location=device)
 
+    if getattr(model, 'model_type', None) == 'Transformer' and not getattr(model, 'quantized', False):
+        # Checkpoints saved before the fast path existed still have seq-first encoder layers.
+        model.enable_fastpath()
     model.eval()
     return model
 
 
-def main():
-    args = get_args()
-    device = get_device(args)
-    model = get_model(args.checkpoint, device)
+class OnnxRuntimeModel(object):
+    """Runs a model exported by main.py --onnx-export on the ONNX Runtime CPU backend.
+
+    Calls follow RNNModel / TransformerModel: `model(input, hidden)` returns the
+    log-probabilities and the next hidden state for RNNs and `model(input)` returns
+    the log-probabilities for Transformers. The exported Transformer always applies
+    the causal mask.
+    """
+
+    def __init__(self, path):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.inputs = self.session.get_inputs()
+        self.model_type = 'Transformer' if len(self.inputs) == 1 else 'RNN'
+
+    def eval(self):
+        return self
 
-    corpus = data.Corpus(args.data)
-    ntokens = len(corpus.dictionary)
+    def init_hidden(self, bsz):
+        # Hidden inputs are [nlayers, batch, nhid], two of them (h0, c0) for LSTMs.
+        hidden = tuple(torch.zeros(i.shape[0], bsz, i.shape[2]) for i in self.inputs[1:])
+        return hidden if len(hidden) > 1 else hidden[0]
 
+    def __call__(self, input, hidden=None):
+        feed = {'input': input.cpu().numpy()}
+        if self.model_type == 'Transformer':
+            return torch.from_numpy(self.session.run(None, feed)[0])
+        hidden = hidden if isinstance(hidden, tuple) else (hidden,)
+        for i, h in zip(self.inputs[1:], hidden):
+            feed[i.name] = h.numpy()
+        output, *hidden = [torch.from_numpy(x) for x in self.session.run(None, feed)]
+        return output, (tuple(hidden) if len(hidden) > 1 else hidden[0])
+
+
+def sample_tokens(model, input, num_words, sampler):
+    """Yields num_words word ids sampled from `model` after the [sequence length, 1] prompt `input`."""
+    if getattr(model, 'mem_len', 0):
+        # Decode with the bounded segment memory instead of rerunning the whole sequence.
+        yield from sample_tokens_cached(model, input.view(-1).tolist(), num_words, sampler, None)
+        return
     is_transformer_model = hasattr(model, 'model_type') and model.model_type == 'Transformer'
     if not is_transformer_model:
         hidden = model.init_hidden(1)
-    input = torch.randint(ntokens, (1, 1), dtype=torch.long).to(device)
-
-    with open(args.outf, 'w') as outf:
-        with torch.no_grad():  # no tracking history
-            for i in range(args.words):
-                if is_transformer_model:
-                    output = model(input, False)
-                    word_weights = output[-1].squeeze().div(args.temperature).exp().cpu()
-                    word_idx = torch.multinomial(word_weights, 1)[0]
-                    word_tensor = torch.Tensor([[word_idx]]).long().to(device)
-                    input = torch.cat([input, word_tensor], 0)
-                else:
-                    output, hidden = model(input, hidden)
-                    word_weights = output.squeeze().div(args.temperature).exp().cpu()
-                    word_idx = torch.multinomial(word_weights, 1)[0]
-                    input.fill_(word_idx)
-
-                word = corpus.dictionary.idx2word[word_idx]
-
-                outf.write(word + ('\n' if i % 20 == 19 else ' '))
-
-                if i % args.log_interval == 0:
-                    print('| Generated {}/{} words'.format(i, args.words))
+    with torch.no_grad():  # no tracking history
+        for i in range(num_words):
+            if is_transformer_model:
+                # Causal like training, the cached, batched and speculative decoders and the ONNX export.
+                output = model(input)
+                word_idx = sampler(output[-1])
+                input = torch.cat([input, word_idx.view(1, 1)], 0)
+            else:
+                output, hidden = model(input, hidden)
+                word_idx = sampler(output[-1:])
+                input = word_idx.view(1, 1)
+            # Only the sampled id leaves the device.
+            yield word_idx.item()
+
+
+def get_dictionary(vocab, data_path):
+    if os.path.exists(vocab):
+        return data.Dictionary.load(vocab)
+    print('No vocabulary at {}, building it from the corpus at {}.'.format(vocab, data_path), file=sys.stderr)
+    return data.Corpus(data_path).dictionary
+
+
+def sample_tokens_cached(model, ids, num_words, sampler, cache):
+    """Like sample_tokens, but starts from the cached state of the longest known prefix of the
+    prompt `ids` and decodes incrementally, see prefix_cache.PrefixCache."""
+    state, log_probs = prefix_cache.encode_prefix(model, ids, cache)
+    with torch.no_grad():
+        for i in range(num_words):
+            word_idx = sampler(log_probs)
+            yield word_idx.item()
+            if i + 1 < num_words:
+                log_probs, state = prefix_cache.step(model, word_idx.view(1, 1), state)
+
+
+def encode_prompt(dictionary, prompt, device):
+    # Generation continues the last line of the prompt, so it doesn't end with <eos>.
+    ids = dictionary.encode(prompt, final_eos=False)
+    if not len(ids):
+        ids = torch.randint(len(dictionary), (1,))
+    return ids.to(device).view(-1, 1)
+
+
+def generate_stream(model, dictionary, prompt='', num_words=1000, sampler=None,
+                    draft_model=None, draft_tokens=4, cache=None):
+    """Yields num_words generated words, each one as soon as it has been sampled.
+
+    The model (see get_model) and the dictionary are loaded once by the caller and
+    can be reused across calls, e.g. from a long-running service:
+        >>> dictionary = data.Dictionary.load(data.vocab_path('model.pt'))
+        >>> for word in generate_stream(model, dictionary, 'the game', 50):
+        ...     print(word, end=' ')
+    `prompt` is a string of whitespace separated words, without one the generation
+    starts from a random word. If an RNN `draft_model` is given, a Transformer
+    `model` is decoded speculatively, see sampling.speculative_decode. Otherwise a
+    prefix_cache.PrefixCache passed as `cache` lets prompts reuse the model states
+    computed for earlier prompts with the same beginning (the two can't be combined).
+    """
+    sampler = sampler or sampling.Sampler()
+    device = next(model.parameters()).device if isinstance(model, torch.nn.Module) else torch.device('cpu')
+    input = encode_prompt(dictionary, prompt, device)
+    if draft_model is not None:
+        if getattr(model, 'model_type', None) != 'Transformer' or getattr(draft_model, 'model_type', None) == 'Transformer':
+            raise ValueError('Speculative decoding needs a Transformer model and an RNN draft model')
+        if getattr(model, 'mem_len', 0):
+            raise ValueError('Speculative decoding does not support models with a segment memory')
+        if cache is not None:
+            raise ValueError('Speculative decoding does not use a prefix cache')
+        word_ids = sampling.speculative_decode(model, draft_model, input, num_words, sampler, draft_tokens)
+    elif cache is not None:
+        word_ids = sample_tokens_cached(model, input.view(-1).tolist(), num_words, sampler, cache)
+    else:
+        word_ids = sample_tokens(model, input, num_words, sampler)
+    idx2word = dictionary.idx2word
+    for word_idx in word_ids:
+        yield idx2word[word_idx]
+
+
+def generate_batch(model, prompts, num_words, samplers, cache=None):
+    """Generates for several requests at once and returns one list of word ids per request.
+
+    `prompts` are 1-D token tensors of any length, `num_words` and `samplers` give the
+    number of words and the Sampler of every request. All sequences advance by one
+    token per step: a row still consumes its prompt while the model output is
+    already sampled for rows with shorter prompts, so every step is a single batched
+    forward pass for both model types. With a prefix_cache.PrefixCache as `cache`,
+    and for Transformers with a segment memory, whose tokens only see the last
+    mem_len keys as in sample_tokens, see generate_batch_cached instead.
+    """
+    if cache is not None or getattr(model, 'mem_len', 0):
+        return generate_batch_cached(model, prompts, num_words, samplers, cache)
+    device = prompts[0].device
+    lengths = [len(prompt) for prompt in prompts]
+    ends = [length + n for length, n in zip(lengths, num_words)]
+    seqs = torch.zeros(max(ends), len(prompts), dtype=torch.long, device=device)
+    for i, prompt in enumerate(prompts):
+        seqs[:len(prompt), i] = prompt
+
+    is_transformer_model = hasattr(model, 'model_type') and model.model_type == 'Transformer'
+    if not is_transformer_model:
+        hidden = model.init_hidden(len(prompts))
+    with torch.no_grad():
+        for t in range(max(ends) - 1):
+            if is_transformer_model:
+                output = model(seqs[:t+1])[-1]
+            else:
+                output, hidden = model(seqs[t:t+1], hidden)
+            for i in range(len(prompts)):
+                if lengths[i] <= t + 1 < ends[i]:
+                    seqs[t+1, i] = samplers[i](output[i])
+    return [seqs[length:end, i].tolist() for i, (length, end) in enumerate(zip(lengths, ends))]
+
+
+def generate_batch_cached(model, prompts, num_words, samplers, cache):
+    """Like generate_batch, but only runs every prompt from its longest prefix in `cache` (if given).
+
+    The states of RNN rows are stacked along the batch dimension, so they decode
+    together with one forward pass per step. The cached keys and values of
+    Transformer rows have different lengths, every row decodes incrementally on
+    its own, see sample_tokens_cached.
+    """
+    ids = [prompt.tolist() for prompt in prompts]
+    if getattr(model, 'model_type', None) == 'Transformer':
+        return [list(sample_tokens_cached(model, prompt, n, sampler, cache))
+                for prompt, n, sampler in zip(ids, num_words, samplers)]
+    states, log_probs = zip(*[prefix_cache.encode_prefix(model, prompt, cache) for prompt in ids])
+    if isinstance(states[0], tuple):
+        hidden = tuple(torch.cat(parts, 1) for parts in zip(*states))
+    else:
+        hidden = torch.cat(states, 1)
+    output = torch.cat(log_probs, 0)
+    word_ids = [[] for _ in prompts]
+    input = torch.zeros(1, len(prompts), dtype=torch.long, device=prompts[0].device)
+    with torch.no_grad():
+        for t in range(max(num_words)):
+            for i, n in enumerate(num_words):
+                if t < n:
+                    input[0, i] = samplers[i](output[i])
+                    word_ids[i].append(int(input[0, i]))
+            if t + 1 < max(num_words):
+                output, hidden = model(input, hidden)
+    return word_ids
+
+
+class LineSink(object):
+    """Buffers words and writes them to a text stream a line of `words_per_line` words at a time.
+
+    With flush=True the stream is flushed after every line, so that a reader of
+    stdout or a pipe sees the text as it is generated.
+    """
+
+    def __init__(self, stream, words_per_line=20, flush=False):
+        self.stream = stream
+        self.words_per_line = words_per_line
+        self.flush = flush
+        self.words = []
+
+    def write(self, word):
+        self.words.append(word)
+        if len(self.words) == self.words_per_line:
+            self.stream.write(' '.join(self.words) + '\n')
+            self.words = []
+            if self.flush:
+                self.stream.flush()
+
+    def close(self):
+        if self.words:
+            self.stream.write(' '.join(self.words) + ' ')
+            self.words = []
+        self.stream.flush()
+
+
+def main():
+    args = get_args()
+    device = get_device(args)
+    if args.onnx:
+        model = OnnxRuntimeModel(args.onnx)
+        device = torch.device('cpu')
+    else:
+        model = get_model(args.checkpoint, device)
+    if args.quantize:
+        from quantize import quantize_model
+        model = quantize_model(model)
+        device = torch.device('cpu')
+    draft_model = get_model(args.draft_checkpoint, device) if args.draft_checkpoint else None
+    if args.thread_config or args.threads:
+        import cpu_threads
+        config = {}
+        if args.thread_config and not args.onnx:
+            # Generation runs the model on one word at a time.
+            config = cpu_threads.load_config(args.thread_config, cpu_threads.model_workload(model, 'inference', 1, 1))
+            if config is None:
+                print('WARNING: {} has no thread config for this model.'.format(args.thread_config))
+        config = dict(config or {})
+        if args.threads:
+            config['intra'] = args.threads
+        cpu_threads.apply_config(config)
+
+    dictionary = get_dictionary(args.vocab or data.vocab_path(args.onnx or args.checkpoint), args.data)
+    sampler = sampling.Sampler(args.temperature, args.top_k, args.top_p, args.greedy)
+    cache = None
+    if args.prefix_cache:
+        if args.onnx:
+            raise ValueError('--prefix-cache needs a PyTorch --checkpoint')
+        # Quantizing changes the states, the float and quantized models don't share entries.
+        identity = dict(data.checkpoint_identity(args.checkpoint), quantized=bool(args.quantize))
+        cache = prefix_cache.PrefixCache(int(args.prefix_cache_mb * 2**20), identity=identity)
+        if os.path.exists(args.prefix_cache) and not cache.load(args.prefix_cache, device):
+            print('WARNING: {} was saved for another model, starting with an empty prefix cache.'.format(
+                args.prefix_cache))
+    words = generate_stream(model, dictionary, args.prompt, args.words, sampler,
+                            draft_model, args.draft_tokens, cache)
+
+    to_stdout = args.outf == '-'
+    outf = sys.stdout if to_stdout else open(args.outf, 'w')
+    sink = LineSink(outf, flush=to_stdout)
+    try:
+        for i, word in enumerate(words):
+            sink.write(word)
+            if not to_stdout and i % args.log_interval == 0:
+                print('| Generated {}/{} words'.format(i, args.words))
+    finally:
+        sink.close()
+        if not to_stdout:
+            outf.close()
+    if cache is not None:
+        cache.save(args.prefix_cache)
 
 
 if __name__ == '__main__':
@@ -1,22 +1,31 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
+import copy
 import math
 import json
 import os
+import random
+import sys
 import time
 
 import torch
 import torch.nn as nn
-import torch.onnx
 
 import data
+import distillation
+import evaluation
+import optimization
 from model import PositionalEncoding, RNNModel, TransformerModel
 
 
-def get_args():
+def get_args(argv=None):
+    # argv defaults to sys.argv[1:], Trainer users pass their own list.
     parser = argparse.ArgumentParser(description='PyTorch Wikitext-2 RNN/LSTM/GRU/Transformer Language Model')
     parser.add_argument('--data', type=str, default='../data/wikitext-2',
                         help='location of the data corpus')
+    parser.add_argument('--corpus-cache', type=str, default='',
+                        help='file with the tokenized corpus, written on first use (or for another --data) and memory-mapped afterwards')
     parser.add_argument('--model', type=str, default='Transformer',
                         help='type of network (RNN_TANH, RNN_RELU, LSTM, GRU, Transformer)')
     parser.add_argument('--emsize', type=int, default=200,
@@ -27,18 +36,47 @@ def get_args():
                         help='number of layers')
     parser.add_argument('--lr', type=float, default=20,
                         help='initial learning rate')
+    parser.add_argument('--optimizer', type=str, default='sgd', choices=['sgd', 'adamw'],
+                        help='optimizer')
+    parser.add_argument('--momentum', type=float, default=0,
+                        help='SGD momentum')
+    parser.add_argument('--weight-decay', type=float, default=0,
+                        help='weight decay (decoupled for AdamW)')
+    parser.add_argument('--schedule', type=str, default='plateau', choices=optimization.LRScheduler.schedules,
+                        help='learning rate schedule (plateau divides lr by 4 when validation does not improve)')
+    parser.add_argument('--warmup-steps', type=int, default=0,
+                        help='number of updates over which the learning rate warms up linearly')
     parser.add_argument('--clip', type=float, default=0.25,
                         help='gradient clipping')
     parser.add_argument('--epochs', type=int, default=40,
                         help='upper epoch limit')
+    parser.add_argument('--patience', type=int, default=0,
+                        help='stop after this many epochs without a better validation loss (0 = never)')
+    parser.add_argument('--max-time', type=float, default=0,
+                        help='stop training after this many minutes (0 = no limit)')
+    parser.add_argument('--max-tokens', type=int, default=0,
+                        help='stop training after this many training tokens, summed over all processes (0 = no limit)')
     parser.add_argument('--batch_size', type=int, default=20, metavar='N',
                         help='batch size')
     parser.add_argument('--bptt', type=int, default=35,
                         help='sequence length')
+    parser.add_argument('--bptt-warmup', type=float, default=0,
+                        help='grow the sequence length linearly from --bptt-min to --bptt over this many epochs')
+    parser.add_argument('--bptt-min', type=int, default=8,
+                        help='sequence length at the start of --bptt-warmup')
+    parser.add_argument('--variable-bptt', action='store_true',
+                        help='draw every sequence length around the current one, as in AWD-LSTM')
+    parser.add_argument('--accum-steps', type=int, default=1,
+                        help='sum the gradients of this many batches before every update')
+    parser.add_argument('--bucket-mb', type=float, default=25,
+                        help='size of the gradient buckets all-reduced together when run with torchrun')
     parser.add_argument('--dropout', type=float, default=0.2,
                         help='dropout applied to layers (0 = no dropout)')
     parser.add_argument('--tied', action='store_true',
                         help='tie the word embedding and softmax weights')
+    parser.add_argument('--sparse-embedding', action='store_true',
+                        help='use sparse gradients for the word embedding and update only the rows in each batch '
+                             '(SGD updates the embedding without --momentum)')
     parser.add_argument('--seed', type=int, default=1111,
                         help='random seed')
     parser.add_argument('--cuda', action='store_true', default=False,
@@ -49,15 +87,100 @@ def get_args():
                         help='report interval')
     parser.add_argument('--save', type=str, default='model.pt',
                         help='path to save the final model')
+    parser.add_argument('--resume', type=str, default='',
+                        help='continue training from this checkpoint and the optimizer state saved next to it')
     parser.add_argument('--onnx-export', type=str, default='',
-                        help='path to export the final model in onnx format')
+                        help='path to export the final model in onnx format (needs onnx and onnxscript)')
     parser.add_argument('--nhead', type=int, default=2,
                         help='the number of heads in the encoder/decoder of the transformer model')
+    parser.add_argument('--positions', type=str, default='absolute', choices=['absolute', 'rotary'],
+                        help='position information of the transformer: sinusoidal table or rotary embeddings')
+    parser.add_argument('--mem-len', type=int, default=0,
+                        help='attend to the last this many tokens of the previous batch, Transformer-XL style '
+                             '(needs --positions rotary). Validation and test carry the memory across disjoint '
+                             'windows too, unless --val-windows or --eval-stride picks sliding or sampled windows')
+    parser.add_argument('--checkpoint-every', type=int, default=0,
+                        help='recompute the activations of segments of this many transformer layers during backward '
+                             'to save memory (0 = keep all activations)')
+    parser.add_argument('--teacher', type=str, default='',
+                        help='distill this trained model checkpoint into the model being trained')
+    parser.add_argument('--distill-alpha', type=float, default=0.5,
+                        help='weight of the teacher\'s soft targets in the loss, the rest goes to the true words')
+    parser.add_argument('--distill-temperature', type=float, default=2.0,
+                        help='temperature softening the teacher and student distributions')
+    parser.add_argument('--teacher-topk', type=int, default=0,
+                        help='keep only the teacher\'s k most likely words per token (0 = whole vocabulary)')
+    parser.add_argument('--teacher-cache', type=str, default='',
+                        help='file with the top-k teacher predictions for the training data, '
+                             'computed on first use and memory-mapped afterwards, rebuilt for another teacher or context '
+                             '(needs --teacher-topk)')
+    parser.add_argument('--teacher-context', type=int, default=0,
+                        help='context length of the cached teacher predictions (0 = bptt)')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='intra-op CPU threads (0 = the --thread-config or PyTorch default)')
+    parser.add_argument('--interop-threads', type=int, default=0,
+                        help='inter-op CPU threads (0 = the --thread-config or PyTorch default)')
+    parser.add_argument('--pin-cores', action='store_true',
+                        help='bind every process to its own block of cores, e.g. the ranks of torchrun')
+    parser.add_argument('--thread-config', type=str, default='',
+                        help='JSON file of tuned thread configs, see cpu_threads.py')
+    parser.add_argument('--autotune-threads', action='store_true',
+                        help='benchmark thread configs for this model and batch shape before training, unless '
+                             '--thread-config (default: threads.json) already has one')
     parser.add_argument('--dry-run', action='store_true',
                         help='verify the code and the model')
     parser.add_argument('--report-dir', type=str, default='',
                         help='save training reports to this directory')
-    args = parser.parse_args()
+    parser.add_argument('--eval-context', type=int, default=0,
+                        help='context length of the evaluation windows (0 = bptt)')
+    parser.add_argument('--eval-stride', type=int, default=0,
+                        help='stride of the exact sliding-window evaluation (0 = half the context for '
+                             'Transformers, the full context for RNNs and --mem-len models, which then carry their '
+                             'hidden state or memory)')
+    parser.add_argument('--val-mode', type=str, default='approx', choices=['approx', 'exact'],
+                        help='per-epoch validation: disjoint windows (approx) or sliding windows (exact)')
+    parser.add_argument('--val-windows', type=int, default=0,
+                        help='score only this many evenly spaced windows in approx validation (0 = all)')
+    parser.add_argument('--test-mode', type=str, default='exact', choices=['approx', 'exact'],
+                        help='final test evaluation: disjoint windows (approx) or sliding windows (exact)')
+    parser.add_argument('--eval-batch-size', type=int, default=10,
+                        help='number of windows evaluated together (RNNs on disjoint windows: number of streams '
+                             'that carry their hidden state, as in the bptt evaluation)')
+    parser.add_argument('--eval-workers', type=int, default=0,
+                        help='evaluate in this many CPU worker processes (0 = in the training process)')
+    parser.add_argument('--eval-threads', type=int, default=0,
+                        help='intra-op threads of every evaluation worker (0 = the training threads divided among '
+                             'the workers, half of them with --overlap-eval)')
+    parser.add_argument('--overlap-eval', action='store_true',
+                        help='validate each epoch in the workers while the next epoch trains, training keeps the '
+                             'threads that the workers don\'t use')
+    args = parser.parse_args(argv)
+
+    if args.bptt < 1:
+        parser.error("--bptt has to be greater or equal 1.")
+    if args.bptt_warmup and not 1 <= args.bptt_min <= args.bptt:
+        parser.error("--bptt-min has to be in [1, --bptt].")
+    if args.eval_context < 0:
+        parser.error("--eval-context has to be greater or equal 0.")
+    if not 0 <= args.eval_stride <= (args.eval_context or args.bptt):
+        parser.error("--eval-stride has to be in [0, --eval-context] (--bptt if 0).")
+    if args.eval_threads < 0:
+        parser.error("--eval-threads has to be greater or equal 0.")
+    if args.overlap_eval and args.eval_workers < 1:
+        parser.error("--overlap-eval needs --eval-workers of at least 1.")
+    if args.accum_steps < 1:
+        parser.error("--accum-steps has to be greater or equal 1.")
+    if args.sparse_embedding and args.tied:
+        parser.error("--sparse-embedding can't be used with --tied, the decoder needs dense gradients.")
+    if args.mem_len and args.positions != 'rotary':
+        parser.error("--mem-len needs --positions rotary.")
+    if not 0 <= args.distill_alpha <= 1:
+        parser.error("--distill-alpha has to be in [0, 1].")
+    if args.teacher_cache and not (args.teacher and args.teacher_topk):
+        parser.error("--teacher-cache needs --teacher and --teacher-topk.")
+    if args.autotune_threads and int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        parser.error("--autotune-threads can't run under torchrun, tune with cpu_threads.py first.")
+
     return args
 
 
@@ -81,15 +204,10 @@ def get_device(args):
     return device
 
 
-args = get_args()
-device = get_device(args)
-
 ###############################################################################
 # Load data
 ###############################################################################
 
-corpus = data.Corpus(args.data)
-
 # Starting from sequential data, batchify arranges the dataset into columns.
 # For instance, with the alphabet as the sequence and batch size 4, we'd get
 # ┌ a g m s ┐
@@ -102,7 +220,7 @@ corpus = data.Corpus(args.data)
 # dependence of e. g. 'g' on 'f' can not be learned, but allows more efficient
 # batch processing.
 
-def batchify(data, bsz):
+def batchify(data, bsz, device):
     # Work out how cleanly we can divide the dataset into bsz parts.
     nbatch = data.size(0) // bsz
     # Trim off any extra elements that wouldn't cleanly fit (remainders).
@@ -111,179 +229,10 @@ def batchify(data, bsz):
     data = data.view(bsz, -1).t().contiguous()
     return data.to(device)
 
-eval_batch_size = 10
-train_data = batchify(corpus.train, args.batch_size)
-val_data = batchify(corpus.valid, eval_batch_size)
-test_data = batchify(corpus.test, eval_batch_size)
-
-###############################################################################
-# Build the model
-###############################################################################
-
-ntokens = len(corpus.dictionary)
-if args.model == 'Transformer':
-    model = TransformerModel(ntokens, args.emsize, args.nhead, args.nhid, args.nlayers, args.dropout).to(device)
-else:
-    model = RNNModel(args.model, ntokens, args.emsize, args.nhid, args.nlayers, args.dropout, args.tied).to(device)
-
-criterion = nn.NLLLoss()
-
-###############################################################################
-# Training code
-###############################################################################
-
-def repackage_hidden(h):
-    """Wraps hidden states in new Tensors, to detach them from their history."""
-
-    if isinstance(h, torch.Tensor):
-        return h.detach()
-    else:
-        return tuple(repackage_hidden(v) for v in h)
-
-
-def get_batch(source, i):
-    # get_batch subdivides the source data into chunks of length args.bptt.
-    # If source is equal to the example output of the batchify function, with
-    # a bptt-limit of 2, we'd get the following two Variables for i = 0:
-    # ┌ a g m s ┐ ┌ b h n t ┐
-    # └ b h n t ┘ └ c i o u ┘
-    # Note that despite the name of the function, the subdivison of data is not
-    # done along the batch dimension (i.e. dimension 1), since that was handled
-    # by the batchify function. The chunks are along dimension 0, corresponding
-    # to the seq_len dimension in the LSTM.
-    seq_len = min(args.bptt, len(source) - 1 - i)
-    data = source[i:i+seq_len]
-    target = source[i+1:i+1+seq_len].view(-1)
-    return data, target
-
-
-def evaluate(data_source):
-    # Turn on evaluation mode which disables dropout.
-    model.eval()
-    total_loss = 0.
-    ntokens = len(corpus.dictionary)
-    if args.model != 'Transformer':
-        hidden = model.init_hidden(eval_batch_size)
-    with torch.no_grad():
-        for i in range(0, data_source.size(0) - 1, args.bptt):
-            data, targets = get_batch(data_source, i)
-            if args.model == 'Transformer':
-                output = model(data)
-                output = output.view(-1, ntokens)
-            else:
-                output, hidden = model(data, hidden)
-                hidden = repackage_hidden(hidden)
-            total_loss += len(data) * criterion(output, targets).item()
-    return total_loss / (len(data_source) - 1)
-
-
-lr = args.lr
-epoch = 0
-
-
-def train():
-    # Turn on training mode which enables dropout.
-    global model
-
-    model.train()
-    total_loss = 0.
-    start_time = time.time()
-    ntokens = len(corpus.dictionary)
-    if args.model != 'Transformer':
-        hidden = model.init_hidden(args.batch_size)
-    for batch, i in enumerate(range(0, train_data.size(0) - 1, args.bptt)):
-        data, targets = get_batch(train_data, i)
-        # Starting each batch, we detach the hidden state from how it was previously produced.
-        # If we didn't, the model would try backpropagating all the way to start of the dataset.
-        model.zero_grad()
-        if args.model == 'Transformer':
-            output = model(data)
-            output = output.view(-1, ntokens)
-        else:
-            hidden = repackage_hidden(hidden)
-            output, hidden = model(data, hidden)
-        loss = criterion(output, targets)
-        loss.backward()
-
-        # `clip_grad_norm` helps prevent the exploding gradient problem in RNNs / LSTMs.
-        torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
-        for p in model.parameters():
-            p.data.add_(p.grad, alpha=-lr)
-
-        total_loss += loss.item()
-
-        if batch % args.log_interval == 0 and batch > 0:
-            cur_loss = total_loss / args.log_interval
-            elapsed = time.time() - start_time
-            print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.2f} | ms/batch {:5.2f} | '
-                    'loss {:5.2f} | ppl {:8.2f}'.format(
-                epoch, batch, len(train_data) // args.bptt, lr,
-                elapsed * 1000 / args.log_interval, cur_loss, math.exp(cur_loss)))
-            total_loss = 0
-            start_time = time.time()
-        if args.dry_run:
-            break
-
-
-def export_onnx(path, batch_size, seq_len):
-    print('The model is also exported in ONNX format at {}.'.format(os.path.realpath(args.onnx_export)))
-    model.eval()
-    dummy_input = torch.LongTensor(seq_len * batch_size).zero_().view(-1, batch_size).to(device)
-    hidden = model.init_hidden(batch_size)
-    torch.onnx.export(model, (dummy_input, hidden), path)
-
-
-best_val_loss = None
-
-
-def main():
-    global best_val_loss
-    global epoch
-    global model
-    global lr
-    # Loop over epochs.
-
-    # Record val loss along with each epoch.
-    loss_records = []
-
-    # At any point you can hit Ctrl + C to break out of training early.
-    try:
-        train_start_time = time.time()
-        for epoch in range(1, args.epochs+1):
-            epoch_start_time = time.time()
-            train()
-            val_loss = evaluate(val_data)
-
-            now = time.time()
-            ppl = math.exp(val_loss)
-            loss_records.append({
-                'epoch': epoch,
-                'time': now - train_start_time,
-                'lr': lr,
-                'val_loss': val_loss,
-                'ppl': ppl,
-            })
-
-            print('-' * 89)
-            print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f} | '
-                    'valid ppl {:8.2f}'.format(epoch, (now - epoch_start_time),
-                                            val_loss, ppl))
-            print('-' * 89)
-            # Save the model if the validation loss is the best we've seen so far.
-            if not best_val_loss or val_loss < best_val_loss:
-                with open(args.save, 'wb') as f:
-                    torch.save(model, f)
-                best_val_loss = val_loss
-            else:
-                # Anneal the learning rate if no improvement has been seen in the validation dataset.
-                lr /= 4.0
-    except KeyboardInterrupt:
-        print('-' * 89)
-        print('Exiting from training early')
 
-    # Load the best saved model.
-    with open(args.save, 'rb') as f:
-        if args.model == 'Transformer':
+def load_model(path, model_type, device):
+    with open(path, 'rb') as f:
+        if model_type == 'Transformer':
             safe_globals = [
                 PositionalEncoding,
                 TransformerModel,
@@ -309,38 +258,578 @@ def main():
                 torch.nn.modules.sparse.Embedding,
             ]
         with torch.serialization.safe_globals(safe_globals):
-            model = torch.load(f)
+            model = torch.load(f, map_location=device)
         # after load the rnn params are not a continuous chunk of memory
         # this makes them a continuous chunk, and will speed up forward pass
         # Currently, only rnn model supports flatten_parameters function.
-        if args.model in ['RNN_TANH', 'RNN_RELU', 'LSTM', 'GRU']:
+        if model_type in ['RNN_TANH', 'RNN_RELU', 'LSTM', 'GRU']:
             model.rnn.flatten_parameters()
+    return model
+
+
+def repackage_hidden(h):
+    """Wraps hidden states in new Tensors, to detach them from their history."""
+
+    if isinstance(h, torch.Tensor):
+        return h.detach()
+    else:
+        return tuple(repackage_hidden(v) for v in h)
+
 
-    # Run on test data.
-    test_loss = evaluate(test_data)
-    print('=' * 89)
-    print('| End of training | test loss {:5.2f} | test ppl {:8.2f}'.format(
-        test_loss, math.exp(test_loss)))
-    print('=' * 89)
-
-    if len(args.onnx_export) > 0:
-        # Export the model in ONNX format.
-        export_onnx(args.onnx_export, batch_size=1, seq_len=args.bptt)
-
-    if args.report_dir != '' and not os.path.exists(args.report_dir):
-        # Save the training report.
-        os.makedirs(args.report_dir)
-        report_fpath = os.path.join(args.report_dir, 'report.json')
-        reports = {
-            'start_time': train_start_time,
-            'end_time': time.time(),
-            'args': vars(args),
-            'records': loss_records
+class Trainer(object):
+    """Trains, tests and reports one language model as configured by `args`, see get_args.
+
+    Importing this module does no work, everything happens in the Trainer, so
+    sweeps, tests and benchmarks can run it in-process and share one loaded
+    corpus between runs:
+
+        >>> corpus = data.load_corpus('../data/wikitext-2')
+        >>> for lr in [5, 20]:
+        ...     trainer = Trainer(get_args(['--epochs', '2', '--lr', str(lr)]), corpus)
+        ...     result = trainer.fit()
+
+    When launched with torchrun (e.g. torchrun --nproc_per_node 4 main.py), every
+    process trains on its own shard of the training data and the gradients are
+    averaged across processes before every update.
+    """
+
+    def __init__(self, args, corpus=None):
+        self.args = args
+        self.device = get_device(args)
+
+        self.world_size = int(os.environ.get('WORLD_SIZE', 1))
+        self.rank = int(os.environ.get('RANK', 0))
+        self.distributed = self.world_size > 1
+        if self.distributed:
+            import torch.distributed as dist
+            self.dist = dist
+            dist.init_process_group('nccl' if args.cuda else 'gloo')
+            if args.cuda:
+                self.device = torch.device('cuda', int(os.environ['LOCAL_RANK']))
+                torch.cuda.set_device(self.device)
+            if self.rank != 0:
+                # Only the first process reports, the others train silently.
+                sys.stdout = open(os.devnull, 'w')
+
+        self.corpus = corpus if corpus is not None else data.load_corpus(args.data, args.corpus_cache)
+        train_tokens = self.corpus.train
+        if self.distributed:
+            # Equal shards, so that all processes run the same number of batches.
+            shard_size = train_tokens.size(0) // self.world_size
+            train_tokens = train_tokens.narrow(0, self.rank * shard_size, shard_size)
+        self.train_data = batchify(train_tokens, args.batch_size, self.device)
+        # Evaluation slides windows over the flat token streams, see evaluation.py.
+        self.val_data = self.corpus.valid.to(self.device)
+        self.test_data = self.corpus.test.to(self.device)
+
+        self.build_model()
+        self.criterion = nn.NLLLoss()
+        self.teacher = None
+        self.teacher_cache = None
+        if args.teacher:
+            self.load_teacher()
+        self.optimizer = optimization.build_optimizer(
+            args.optimizer, self.model.parameters(), args.lr, args.weight_decay, args.momentum,
+            sparse_params=[self.embedding.weight] if self.embedding.sparse else [])
+        total_steps = sum(math.ceil(len(self.epoch_batches(self.train_data.size(0), epoch)) / args.accum_steps)
+                          for epoch in range(1, args.epochs + 1))
+        self.scheduler = optimization.LRScheduler(self.optimizer, args.schedule, args.warmup_steps, total_steps)
+        self.start_epoch = 1
+        self.best_val_loss = None
+        self.tokens_trained = 0
+        if args.resume:
+            training_state = torch.load(optimization.training_state_path(args.resume), map_location=self.device)
+            self.optimizer.load_state_dict(training_state['optimizer'])
+            self.scheduler.load_state_dict(training_state['scheduler'])
+            self.start_epoch = training_state['epoch'] + 1
+            self.best_val_loss = training_state['best_val_loss']
+            self.tokens_trained = training_state['tokens_trained']
+
+        # Only the first process evaluates, see sync_loss.
+        self.evaluator = None
+        if args.eval_workers > 0 and self.rank == 0:
+            eval_threads = args.eval_threads or None
+            if args.overlap_eval:
+                # The workers run next to the training, which gives up the threads they use.
+                eval_threads = args.eval_threads or max(1, torch.get_num_threads() // (2 * args.eval_workers))
+                torch.set_num_threads(max(1, torch.get_num_threads() - args.eval_workers * eval_threads))
+            self.evaluator = evaluation.ParallelEvaluator(args.eval_workers, eval_threads)
+
+        self.epoch = 0
+        self.train_start_time = None
+        # Why training ended, recorded in the report.
+        self.stop_reason = None
+        # Record val loss along with each epoch.
+        self.loss_records = []
+        # Number of epochs since the validation loss last improved, for --patience.
+        self.bad_epochs = 0
+
+    ###########################################################################
+    # Build the model
+    ###########################################################################
+
+    def build_model(self):
+        args = self.args
+        ntokens = len(self.corpus.dictionary)
+        if args.model == 'Transformer':
+            model = TransformerModel(ntokens, args.emsize, args.nhead, args.nhid, args.nlayers, args.dropout,
+                                     args.positions, args.mem_len).to(self.device)
+            # Lets evaluate() run the encoder through PyTorch's fused inference kernels.
+            model.enable_fastpath()
+        else:
+            model = RNNModel(args.model, ntokens, args.emsize, args.nhid, args.nlayers, args.dropout,
+                             args.tied).to(self.device)
+        if args.resume:
+            model = load_model(args.resume, args.model, self.device)
+        if args.model == 'Transformer':
+            model.set_checkpointing(args.checkpoint_every)
+        self.embedding = model.input_emb if args.model == 'Transformer' else model.encoder
+        if args.sparse_embedding:
+            # A batch only touches a few hundred of the vocabulary rows, the gradient holds just those.
+            self.embedding.sparse = True
+
+        self.model = model
+        self.train_model = model
+        if self.distributed:
+            # DistributedDataParallel all-reduces the gradients in buckets of --bucket-mb
+            # while backward() is still computing the gradients of earlier layers.
+            # The only buffer is the constant positional encoding table, which doesn't need broadcasting.
+            self.train_model = nn.parallel.DistributedDataParallel(
+                model, bucket_cap_mb=args.bucket_mb, gradient_as_bucket_view=True, broadcast_buffers=False)
+
+    def load_teacher(self):
+        """Loads the frozen --teacher and, with --teacher-cache, its predictions for the training data."""
+        from generate import get_model
+        args = self.args
+        self.teacher = get_model(args.teacher, self.device)
+        for param in self.teacher.parameters():
+            param.requires_grad_(False)
+        if self.teacher.decoder.out_features != len(self.corpus.dictionary):
+            raise ValueError('The teacher {} was trained with another vocabulary'.format(args.teacher))
+        if not args.teacher_cache:
+            return
+        path = args.teacher_cache
+        if self.distributed:
+            # Every process trains on its own shard and caches the predictions for it.
+            base, ext = os.path.splitext(path)
+            path = '{}.rank{}{}'.format(base, self.rank, ext)
+        context_len = args.teacher_context or args.bptt
+        stride = max(1, context_len // 2)
+        identity = data.checkpoint_identity(args.teacher)
+        # The rows of the cache follow the batchified training shard of this process.
+        data_identity = dict(data.corpus_identity(args.data), batch_size=args.batch_size,
+                             rank=self.rank, world_size=self.world_size)
+        self.teacher_cache = distillation.load_teacher_cache(path, self.train_data, context_len, stride,
+                                                             args.teacher_topk, identity, data_identity)
+        if self.teacher_cache is None:
+            print('| caching the top {} teacher predictions to {}'.format(args.teacher_topk, path))
+            distillation.build_teacher_cache(self.teacher, self.train_data, context_len, stride,
+                                             args.teacher_topk, path, identity, data_identity)
+            self.teacher_cache = distillation.load_teacher_cache(path, self.train_data, context_len, stride,
+                                                                 args.teacher_topk, identity, data_identity)
+
+    def soft_targets(self, data, i):
+        # The teacher's predictions for the batch starting at row i of train_data.
+        if self.teacher_cache is None:
+            return distillation.soft_targets(self.teacher, data, self.args.teacher_topk)
+        indices, log_probs = self.teacher_cache
+        rows = slice(i, i + data.size(0))
+        return (indices[rows].reshape(data.numel(), -1).to(self.device),
+                log_probs[rows].reshape(data.numel(), -1).to(self.device))
+
+    ###########################################################################
+    # Training code
+    ###########################################################################
+
+    def epoch_batches(self, num_tokens, epoch):
+        """Returns the (start, sequence length) of every training batch of `epoch`.
+
+        Without --bptt-warmup and --variable-bptt all batches are args.bptt long. The
+        warmup starts with short sequences, which are cheap for the transformer's
+        attention, and reaches args.bptt after args.bptt_warmup epochs. With
+        --variable-bptt every length is drawn from N(base, 5), where base is the
+        current length or, with probability 0.05, half of it (Merity et al. 2017,
+        https://arxiv.org/abs/1708.02182). The draws are seeded by the epoch, so all
+        processes of a distributed run cut the same batches.
+        """
+        args = self.args
+        rng = random.Random(args.seed * 1000 + epoch)
+        batches = []
+        i = 0
+        while i < num_tokens - 1:
+            seq_len = args.bptt
+            if args.bptt_warmup:
+                progress = min(1., (epoch - 1 + i / num_tokens) / args.bptt_warmup)
+                seq_len = round(args.bptt_min + (args.bptt - args.bptt_min) * progress)
+            if args.variable_bptt:
+                base = seq_len if rng.random() < 0.95 else seq_len / 2
+                seq_len = max(5, int(rng.gauss(base, 5)))
+            seq_len = min(seq_len, num_tokens - 1 - i)
+            batches.append((i, seq_len))
+            i += seq_len
+        return batches
+
+    def get_batch(self, source, i, seq_len=None):
+        # get_batch subdivides the source data into chunks of length args.bptt
+        # (or seq_len, see epoch_batches).
+        # If source is equal to the example output of the batchify function, with
+        # a bptt-limit of 2, we'd get the following two Variables for i = 0:
+        # ┌ a g m s ┐ ┌ b h n t ┐
+        # └ b h n t ┘ └ c i o u ┘
+        # Note that despite the name of the function, the subdivison of data is not
+        # done along the batch dimension (i.e. dimension 1), since that was handled
+        # by the batchify function. The chunks are along dimension 0, corresponding
+        # to the seq_len dimension in the LSTM.
+        seq_len = min(seq_len or self.args.bptt, len(source) - 1 - i)
+        data = source[i:i+seq_len]
+        target = source[i+1:i+1+seq_len].view(-1)
+        return data, target
+
+    def eval_settings(self, mode):
+        # The approx mode scores disjoint windows (optionally only a subset of them),
+        # which is cheap enough to run after every epoch. The exact mode slides
+        # overlapping windows so that every token is scored with a long context.
+        # RNNs and memory Transformers default to disjoint windows there too: those
+        # carry the hidden state or memory across the whole stream, as in training.
+        args = self.args
+        context_len = args.eval_context or args.bptt
+        if mode == 'exact':
+            if args.eval_stride:
+                return context_len, args.eval_stride, None
+            if args.model != 'Transformer' or args.mem_len:
+                return context_len, context_len, None
+            return context_len, max(1, context_len // 2), None
+        return context_len, context_len, args.val_windows or None
+
+    def submit_evaluate(self, data_source, mode='approx'):
+        # Evaluates a snapshot of the current weights in the worker processes, see
+        # evaluation.ParallelEvaluator. Returns a PendingLoss.
+        context_len, stride, max_windows = self.eval_settings(mode)
+        return self.evaluator.submit(self.model, data_source, context_len, stride, self.args.eval_batch_size,
+                                     max_windows)
+
+    def evaluate(self, data_source, mode='approx'):
+        if self.evaluator is not None:
+            return self.submit_evaluate(data_source, mode).result()
+        context_len, stride, max_windows = self.eval_settings(mode)
+        return evaluation.sliding_window_loss(self.model, data_source, context_len, stride,
+                                              self.args.eval_batch_size, max_windows)
+
+    def budget_exhausted(self):
+        """Returns 'time_budget' or 'token_budget' once --max-time or --max-tokens is used up, else None."""
+        args = self.args
+        if args.max_tokens and self.tokens_trained >= args.max_tokens:
+            return 'token_budget'
+        if args.max_time:
+            out_of_time = time.time() - self.train_start_time >= args.max_time * 60
+            if self.distributed:
+                # The clocks of the processes differ a little, all of them follow the first one.
+                out_of_time = torch.tensor([out_of_time], dtype=torch.uint8, device=self.device)
+                self.dist.broadcast(out_of_time, 0)
+                out_of_time = bool(out_of_time.item())
+            if out_of_time:
+                return 'time_budget'
+        return None
+
+    def train(self):
+        args = self.args
+        model = self.model
+        embedding = self.embedding
+        optimizer = self.optimizer
+        scheduler = self.scheduler
+        # Turn on training mode which enables dropout.
+        model.train()
+        total_loss = 0.
+        start_time = time.time()
+        ntokens = len(self.corpus.dictionary)
+        if args.model != 'Transformer':
+            hidden = model.init_hidden(args.batch_size)
+        elif args.mem_len:
+            mems = model.init_mems()
+        batches = self.epoch_batches(self.train_data.size(0), self.epoch)
+        # Shorter sequences average the loss over fewer tokens, their updates get a proportionally smaller lr.
+        scale_lr = args.bptt_warmup or args.variable_bptt
+        for batch, (i, seq_len) in enumerate(batches):
+            data, targets = self.get_batch(self.train_data, i, seq_len)
+            # The gradients of args.accum_steps consecutive batches are summed before
+            # every update, the last update of the epoch may cover fewer batches.
+            step_start = batch - batch % args.accum_steps
+            step_size = min(args.accum_steps, len(batches) - step_start)
+            last_of_step = batch == step_start + step_size - 1
+            if batch == step_start:
+                optimizer.zero_grad()
+            # Between updates the gradients only accumulate locally, they are all-reduced
+            # during the backward pass of the last batch.
+            with contextlib.nullcontext() if last_of_step or not self.distributed else self.train_model.no_sync():
+                if args.model == 'Transformer' and args.mem_len:
+                    # The memory of the previous batch is carried over, detached like the RNN hidden state.
+                    output, mems = self.train_model(data, mems=mems)
+                    output = output.view(-1, ntokens)
+                elif args.model == 'Transformer':
+                    output = self.train_model(data)
+                    output = output.view(-1, ntokens)
+                else:
+                    # Starting each batch, we detach the hidden state from how it was previously produced.
+                    # If we didn't, the model would try backpropagating all the way to start of the dataset.
+                    hidden = repackage_hidden(hidden)
+                    output, hidden = self.train_model(data, hidden)
+                loss = self.criterion(output, targets)
+                train_loss = loss
+                if self.teacher is not None:
+                    indices, teacher_log_probs = self.soft_targets(data, i)
+                    train_loss = distillation.distillation_loss(output, loss, indices, teacher_log_probs,
+                                                                args.distill_alpha, args.distill_temperature)
+                (train_loss / step_size).backward()
+
+            if last_of_step:
+                if embedding.sparse and embedding.weight.grad is not None:
+                    # Sum the rows of repeated tokens once, for both the clipping and the update.
+                    embedding.weight.grad = embedding.weight.grad.coalesce()
+                # `clip_grad_norm` helps prevent the exploding gradient problem in RNNs / LSTMs.
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+                step_lengths = [length for _, length in batches[step_start:step_start + step_size]]
+                scheduler.step(sum(step_lengths) / (step_size * args.bptt) if scale_lr else 1.)
+                optimizer.step()
+
+            total_loss += loss.item()
+            self.tokens_trained += data.numel() * self.world_size
+
+            if batch % args.log_interval == 0 and batch > 0:
+                cur_loss = total_loss / args.log_interval
+                elapsed = time.time() - start_time
+                print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:.3g} | ms/batch {:5.2f} | '
+                        'loss {:5.2f} | ppl {:8.2f}'.format(
+                    self.epoch, batch, len(batches), scheduler.get_lr(),
+                    elapsed * 1000 / args.log_interval, cur_loss, math.exp(cur_loss)))
+                total_loss = 0
+                start_time = time.time()
+            if args.dry_run and last_of_step:
+                break
+            if last_of_step:
+                # Budgets are checked after updates, so no gradients are thrown away.
+                self.stop_reason = self.budget_exhausted()
+                if self.stop_reason:
+                    print('| {} used up after {} tokens, stopping in the middle of epoch {}'.format(
+                        self.stop_reason.replace('_', ' '), self.tokens_trained, self.epoch))
+                    break
+
+    def export_onnx(self, path, batch_size, seq_len):
+        # Only needed for --onnx-export, the exporters take a while to import.
+        import torch.onnx
+
+        # The sequence length and batch size are dynamic axes of the exported model.
+        # Keep the example batch size above 1, the exporters specialize size-1 dims.
+        print('The model is also exported in ONNX format at {}.'.format(os.path.realpath(path)))
+        model = self.model
+        model.eval()
+        dummy_input = torch.LongTensor(seq_len * batch_size).zero_().view(-1, batch_size).to(self.device)
+        if self.args.model == 'Transformer':
+            # The fused encoder kernel has no ONNX counterpart, export the plain encoder layers.
+            export_model = copy.deepcopy(model).disable_fastpath()
+            dim = torch.export.Dim.DYNAMIC
+            torch.onnx.export(export_model, (dummy_input,), path,
+                              input_names=['input'], output_names=['output'],
+                              dynamic_shapes=({0: dim, 1: dim},), dynamo=True)
+        else:
+            # torch.export unrolls RNNs over the example length, the TorchScript exporter
+            # maps them to the ONNX RNN/GRU/LSTM ops that take any sequence length.
+            hidden = model.init_hidden(batch_size)
+            hidden_names = ['h0', 'c0'] if self.args.model == 'LSTM' else ['h0']
+            output_hidden_names = ['hn', 'cn'] if self.args.model == 'LSTM' else ['hn']
+            dynamic_axes = {'input': {0: 'seq_len', 1: 'batch'}, 'output': {0: 'tokens'}}
+            for name in hidden_names + output_hidden_names:
+                dynamic_axes[name] = {1: 'batch'}
+            torch.onnx.export(model, (dummy_input, hidden), path,
+                              input_names=['input'] + hidden_names, output_names=['output'] + output_hidden_names,
+                              dynamic_axes=dynamic_axes, dynamo=False)
+
+    def sync_loss(self, loss):
+        # Only the first process validates, the others take over its loss so that
+        # all of them anneal the learning rate at the same epochs.
+        if not self.distributed:
+            return loss
+        loss = torch.tensor([loss if self.rank == 0 else 0.], dtype=torch.float64, device=self.device)
+        self.dist.broadcast(loss, 0)
+        return loss.item()
+
+    def end_of_epoch(self, epoch, epoch_time, val_loss, epoch_model, training_state):
+        args = self.args
+        now = time.time()
+        ppl = math.exp(val_loss)
+        self.loss_records.append({
+            'epoch': epoch,
+            'time': now - self.train_start_time,
+            'tokens': training_state['tokens_trained'],
+            'lr': self.scheduler.get_lr(),
+            'val_loss': val_loss,
+            'ppl': ppl,
+        })
+
+        print('-' * 89)
+        print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f} | '
+                'valid ppl {:8.2f}'.format(epoch, epoch_time,
+                                        val_loss, ppl))
+        print('-' * 89)
+        # Save the model if the validation loss is the best we've seen so far.
+        if not self.best_val_loss or val_loss < self.best_val_loss:
+            self.best_val_loss = val_loss
+            self.bad_epochs = 0
+            if self.rank == 0:
+                with open(args.save, 'wb') as f:
+                    torch.save(epoch_model, f)
+                # Everything needed to continue training from this checkpoint with --resume.
+                training_state = dict(training_state, epoch=epoch, best_val_loss=self.best_val_loss)
+                torch.save(training_state, optimization.training_state_path(args.save))
+        else:
+            self.bad_epochs += 1
+            self.scheduler.plateau()
+
+    def fit(self):
+        """Trains until a stop condition, then tests the best checkpoint and writes the report.
+
+        Returns a dict with the test loss, the best validation loss, the stop reason,
+        the number of training tokens and the per-epoch records, or None on the
+        processes other than the first one of a distributed run.
+        """
+        args = self.args
+        # Loop over epochs.
+
+        # generate.py only needs the vocabulary, save it so it doesn't have to load the corpus.
+        if self.rank == 0:
+            self.corpus.dictionary.save(data.vocab_path(args.save))
+        print('| effective batch size {} sequences of {} tokens ({} processes x {} batches x {})'.format(
+            self.world_size * args.accum_steps * args.batch_size, args.bptt, self.world_size, args.accum_steps,
+            args.batch_size))
+
+        # At any point you can hit Ctrl + C to break out of training early.
+        try:
+            self.train_start_time = time.time()
+            # With --overlap-eval, epoch N is validated while epoch N+1 trains, so a
+            # learning rate annealing decision takes effect one epoch later.
+            pending = None
+            for self.epoch in range(self.start_epoch, args.epochs+1):
+                epoch_start_time = time.time()
+                self.train()
+                training_state = {'optimizer': self.optimizer.state_dict(),
+                                  'scheduler': self.scheduler.state_dict(),
+                                  'tokens_trained': self.tokens_trained}
+                if not args.overlap_eval:
+                    val_loss = self.sync_loss(self.evaluate(self.val_data, args.val_mode) if self.rank == 0 else None)
+                    self.end_of_epoch(self.epoch, time.time() - epoch_start_time, val_loss, self.model,
+                                      training_state)
+                else:
+                    if pending is not None:
+                        pending_epoch, pending_time, pending_loss, pending_state = pending
+                        val_loss = self.sync_loss(pending_loss.result() if self.rank == 0 else None)
+                        self.end_of_epoch(pending_epoch, pending_time, val_loss,
+                                          pending_loss and pending_loss.snapshot, pending_state)
+                    # The optimizer state has to match the evaluated snapshot, not the weights of the next epoch.
+                    pending = (self.epoch, time.time() - epoch_start_time,
+                               self.submit_evaluate(self.val_data, args.val_mode) if self.rank == 0 else None,
+                               copy.deepcopy(training_state) if self.rank == 0 else training_state)
+                if args.patience and self.bad_epochs >= args.patience:
+                    self.stop_reason = 'early_stopping'
+                    print('| no improvement in {} epochs, stopping early'.format(self.bad_epochs))
+                if self.stop_reason:
+                    break
+            else:
+                self.stop_reason = 'max_epochs'
+            if pending is not None:
+                pending_epoch, pending_time, pending_loss, pending_state = pending
+                val_loss = self.sync_loss(pending_loss.result() if self.rank == 0 else None)
+                self.end_of_epoch(pending_epoch, pending_time, val_loss, pending_loss and pending_loss.snapshot,
+                                  pending_state)
+        except KeyboardInterrupt:
+            print('-' * 89)
+            print('Exiting from training early')
+            self.stop_reason = 'interrupted'
+
+        if self.distributed:
+            # The first process tests, exports and reports the best model on its own.
+            self.dist.destroy_process_group()
+            if self.rank != 0:
+                return None
+
+        # Load the best saved model.
+        self.model = load_model(args.save, args.model, self.device)
+
+        # Run on test data.
+        test_loss = self.evaluate(self.test_data, args.test_mode)
+        if self.evaluator is not None:
+            self.evaluator.shutdown()
+        print('=' * 89)
+        print('| End of training | test loss {:5.2f} | test ppl {:8.2f}'.format(
+            test_loss, math.exp(test_loss)))
+        print('=' * 89)
+
+        if len(args.onnx_export) > 0:
+            # Export the model in ONNX format.
+            self.export_onnx(args.onnx_export, batch_size=2, seq_len=args.bptt)
+            self.corpus.dictionary.save(data.vocab_path(args.onnx_export))
+
+        if args.report_dir != '' and not os.path.exists(args.report_dir):
+            # Save the training report.
+            os.makedirs(args.report_dir)
+            report_fpath = os.path.join(args.report_dir, 'report.json')
+            reports = {
+                'start_time': self.train_start_time,
+                'end_time': time.time(),
+                'args': vars(args),
+                'stop_reason': self.stop_reason,
+                'tokens_trained': self.tokens_trained,
+                'records': self.loss_records
+            }
+            with open(report_fpath, 'w') as f:
+                json.dump(reports, f, indent=4)
+            print(f'Training report saved to {report_fpath}')
+
+        return {
+            'test_loss': test_loss,
+            'best_val_loss': self.best_val_loss,
+            'stop_reason': self.stop_reason,
+            'tokens_trained': self.tokens_trained,
+            'records': self.loss_records,
         }
-        with open(report_fpath, 'w') as f:
-            json.dump(reports, f, indent=4)
-        print(f'Training report saved to {report_fpath}')
+
+
+def configure_threads(args, ntokens):
+    """Applies the tuned thread config of the training workload and the explicit thread options to this process."""
+    import cpu_threads
+    workload = cpu_threads.make_workload(args.model, ntokens, args.emsize, args.nhid, args.nlayers, args.nhead,
+                                         'train', args.batch_size, args.bptt, args.positions, args.mem_len,
+                                         args.checkpoint_every, args.sparse_embedding, args.accum_steps)
+    config = None
+    if args.thread_config or args.autotune_threads:
+        path = args.thread_config or 'threads.json'
+        config = cpu_threads.load_config(path, workload)
+        if config is None and args.autotune_threads:
+            print('| tuning the CPU threads')
+            config, results = cpu_threads.tune(workload, pin=args.pin_cores)
+            cpu_threads.save_config(path, workload, config, results)
+    config = dict(config or {})
+    if args.threads:
+        config['intra'] = args.threads
+    elif args.pin_cores and 'intra' not in config:
+        # Without a thread count, the processes of the host split its cores.
+        config['intra'] = max(1, len(cpu_threads.available_cores()) // int(os.environ.get('LOCAL_WORLD_SIZE', 1)))
+    if args.interop_threads:
+        config['inter'] = args.interop_threads
+    if args.pin_cores:
+        config['pin'] = True
+    if config:
+        cpu_threads.apply_config(config, int(os.environ.get('LOCAL_RANK', 0)))
+        if int(os.environ.get('RANK', 0)) == 0:
+            print('| {} intra-op threads | {} inter-op threads{}'.format(
+                torch.get_num_threads(), torch.get_num_interop_threads(), ' | pinned' if config.get('pin') else ''))
+
+
+def main(argv=None):
+    args = get_args(argv)
+    corpus = data.load_corpus(args.data, args.corpus_cache)
+    # The workload of the thread config needs the vocabulary size.
+    configure_threads(args, len(corpus.dictionary))
+    Trainer(args, corpus).fit()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
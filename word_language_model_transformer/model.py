@@ -2,6 +2,7 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 class RNNModel(nn.Module):
     """Container module with an encoder, a recurrent module, and a decoder."""
@@ -104,14 +105,48 @@ class PositionalEncoding(nn.Module):
         x = x + self.pe[:x.size(0), :]
         return self.dropout(x)
 
+def apply_rotary(x, positions):
+    r"""Rotates the queries or keys `x` of shape [..., sequence length, head dim] by their `positions`.
+
+    Rotary position embedding (Su et al. 2021, https://arxiv.org/abs/2104.09864):
+    pairs of features are rotated by angles proportional to the position, so the
+    dot product of a query and a key only depends on their distance and there is
+    no table that limits the sequence length.
+    """
+    half = x.size(-1) // 2
+    inv_freq = torch.exp(torch.arange(half, dtype=torch.float, device=x.device) * (-math.log(10000.0) / half))
+    angles = positions.float().unsqueeze(-1) * inv_freq
+    cos, sin = angles.cos().to(x.dtype), angles.sin().to(x.dtype)
+    x1, x2 = x[..., :half], x[..., half:]
+    return torch.cat([x1 * cos - x2 * sin, x1 * sin + x2 * cos], dim=-1)
+
 class TransformerModel(nn.Transformer):
-    """Container module with an encoder, a recurrent or transformer module, and a decoder."""
+    """Container module with an encoder, a recurrent or transformer module, and a decoder.
+
+    With positions='rotary' the attention uses rotary position embeddings instead
+    of adding the PositionalEncoding table, so the sequence length isn't capped.
+    mem_len > 0 (rotary only) adds a Transformer-XL style segment memory: the keys
+    and values of the last mem_len tokens of the previous segment are kept,
+    detached, and attended to by the next one, see forward(src, mems=...).
+    The evaluation in evaluation.py calls forward(src) without a memory, so its
+    losses only reflect the context within each evaluation window.
+    """
 
-    def __init__(self, ntoken, ninp, nhead, nhid, nlayers, dropout=0.5):
+    def __init__(self, ntoken, ninp, nhead, nhid, nlayers, dropout=0.5, positions='absolute', mem_len=0):
         super(TransformerModel, self).__init__(d_model=ninp, nhead=nhead, dim_feedforward=nhid, num_encoder_layers=nlayers)
+        if positions not in ['absolute', 'rotary']:
+            raise ValueError("Invalid positions '{}', options are ['absolute', 'rotary']".format(positions))
+        if mem_len and positions != 'rotary':
+            raise ValueError('The segment memory (mem_len > 0) needs rotary positions')
         self.model_type = 'Transformer'
         self.src_mask = None
-        self.pos_encoder = PositionalEncoding(ninp, dropout)
+        self.positions = positions
+        self.mem_len = mem_len
+        if positions == 'absolute':
+            self.pos_encoder = PositionalEncoding(ninp, dropout)
+        else:
+            self.pos_encoder = None
+            self.emb_dropout = nn.Dropout(dropout)
 
         self.input_emb = nn.Embedding(ntoken, ninp)
         self.ninp = ninp
@@ -122,23 +157,273 @@ class TransformerModel(nn.Transformer):
     def _generate_square_subsequent_mask(self, sz):
         return torch.log(torch.tril(torch.ones(sz,sz)))
 
+    def _generate_causal_mask(self, sz):
+        # Boolean variant used by the fast path, True marks a position that may not be attended.
+        return torch.triu(torch.ones(sz, sz, dtype=torch.bool), diagonal=1)
+
+    def enable_fastpath(self):
+        """Prepare the encoder for PyTorch's fused inference kernels.
+
+        The fused ``torch._transformer_encoder_layer_fwd`` kernel is only taken when
+        the encoder layers are batch first. This flips the layers to batch first;
+        ``forward`` keeps its [sequence length, batch size] interface and transposes
+        around the encoder. The kernel itself only engages in eval mode with autograd
+        disabled, so training is unaffected. Padded batches (src_key_padding_mask)
+        run through the same kernel with the padding merged into the causal mask.
+        PyTorch only converts them to nested tensors without an attention mask,
+        which a causal language model never runs, so the padding is still computed.
+        """
+        for layer in self.encoder.layers:
+            layer.self_attn.batch_first = True
+        self.encoder.use_nested_tensor = True
+        self.fastpath = True
+        self.src_mask = None
+        return self
+
+    def disable_fastpath(self):
+        """Undo enable_fastpath, e.g. before swapping the encoder layers for modules the fused kernel can't run."""
+        for layer in self.encoder.layers:
+            layer.self_attn.batch_first = False
+        self.encoder.use_nested_tensor = False
+        self.fastpath = False
+        self.src_mask = None
+        return self
+
+    def set_checkpointing(self, every=1):
+        """Recompute encoder activations during backward instead of keeping them.
+
+        The encoder layers are split into segments of `every` layers and only the
+        input of each segment is kept for backward; the activations inside a segment
+        are recomputed from it, at the cost of one more forward pass through the
+        layers. Longer segments keep fewer inputs, but hold the activations of a
+        whole segment while it is recomputed. 0 turns checkpointing off. Only
+        applies while training with autograd enabled.
+        """
+        self.checkpoint_every = every
+        return self
+
+    def _encode(self, src, mask, src_key_padding_mask, is_causal):
+        every = getattr(self, 'checkpoint_every', 0)
+        if not (every and self.training and torch.is_grad_enabled()):
+            return self.encoder(src, mask=mask, src_key_padding_mask=src_key_padding_mask, is_causal=is_causal)
+
+        layers = self.encoder.layers
+
+        def run_segment(x, start):
+            for layer in layers[start:start + every]:
+                x = layer(x, src_mask=mask, src_key_padding_mask=src_key_padding_mask, is_causal=bool(is_causal))
+            return x
+
+        # The dropout masks are replayed during recomputation, checkpoint() restores the RNG state.
+        for start in range(0, len(layers), every):
+            src = checkpoint(run_segment, src, start, use_reentrant=False)
+        if self.encoder.norm is not None:
+            src = self.encoder.norm(src)
+        return src
+
     def init_weights(self):
         initrange = 0.1
         nn.init.uniform_(self.input_emb.weight, -initrange, initrange)
         nn.init.zeros_(self.decoder.bias)
         nn.init.uniform_(self.decoder.weight, -initrange, initrange)
 
-    def forward(self, src, has_mask=True):
+    def init_mems(self):
+        """Returns the empty segment memory to start forward(src, mems=...) with, like RNNModel.init_hidden."""
+        return []
+
+    def _embed(self, src, offset=0):
+        x = self.input_emb(src) * math.sqrt(self.ninp)
+        if getattr(self, 'positions', 'absolute') == 'rotary':
+            return self.emb_dropout(x)
+        x = x + self.pos_encoder.pe[offset:offset + src.size(0)]
+        return self.pos_encoder.dropout(x)
+
+    def _attend(self, x, past=None, keep=None):
+        """Runs the embedded [sequence length, batch size, ninp] `x` through the encoder layers.
+
+        Every layer also attends to the keys and values in `past` (see
+        forward_with_cache). Returns the encoder output and the per-layer keys and
+        values of `past` extended by `x`, cut to the last `keep` positions if given.
+        Keys are kept before the rotary embedding, which is applied to the
+        concatenated keys here, so the positions stay relative to the memory.
+        Activation checkpointing (set_checkpointing) applies as in _encode.
+        """
+        past_len = past[0][0].size(2) if past else 0
+        seq_len = x.size(0)
+        # Query i sits at position past_len + i and may attend to every key up to there.
+        mask = torch.ones(seq_len, past_len + seq_len, dtype=torch.bool, device=x.device).tril(diagonal=past_len)
+        key_positions = torch.arange(past_len + seq_len, device=x.device)
+        layers = self.encoder.layers
+        every = getattr(self, 'checkpoint_every', 0)
+        checkpointing = bool(every) and self.training and torch.is_grad_enabled()
+        if not checkpointing:
+            every = len(layers)
+
+        def run_segment(x, start, *segment_past):
+            present = []
+            for i, layer in enumerate(layers[start:start + every]):
+                x, layer_present = self._attend_layer(layer, x, segment_past[i] if segment_past else None,
+                                                      mask, key_positions, keep)
+                present.append(layer_present)
+            return x, present
+
+        present = []
+        for start in range(0, len(layers), every):
+            segment_past = past[start:start + every] if past else []
+            if checkpointing:
+                # The dropout masks are replayed during recomputation, checkpoint() restores the RNG state.
+                x, segment_present = checkpoint(run_segment, x, start, *segment_past, use_reentrant=False)
+            else:
+                x, segment_present = run_segment(x, start, *segment_past)
+            present += segment_present
+        if self.encoder.norm is not None:
+            x = self.encoder.norm(x)
+        return x, present
+
+    def _attend_layer(self, layer, x, past, mask, key_positions, keep):
+        seq_len, bsz = x.shape[:2]
+        past_len = key_positions.size(0) - seq_len
+        attn = layer.self_attn
+        head_dim = self.ninp // attn.num_heads
+        # [sequence length, batch size, ninp] -> [batch size, nhead, sequence length, head dim]
+        q, k, v = [t.reshape(seq_len, bsz, attn.num_heads, head_dim).permute(1, 2, 0, 3)
+                   for t in F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)]
+        if past is not None:
+            k = torch.cat([past[0], k], 2)
+            v = torch.cat([past[1], v], 2)
+        present = (k[:, :, -keep:], v[:, :, -keep:]) if keep else (k, v)
+        if getattr(self, 'positions', 'absolute') == 'rotary':
+            q = apply_rotary(q, key_positions[past_len:])
+            k = apply_rotary(k, key_positions)
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask,
+                                             dropout_p=attn.dropout if self.training else 0.)
+        out = attn.out_proj(out.permute(2, 0, 1, 3).reshape(seq_len, bsz, self.ninp))
+        # Post-norm encoder layer, as in nn.TransformerEncoderLayer(norm_first=False).
+        x = layer.norm1(x + layer.dropout1(out))
+        x = layer.norm2(x + layer.dropout2(layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))))
+        return x, present
+
+    def forward_with_cache(self, src, past=None):
+        """Causal forward pass that reuses the keys and values of the tokens before `src`.
+
+        `past` is the list returned by the previous call, holding one (key, value) pair
+        of shape [batch size, nhead, past length, head dim] per encoder layer, or None.
+        Returns the log-probabilities for `src` and `past` extended by `src`, so
+        decoding one token at a time only computes attention for the new token.
+        Models with a segment memory only keep the last mem_len positions, which
+        bounds the cost of every step. Meant for inference, call eval() first.
+        """
+        past_len = past[0][0].size(2) if past else 0
+        x, present = self._attend(self._embed(src, past_len), past, getattr(self, 'mem_len', 0) or None)
+        return F.log_softmax(self.decoder(x), dim=-1), present
+
+    def forward(self, src, has_mask=True, src_key_padding_mask=None, mems=None):
+        if mems is not None or getattr(self, 'positions', 'absolute') == 'rotary':
+            # The attention is computed in _attend, nn.MultiheadAttention knows neither
+            # rotary positions nor memories. It is always causal.
+            if src_key_padding_mask is not None:
+                raise ValueError('src_key_padding_mask is not supported with rotary positions')
+            output, present = self._attend(self._embed(src), mems or None, self.mem_len)
+            output = F.log_softmax(self.decoder(output), dim=-1)
+            if mems is None:
+                return output
+            # Like repackage_hidden for RNNs, the memory doesn't carry the graph of the previous segment.
+            return output, [(k.detach(), v.detach()) for k, v in present]
+
+        fastpath = getattr(self, 'fastpath', False)
         if has_mask:
             device = src.device
-            if self.src_mask is None or self.src_mask.size(0) != len(src):
-                mask = self._generate_square_subsequent_mask(len(src)).to(device)
+            if torch.onnx.is_in_onnx_export():
+                # A cached mask would be baked into the exported graph with the example length.
+                self.src_mask = self._generate_square_subsequent_mask(src.size(0)).to(device)
+            elif self.src_mask is None or self.src_mask.size(0) != len(src):
+                if fastpath:
+                    mask = self._generate_causal_mask(len(src)).to(device)
+                else:
+                    mask = self._generate_square_subsequent_mask(len(src)).to(device)
                 self.src_mask = mask
         else:
             self.src_mask = None
+        if (src_key_padding_mask is not None and src_key_padding_mask.dtype == torch.bool
+                and self.src_mask is not None and self.src_mask.is_floating_point()):
+            # The encoder wants both masks of one type, the causal mask is additive without the fast path.
+            src_key_padding_mask = torch.zeros(src_key_padding_mask.shape, device=src.device).masked_fill(
+                src_key_padding_mask, float('-inf'))
 
         src = self.input_emb(src) * math.sqrt(self.ninp)
         src = self.pos_encoder(src)
-        output = self.encoder(src, mask=self.src_mask)
+        if fastpath:
+            output = self._encode(src.transpose(0, 1), self.src_mask, src_key_padding_mask, has_mask or None)
+            output = output.transpose(0, 1)
+        else:
+            output = self._encode(src, self.src_mask, src_key_padding_mask, has_mask or None)
         output = self.decoder(output)
         return F.log_softmax(output, dim=-1)
+
+
+class LowRankLinear(nn.Module):
+    r"""Linear layer whose [out_features, in_features] weight is factored as up.weight @ down.weight.
+
+    With rank r the layer holds r * (in_features + out_features) weights instead
+    of in_features * out_features and computes two thin matmuls, see compress.py.
+    """
+
+    def __init__(self, in_features, out_features, rank, bias=True):
+        super(LowRankLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.down = nn.Linear(in_features, rank, bias=False)
+        self.up = nn.Linear(rank, out_features, bias=bias)
+
+    def forward(self, x):
+        return self.up(self.down(x))
+
+
+class LowRankEmbedding(nn.Module):
+    r"""Embedding whose [num_embeddings, embedding_dim] table is factored as embedding.weight @ up.weight.T."""
+
+    def __init__(self, num_embeddings, embedding_dim, rank):
+        super(LowRankEmbedding, self).__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.embedding = nn.Embedding(num_embeddings, rank)
+        self.up = nn.Linear(rank, embedding_dim, bias=False)
+
+    def forward(self, input):
+        return self.up(self.embedding(input))
+
+
+class PrunedLinear(nn.Module):
+    r"""Linear layer that only reads the input features in `index`, the other columns of its weight were pruned.
+
+    `linear` maps the len(index) kept features to out_features, it may itself be a LowRankLinear.
+    """
+
+    def __init__(self, in_features, index, linear):
+        super(PrunedLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = linear.out_features
+        self.register_buffer('index', index)
+        self.linear = linear
+
+    def forward(self, x):
+        return self.linear(x.index_select(-1, self.index))
+
+
+class PrunedEmbedding(nn.Module):
+    r"""Embedding that only stores the features in `index`, the other features of every word are zero.
+
+    `embedding` holds the len(index) kept features, it may itself be a LowRankEmbedding.
+    """
+
+    def __init__(self, embedding_dim, index, embedding):
+        super(PrunedEmbedding, self).__init__()
+        self.num_embeddings = embedding.num_embeddings
+        self.embedding_dim = embedding_dim
+        self.register_buffer('index', index)
+        self.embedding = embedding
+
+    def forward(self, input):
+        kept = self.embedding(input)
+        output = kept.new_zeros(kept.shape[:-1] + (self.embedding_dim,))
+        return output.index_copy(-1, self.index, kept)
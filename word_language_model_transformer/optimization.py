@@ -0,0 +1,128 @@
+import math
+import os
+
+import torch
+
+
+def build_optimizer(name, params, lr, weight_decay=0., momentum=0., betas=(0.9, 0.999), sparse_params=()):
+    """Returns the torch.optim optimizer `name` ('sgd' or 'adamw') for `params`.
+
+    Both update all parameters with a few multi-tensor kernels instead of a Python
+    loop over the parameters: AdamW uses the fused kernel where the parameters'
+    device has one and the foreach kernels otherwise, SGD always uses foreach.
+    `sparse_params` are the parameters with sparse gradients (embeddings with
+    sparse=True). Only the rows present in their gradients are updated: SGD adds
+    the sparse gradient in place and AdamW is paired with SparseAdam for them.
+    They are never weight decayed and SGD updates them without momentum, since
+    both would touch every row (a sparse momentum buffer accumulates all the rows
+    ever updated).
+    """
+    sparse_ids = {id(p) for p in sparse_params}
+    dense_params = [p for p in params if id(p) not in sparse_ids]
+    sparse_params = list(sparse_params)
+    if name == 'sgd':
+        groups = [{'params': dense_params}]
+        if sparse_params:
+            groups.append({'params': sparse_params, 'weight_decay': 0., 'momentum': 0.})
+        return torch.optim.SGD(groups, lr=lr, momentum=momentum, weight_decay=weight_decay, foreach=True)
+    if name == 'adamw':
+        try:
+            optimizer = torch.optim.AdamW(dense_params, lr=lr, betas=betas, weight_decay=weight_decay, fused=True)
+        except RuntimeError:
+            optimizer = torch.optim.AdamW(dense_params, lr=lr, betas=betas, weight_decay=weight_decay, foreach=True)
+        if sparse_params:
+            return OptimizerGroup([optimizer, torch.optim.SparseAdam(sparse_params, lr=lr, betas=betas)])
+        return optimizer
+    raise ValueError("Invalid optimizer '{}', options are ['sgd', 'adamw']".format(name))
+
+
+class OptimizerGroup(object):
+    """Steps several optimizers as one, e.g. AdamW for the dense parameters and SparseAdam for a sparse embedding."""
+
+    def __init__(self, optimizers):
+        self.optimizers = optimizers
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    def zero_grad(self, set_to_none=True):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none)
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return {'optimizers': [optimizer.state_dict() for optimizer in self.optimizers]}
+
+    def load_state_dict(self, state_dict):
+        for optimizer, state in zip(self.optimizers, state_dict['optimizers']):
+            optimizer.load_state_dict(state)
+
+
+class LRScheduler(object):
+    """Sets the learning rate of `optimizer` before every update.
+
+    The learning rate is the base learning rate times a linear warmup over the
+    first `warmup_steps` updates times the schedule:
+        constant: 1.
+        cosine: cosine decay from 1 to 0 over `total_steps` updates.
+        inverse_sqrt: sqrt(warmup_steps / step) after the warmup.
+        plateau: 1, divided by 4 every time plateau() is called, i.e. after every
+            epoch that didn't improve the validation loss.
+    Examples:
+        >>> scheduler = LRScheduler(optimizer, 'cosine', warmup_steps=1000, total_steps=50000)
+        >>> scheduler.step()
+        >>> optimizer.step()
+    """
+
+    schedules = ['plateau', 'constant', 'cosine', 'inverse_sqrt']
+
+    def __init__(self, optimizer, schedule='plateau', warmup_steps=0, total_steps=0):
+        if schedule not in self.schedules:
+            raise ValueError("Invalid schedule '{}', options are {}".format(schedule, self.schedules))
+        self.optimizer = optimizer
+        self.schedule = schedule
+        self.warmup_steps = warmup_steps
+        self.total_steps = total_steps
+        self.base_lrs = [group['lr'] for group in optimizer.param_groups]
+        self.num_steps = 0
+        self.annealing = 1.
+
+    def factor(self, step):
+        factor = min(1., step / self.warmup_steps) if self.warmup_steps else 1.
+        if self.schedule == 'cosine':
+            progress = min(1., step / max(1, self.total_steps))
+            factor *= 0.5 * (1. + math.cos(math.pi * progress))
+        elif self.schedule == 'inverse_sqrt':
+            factor *= math.sqrt(max(1, self.warmup_steps) / max(step, self.warmup_steps, 1))
+        return factor * self.annealing
+
+    def step(self, scale=1.):
+        # `scale` only applies to this update, e.g. for a batch of shorter sequences.
+        self.num_steps += 1
+        factor = self.factor(self.num_steps) * scale
+        for group, base_lr in zip(self.optimizer.param_groups, self.base_lrs):
+            group['lr'] = base_lr * factor
+
+    def plateau(self):
+        # Anneal the learning rate if no improvement has been seen in the validation dataset.
+        if self.schedule == 'plateau':
+            self.annealing /= 4.0
+
+    def get_lr(self):
+        return self.optimizer.param_groups[0]['lr']
+
+    def state_dict(self):
+        return {'num_steps': self.num_steps, 'annealing': self.annealing}
+
+    def load_state_dict(self, state_dict):
+        self.num_steps = state_dict['num_steps']
+        self.annealing = state_dict['annealing']
+
+
+def training_state_path(checkpoint):
+    # The optimizer and scheduler state is saved next to the checkpoint, e.g. model.pt -> model.train.pt.
+    return os.path.splitext(checkpoint)[0] + '.train.pt'
@@ -0,0 +1,123 @@
+from collections import OrderedDict
+
+import torch
+
+
+def _nbytes(state):
+    if isinstance(state, torch.Tensor):
+        return state.nelement() * state.element_size()
+    if isinstance(state, (tuple, list)):
+        return sum(_nbytes(s) for s in state)
+    return 0
+
+
+def _compact(state):
+    # Slices of the model outputs would keep (and save) the whole output tensor alive.
+    if isinstance(state, torch.Tensor):
+        return state.clone()
+    return type(state)(_compact(s) for s in state)
+
+
+class PrefixCache(object):
+    """LRU cache of model states for prompt prefixes, keyed by their token ids.
+
+    An entry holds the state after a prefix (the hidden state of an RNNModel, or the
+    per-layer keys and values of TransformerModel.forward_with_cache) and the
+    log-probabilities of the next token. States are stored for the whole prompt and
+    after every `block` tokens of it, so prompts that only share their beginning
+    still reuse the longest block-aligned common prefix. When the entries take more
+    than `max_bytes`, the least recently used ones are evicted.
+    The states only hold for one model: `identity` (e.g. data.checkpoint_identity())
+    is saved with the entries and load() ignores files saved for another one.
+    Examples:
+        >>> cache = PrefixCache(max_bytes=256 * 2**20, identity=data.checkpoint_identity('model.pt'))
+        >>> state, log_probs = encode_prefix(model, ids, cache)
+    """
+
+    def __init__(self, max_bytes=256 * 2**20, block=64, identity=None):
+        self.max_bytes = max_bytes
+        self.block = block
+        self.identity = identity
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, ids):
+        """Returns (length, state, log_probs) for the longest cached prefix of `ids`, or (0, None, None)."""
+        lengths = [len(ids)] + list(range((len(ids) - 1) // self.block * self.block, 0, -self.block))
+        for length in lengths:
+            key = tuple(ids[:length])
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                state, log_probs = self.entries[key]
+                return length, state, log_probs
+        self.misses += 1
+        return 0, None, None
+
+    def put(self, ids, state, log_probs):
+        key = tuple(ids)
+        if key in self.entries:
+            self.nbytes -= _nbytes(self.entries.pop(key))
+        self.entries[key] = _compact((state, log_probs))
+        self.nbytes += _nbytes(self.entries[key])
+        while self.nbytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= _nbytes(evicted)
+
+    def save(self, path):
+        """Writes the entries to `path`, so that later processes can start with a warm cache."""
+        with open(path, 'wb') as f:
+            torch.save({'identity': self.identity, 'entries': list(self.entries.items())}, f)
+
+    def load(self, path, device=None):
+        """Adds the entries saved at `path`, the most recently used ones last.
+
+        Returns False and adds nothing if they were saved for a model with another identity.
+        """
+        with open(path, 'rb') as f:
+            saved = torch.load(f, map_location=device)
+        if not isinstance(saved, dict) or saved['identity'] != self.identity:
+            return False
+        for key, (state, log_probs) in saved['entries']:
+            self.put(key, state, log_probs)
+        return True
+
+
+def step(model, input, state):
+    """Runs the [sequence length, 1] `input` from `state` (None to start from scratch).
+
+    Returns the log-probabilities of the token after the input and the new state.
+    """
+    if getattr(model, 'model_type', None) == 'Transformer':
+        output, state = model.forward_with_cache(input, state)
+        return output[-1], state
+    if state is None:
+        state = model.init_hidden(input.size(1))
+    output, state = model(input, state)
+    return output[-1:], state
+
+
+def encode_prefix(model, ids, cache=None):
+    """Returns the state after the token ids `ids` and the log-probabilities of the next token.
+
+    Only the tokens after the longest cached prefix are run through the model. The
+    prompt is processed in `cache.block` sized chunks, caching the state after each.
+    """
+    device = next(model.parameters()).device
+    length, state, log_probs = cache.get(ids) if cache is not None else (0, None, None)
+    with torch.no_grad():
+        while length < len(ids):
+            end = len(ids)
+            if cache is not None:
+                end = min(end, (length // cache.block + 1) * cache.block)
+            input = torch.tensor(ids[length:end], dtype=torch.long, device=device).view(-1, 1)
+            log_probs, state = step(model, input, state)
+            length = end
+            if cache is not None:
+                cache.put(ids[:length], state, log_probs)
+    return state, log_probs
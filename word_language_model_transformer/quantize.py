@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+###############################################################################
+# Language Modeling on Wikitext-2
+#
+# This file applies dynamic int8 quantization to a trained model, saves the
+# quantized checkpoint and compares its perplexity against the float model.
+#
+###############################################################################
+import argparse
+import copy
+import io
+import math
+import time
+
+import torch
+import torch.nn as nn
+
+import data
+import evaluation
+from generate import get_model
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Dynamic int8 quantization of a Wikitext-2 Language Model')
+    parser.add_argument('--data', type=str, default='../data/wikitext-2',
+                        help='location of the data corpus')
+    parser.add_argument('--checkpoint', type=str, default='./model.pt',
+                        help='float model checkpoint to quantize')
+    parser.add_argument('--save', type=str, default='./model_int8.pt',
+                        help='path to save the quantized model')
+    parser.add_argument('--eval-context', type=int, default=35,
+                        help='context length of the evaluation windows')
+    parser.add_argument('--eval-batch-size', type=int, default=10,
+                        help='number of windows evaluated together')
+    parser.add_argument('--eval-windows', type=int, default=0,
+                        help='score only this many evenly spaced validation windows (0 = all)')
+    args = parser.parse_args()
+    return args
+
+
+def quantize_model(model):
+    """Returns an int8 copy of `model` with dynamically quantized Linear, LSTM and GRU layers.
+
+    The weights are quantized ahead of time, the activations are quantized on the
+    fly for every matmul. Quantized models only run on the CPU. The attention
+    projections of nn.MultiheadAttention are kept as raw parameters (in_proj) or as
+    NonDynamicallyQuantizableLinear (out_proj) by PyTorch and so stay in float.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    if getattr(model, 'model_type', None) == 'Transformer':
+        # The fused encoder kernel reads the float weights of the feed-forward layers.
+        model.disable_fastpath()
+    model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear, nn.LSTM, nn.GRU}, dtype=torch.qint8)
+    model.quantized = True
+    return model
+
+
+def checkpoint_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def main():
+    args = get_args()
+    device = torch.device('cpu')
+    float_model = get_model(args.checkpoint, device)
+    quantized_model = quantize_model(float_model)
+    with open(args.save, 'wb') as f:
+        torch.save(quantized_model, f)
+    print('Quantized model saved to {}'.format(args.save))
+
+    corpus = data.Corpus(args.data)
+    corpus.dictionary.save(data.vocab_path(args.save))
+
+    print('=' * 89)
+    for name, model in [('float32', float_model), ('int8', quantized_model)]:
+        start_time = time.time()
+        loss = evaluation.sliding_window_loss(model, corpus.valid, args.eval_context, args.eval_context,
+                                              args.eval_batch_size, args.eval_windows or None)
+        elapsed = time.time() - start_time
+        print('| {:7s} | size {:8.2f} MB | valid loss {:5.2f} | valid ppl {:8.2f} | time {:6.2f}s'.format(
+            name, checkpoint_size(model) / 2**20, loss, math.exp(loss), elapsed))
+    print('=' * 89)
+
+
+if __name__ == '__main__':
+    main()
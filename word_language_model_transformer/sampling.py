@@ -0,0 +1,125 @@
+import torch
+import torch.nn.functional as F
+
+
+class Sampler(object):
+    """Draws next-token ids from the log-probabilities returned by the models.
+
+    Supports temperature, top-k, nucleus (top-p) and greedy sampling. Everything
+    runs on the device of the log-probabilities, so only the sampled ids need to
+    reach the host. top-k only partially sorts the vocabulary with torch.topk.
+    Args:
+        temperature: higher will increase diversity (default=1.0).
+        top_k: sample among the k most likely tokens, 0 disables it (default=0).
+        top_p: sample among the most likely tokens whose probabilities add up to
+            top_p, 1.0 disables it (default=1.0).
+        greedy: always pick the most likely token (default=False).
+    Examples:
+        >>> sampler = Sampler(temperature=0.8, top_k=40)
+        >>> word_idx = sampler(output[-1])
+    """
+
+    def __init__(self, temperature=1.0, top_k=0, top_p=1.0, greedy=False):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.greedy = greedy
+
+    def _nucleus_mask(self, sorted_logits):
+        # True for the tokens (in descending order) that fall outside the nucleus.
+        # The most likely token is always kept.
+        probs = F.softmax(sorted_logits, dim=-1)
+        return probs.cumsum(-1) - probs > self.top_p
+
+    def __call__(self, log_probs):
+        """Returns the sampled ids, log_probs has shape [..., ntoken] and the result [...]."""
+        if self.greedy:
+            return log_probs.argmax(-1)
+        logits = log_probs / self.temperature
+        ntoken = logits.size(-1)
+        if self.top_k or self.top_p < 1.0:
+            values, indices = logits.topk(min(self.top_k or ntoken, ntoken), dim=-1)
+            if self.top_p < 1.0:
+                values = values.masked_fill(self._nucleus_mask(values), float('-inf'))
+            choice = torch.multinomial(F.softmax(values, dim=-1).view(-1, values.size(-1)), 1)
+            return indices.gather(-1, choice.view(indices.shape[:-1] + (1,))).squeeze(-1)
+        choice = torch.multinomial(F.softmax(logits, dim=-1).view(-1, ntoken), 1)
+        return choice.view(logits.shape[:-1])
+
+    def probs(self, log_probs):
+        """Returns the full [..., ntoken] distribution that __call__ samples from."""
+        if self.greedy:
+            return F.one_hot(log_probs.argmax(-1), log_probs.size(-1)).to(log_probs.dtype)
+        logits = log_probs / self.temperature
+        if self.top_k and self.top_k < logits.size(-1):
+            kth = logits.topk(self.top_k, dim=-1).values[..., -1:]
+            logits = logits.masked_fill(logits < kth, float('-inf'))
+        if self.top_p < 1.0:
+            sorted_logits, indices = logits.sort(dim=-1, descending=True)
+            mask = torch.zeros_like(logits, dtype=torch.bool).scatter(-1, indices, self._nucleus_mask(sorted_logits))
+            logits = logits.masked_fill(mask, float('-inf'))
+        return F.softmax(logits, dim=-1)
+
+
+def speculative_decode(target, draft, input, num_tokens, sampler, draft_tokens=4):
+    """Yields num_tokens token ids following the [sequence length, 1] prompt `input`.
+
+    A small recurrent `draft` model proposes `draft_tokens` tokens one by one, then
+    the TransformerModel `target` scores all of them in a single forward pass. Every
+    proposal is accepted with probability min(1, p/q), where p and q are the target
+    and draft distributions after the sampler's filtering. At the first rejection a
+    token is drawn from the normalized max(0, p - q) instead and the rest of the
+    proposals are dropped; if all are accepted, a bonus token is drawn from the
+    target. The output follows the target's distribution exactly, and every step
+    yields between 1 and draft_tokens + 1 tokens. The target rescores the whole
+    sequence, so it can't have a segment memory (mem_len > 0).
+    """
+    if getattr(target, 'mem_len', 0):
+        raise ValueError('Speculative decoding does not support models with a segment memory')
+    tokens = input
+    hidden = draft.init_hidden(1)
+    # Tokens that the draft model has not consumed yet.
+    pending = input
+    produced = 0
+    steps = torch.arange(draft_tokens, device=input.device)
+    with torch.no_grad():
+        while produced < num_tokens:
+            drafted, draft_probs, hiddens = [], [], []
+            x = pending
+            for _ in range(draft_tokens):
+                output, hidden = draft(x, hidden)
+                q = sampler.probs(output[-1:])
+                x = torch.multinomial(q, 1)
+                drafted.append(x)
+                draft_probs.append(q)
+                hiddens.append(hidden)
+            drafted = torch.cat(drafted, 0)
+            q = torch.cat(draft_probs, 0)
+
+            output = target(torch.cat([tokens, drafted], 0))
+            p = sampler.probs(output[-draft_tokens-1:, 0])
+            ids = drafted.view(-1)
+            ratio = p[steps, ids] / q[steps, ids]
+            accepted = torch.rand(draft_tokens, device=input.device) < ratio
+            n = int(accepted.cumprod(0).sum())
+
+            if n < draft_tokens:
+                residual = (p[n] - q[n]).clamp(min=0)
+                if residual.sum() <= 0:
+                    residual = p[n]
+                correction = torch.multinomial(residual, 1).view(1, 1)
+                # hiddens[n] has consumed the pending tokens and the accepted proposals.
+                hidden = hiddens[n]
+                pending = correction
+            else:
+                correction = torch.multinomial(p[n], 1).view(1, 1)
+                hidden = hiddens[-1]
+                pending = torch.cat([drafted[-1:], correction], 0)
+            new_tokens = torch.cat([drafted[:n], correction], 0)
+            tokens = torch.cat([tokens, new_tokens], 0)
+
+            for token in new_tokens.view(-1).tolist():
+                yield token
+                produced += 1
+                if produced == num_tokens:
+                    return
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+###############################################################################
+# Language Modeling on Wikitext-2
+#
+# This file scores arbitrary text files with a trained model. It writes one
+# JSON line per document with its loss and perplexity and can also save the
+# log-probability of every token as a numpy array:
+#
+#   python score.py --checkpoint model.pt --split line --workers 4 \
+#       --token-log-probs scores.npz a.txt b.txt > docs.jsonl
+#
+###############################################################################
+import argparse
+import collections
+import itertools
+import json
+import math
+import sys
+from io import open
+
+import torch
+
+import data
+import evaluation
+from generate import get_dictionary, get_model
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Score text files with a Wikitext-2 Language Model')
+    parser.add_argument('files', nargs='+',
+                        help='text files to score (- for stdin)')
+    parser.add_argument('--data', type=str, default='../data/wikitext-2',
+                        help='location of the data corpus, only read if there is no vocabulary file')
+    parser.add_argument('--checkpoint', type=str, default='./model.pt',
+                        help='model checkpoint to use')
+    parser.add_argument('--vocab', type=str, default='',
+                        help='vocabulary file saved by main.py (default: next to the checkpoint)')
+    parser.add_argument('--split', type=str, default='file', choices=['file', 'line', 'blank'],
+                        help='what makes a document: a whole file, a line or a blank-line separated paragraph')
+    parser.add_argument('--output', type=str, default='-',
+                        help='JSON lines file for the per-document scores (- for stdout)')
+    parser.add_argument('--token-log-probs', type=str, default='',
+                        help='also save the per-token log-probabilities to this .npz file')
+    parser.add_argument('--context', type=int, default=35,
+                        help='context length of the scoring windows')
+    parser.add_argument('--stride', type=int, default=0,
+                        help='tokens scored per window (default: half the context)')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='number of windows scored together')
+    parser.add_argument('--docs-per-task', type=int, default=256,
+                        help='number of documents sent to a worker at once')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of worker processes (0 = score in this process)')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='torch threads per worker (default: the cores divided among the workers)')
+    parser.add_argument('--cuda', action='store_true',
+                        help='use CUDA')
+    args = parser.parse_args()
+
+    if args.context < 1:
+        parser.error("--context has to be greater or equal 1.")
+    if not 0 <= args.stride <= args.context:
+        parser.error("--stride has to be in [0, --context].")
+    if args.cuda and args.workers:
+        parser.error("--workers only runs on the CPU.")
+
+    return args
+
+
+def read_documents(files, split):
+    """Yields (source, text) for every document of `files`, reading one line at a time."""
+    for path in files:
+        f = sys.stdin if path == '-' else open(path, 'r', encoding="utf8")
+        try:
+            if split == 'file':
+                yield path, f.read()
+            elif split == 'line':
+                for line in f:
+                    if line.strip():
+                        yield path, line
+            else:
+                paragraph = []
+                for line in itertools.chain(f, ['\n']):
+                    if line.strip():
+                        paragraph.append(line)
+                    elif paragraph:
+                        yield path, ''.join(paragraph)
+                        paragraph = []
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+###############################################################################
+# Scoring, in this process or in the workers
+###############################################################################
+
+# Set once per process by init_scorer, so the model is not sent with every task.
+_scorer = None
+
+
+def init_scorer(checkpoint, vocab, data_path, device, context, stride, batch_size, threads):
+    global _scorer
+    if threads:
+        torch.set_num_threads(threads)
+    model = get_model(checkpoint, device)
+    dictionary = get_dictionary(vocab, data_path)
+    _scorer = (model, dictionary, device, context, stride, batch_size)
+
+
+def score_documents(texts):
+    """Returns the per-token log-probabilities of every text as float32 numpy arrays."""
+    model, dictionary, device, context, stride, batch_size = _scorer
+    documents = [dictionary.encode(text).to(device) for text in texts]
+    log_probs = evaluation.document_log_probs(model, documents, context, stride, batch_size)
+    return [lp.float().cpu().numpy() for lp in log_probs]
+
+
+def main():
+    args = get_args()
+    device = torch.device("cuda" if args.cuda else "cpu")
+    vocab = args.vocab or data.vocab_path(args.checkpoint)
+    stride = args.stride or max(1, args.context // 2)
+
+    documents = read_documents(args.files, args.split)
+    chunks = iter(lambda: list(itertools.islice(documents, args.docs_per_task)), [])
+    # The sources are kept here, only the texts go to the workers.
+    sources = collections.deque()
+
+    def texts():
+        for chunk in chunks:
+            sources.append([source for source, _ in chunk])
+            yield [text for _, text in chunk]
+
+    if args.workers:
+        import torch.multiprocessing as mp
+        threads = args.threads or max(1, torch.get_num_threads() // args.workers)
+        # Spawned workers load the model themselves instead of inheriting the parent's threads.
+        pool = mp.get_context('spawn').Pool(
+            args.workers, init_scorer,
+            (args.checkpoint, vocab, args.data, device, args.context, stride, args.batch_size, threads))
+        results = pool.imap(score_documents, texts())
+    else:
+        pool = None
+        init_scorer(args.checkpoint, vocab, args.data, device, args.context, stride, args.batch_size,
+                    args.threads)
+        results = map(score_documents, texts())
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding="utf8")
+    token_log_probs = []
+    total_loss = 0.
+    total_tokens = 0
+    doc = 0
+    try:
+        for chunk_log_probs in results:
+            for source, log_probs in zip(sources.popleft(), chunk_log_probs):
+                tokens = len(log_probs)
+                loss = -float(log_probs.sum(dtype='float64')) / tokens if tokens else float('nan')
+                out.write(json.dumps({'source': source, 'doc': doc, 'tokens': tokens,
+                                      'loss': loss, 'ppl': math.exp(loss) if tokens else float('nan')}) + '\n')
+                if args.token_log_probs:
+                    token_log_probs.append(log_probs)
+                total_loss -= float(log_probs.sum(dtype='float64'))
+                total_tokens += tokens
+                doc += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if args.token_log_probs:
+        import numpy as np
+        # Document i owns log_probs[offsets[i]:offsets[i + 1]].
+        offsets = np.cumsum([0] + [len(lp) for lp in token_log_probs], dtype=np.int64)
+        log_probs = np.concatenate(token_log_probs) if token_log_probs else np.zeros(0, dtype=np.float32)
+        np.savez(args.token_log_probs, log_probs=log_probs, offsets=offsets)
+
+    if total_tokens:
+        print('| scored {} documents | {} tokens | loss {:5.2f} | ppl {:8.2f}'.format(
+            doc, total_tokens, total_loss / total_tokens, math.exp(total_loss / total_tokens)),
+            file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
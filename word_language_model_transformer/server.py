@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+###############################################################################
+# Language Modeling on Wikitext-2
+#
+# This file serves a trained model over HTTP. Concurrent requests are grouped
+# into dynamic batches so that every forward pass serves several of them.
+#
+#   POST /generate  {"prompt": "the game", "words": 50, "temperature": 1.0,
+#                    "top_k": 0, "top_p": 1.0, "greedy": false}
+#                   -> {"text": "..."}
+#   POST /score     {"text": "..."}
+#                   -> {"tokens": 12, "loss": 5.1, "ppl": 164.0}
+#
+###############################################################################
+import argparse
+import asyncio
+import json
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+import data
+import evaluation
+import prefix_cache
+import sampling
+from generate import generate_batch, get_device, get_dictionary, get_model
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='PyTorch Wikitext-2 Language Model server')
+    parser.add_argument('--data', type=str, default='../data/wikitext-2',
+                        help='location of the data corpus, only read if there is no vocabulary file')
+    parser.add_argument('--checkpoint', type=str, default='./model.pt',
+                        help='model checkpoint to use')
+    parser.add_argument('--vocab', type=str, default='',
+                        help='vocabulary file saved by main.py (default: next to the checkpoint)')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to listen on')
+    parser.add_argument('--max-batch-size', type=int, default=16,
+                        help='maximum number of requests in one batch')
+    parser.add_argument('--max-wait-ms', type=float, default=10,
+                        help='how long the first request of a batch waits for others to join')
+    parser.add_argument('--max-words', type=int, default=1000,
+                        help='maximum number of words per generation request')
+    parser.add_argument('--prefix-cache-mb', type=float, default=0,
+                        help='memory budget in MB of a cache of the model states of earlier prompts, so that '
+                             'prompts with a common beginning only run their new part (0 = no cache)')
+    parser.add_argument('--prefix-cache', type=str, default='',
+                        help='file to start the prefix cache from and to save it to on shutdown '
+                             '(ignored when saved for another checkpoint)')
+    parser.add_argument('--seed', type=int, default=1111,
+                        help='random seed')
+    parser.add_argument('--cuda', action='store_true',
+                        help='use CUDA')
+    parser.add_argument('--mps', action='store_true', default=False,
+                            help='enables macOS GPU training')
+    args = parser.parse_args()
+
+    if args.prefix_cache and args.prefix_cache_mb <= 0:
+        parser.error("--prefix-cache needs --prefix-cache-mb.")
+
+    return args
+
+
+class DynamicBatcher(object):
+    """Groups requests that arrive close together and runs them as one batch.
+
+    A batch is closed when it holds `max_batch_size` requests or `max_wait` seconds
+    after its first request arrived, whichever comes first. `run_batch` receives the
+    list of requests and returns the list of results; it runs on `executor`, so the
+    event loop keeps accepting requests during the forward passes. A result that is
+    an exception fails only its own request.
+    """
+
+    def __init__(self, run_batch, executor, max_batch_size, max_wait):
+        self.run_batch = run_batch
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+
+    async def submit(self, request):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, [r for r, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error'}
+
+
+class LanguageModelServer(object):
+    """Keeps the model and vocabulary loaded and answers /generate and /score requests.
+
+    With a prefix_cache.PrefixCache as `cache`, /generate only runs the part of a
+    prompt after its longest cached prefix, see generate.generate_batch_cached.
+    """
+
+    def __init__(self, model, dictionary, device, max_batch_size=16, max_wait=0.01, max_words=1000, cache=None):
+        self.model = model
+        self.dictionary = dictionary
+        self.device = device
+        self.max_words = max_words
+        self.cache = cache
+        # TransformerModel can't go past the length of its positional encoding table (rotary positions have none).
+        self.max_len = model.pos_encoder.pe.size(0) if getattr(model, 'pos_encoder', None) is not None else None
+        # A single thread runs all forward passes, the model is not shared between threads.
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.generate_batcher = DynamicBatcher(self._generate_batch, executor, max_batch_size, max_wait)
+        self.score_batcher = DynamicBatcher(self._score_batch, executor, max_batch_size, max_wait)
+
+    @staticmethod
+    def _run_each_on_failure(run_batch, requests):
+        # If the batch fails, the requests are retried one by one, so that a bad
+        # request only fails itself and not the others batched with it.
+        try:
+            return run_batch(requests)
+        except Exception:
+            if len(requests) == 1:
+                raise
+        results = []
+        for request in requests:
+            try:
+                results.extend(run_batch([request]))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _generate_batch(self, requests):
+        def run_batch(requests):
+            prompts = [prompt for prompt, _, _ in requests]
+            num_words = [n for _, n, _ in requests]
+            samplers = [sampler for _, _, sampler in requests]
+            word_ids = generate_batch(self.model, prompts, num_words, samplers, self.cache)
+            return [' '.join(self.dictionary.idx2word[i] for i in ids) for ids in word_ids]
+        return self._run_each_on_failure(run_batch, requests)
+
+    def _score_batch(self, sequences):
+        def run_batch(sequences):
+            results = []
+            for log_probs in evaluation.sequence_log_probs(self.model, sequences):
+                loss = -log_probs.mean().item()
+                results.append({'tokens': len(log_probs), 'loss': loss, 'ppl': math.exp(loss)})
+            return results
+        return self._run_each_on_failure(run_batch, sequences)
+
+    @staticmethod
+    def _integer(body, name, default):
+        # int() raises OverflowError rather than ValueError for a JSON 1e999 (float infinity)
+        # and silently truncates 2.7, both are rejected like other non-integers.
+        value = body.get(name, default)
+        try:
+            number = int(value)
+        except (ValueError, TypeError, OverflowError):
+            number = None
+        if number is None or (isinstance(value, float) and value != number):
+            raise HTTPError(400, '"{}" has to be an integer'.format(name))
+        return number
+
+    async def generate(self, body):
+        prompt = body.get('prompt', '')
+        if not isinstance(prompt, str):
+            raise HTTPError(400, '"prompt" has to be a string')
+        if prompt.strip():
+            # Generation continues the prompt, it doesn't start a new line.
+            prompt = self.dictionary.encode(prompt, final_eos=False).to(self.device)
+        else:
+            prompt = torch.randint(len(self.dictionary), (1,), device=self.device)
+        num_words = self._integer(body, 'words', 50)
+        if not 0 < num_words <= self.max_words:
+            raise HTTPError(400, '"words" has to be in [1, {}]'.format(self.max_words))
+        if self.max_len and len(prompt) + num_words > self.max_len:
+            raise HTTPError(400, 'prompt and words are longer than {} tokens'.format(self.max_len))
+        temperature = float(body.get('temperature', 1.0))
+        top_k = self._integer(body, 'top_k', 0)
+        top_p = float(body.get('top_p', 1.0))
+        greedy = body.get('greedy', False)
+        # The same checks as the generate.py options. float() accepts "nan" and "inf",
+        # which fail every comparison, so they are rejected explicitly.
+        if not math.isfinite(temperature) or temperature < 1e-3:
+            raise HTTPError(400, '"temperature" has to be a finite number greater or equal 1e-3')
+        if top_k < 0:
+            raise HTTPError(400, '"top_k" has to be greater or equal 0')
+        if not math.isfinite(top_p) or not 0 < top_p <= 1:
+            raise HTTPError(400, '"top_p" has to be in (0, 1]')
+        if not isinstance(greedy, bool):
+            raise HTTPError(400, '"greedy" has to be true or false')
+        sampler = sampling.Sampler(temperature, top_k, top_p, greedy)
+        text = await self.generate_batcher.submit((prompt, num_words, sampler))
+        return {'text': text}
+
+    async def score(self, body):
+        text = body.get('text', '')
+        if not isinstance(text, str) or not text.split():
+            raise HTTPError(400, '"text" has to be a non-empty string')
+        ids = self.dictionary.encode(text).to(self.device)
+        if self.max_len and len(ids) > self.max_len + 1:
+            raise HTTPError(400, 'text is longer than {} tokens'.format(self.max_len))
+        return await self.score_batcher.submit(ids)
+
+    async def handle(self, reader, writer):
+        try:
+            status, response = 200, await self.dispatch(reader)
+        except HTTPError as e:
+            status, response = e.status, {'error': str(e)}
+        except (ValueError, TypeError, OverflowError) as e:
+            status, response = 400, {'error': str(e)}
+        except Exception as e:
+            status, response = 500, {'error': str(e)}
+        payload = json.dumps(response).encode('utf8')
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, REASONS[status], len(payload)).encode('latin1'))
+        writer.write(payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def dispatch(self, reader):
+        request_line = (await reader.readline()).decode('latin1').split()
+        if len(request_line) != 3:
+            raise HTTPError(400, 'malformed request line')
+        method, path, _ = request_line
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+        routes = {'/generate': self.generate, '/score': self.score}
+        if path not in routes:
+            raise HTTPError(404, 'unknown path {}'.format(path))
+        if method != 'POST':
+            raise HTTPError(405, 'use POST')
+        body = json.loads(body or b'{}')
+        if not isinstance(body, dict):
+            raise HTTPError(400, 'the request body has to be a JSON object')
+        return await routes[path](body)
+
+    async def serve(self, host, port):
+        batchers = [asyncio.ensure_future(self.generate_batcher.run()),
+                    asyncio.ensure_future(self.score_batcher.run())]
+        server = await asyncio.start_server(self.handle, host, port)
+        print('| Serving on http://{}:{}'.format(host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for batcher in batchers:
+                batcher.cancel()
+
+
+def main():
+    args = get_args()
+    device = get_device(args)
+    model = get_model(args.checkpoint, device)
+    dictionary = get_dictionary(args.vocab or data.vocab_path(args.checkpoint), args.data)
+    cache = None
+    if args.prefix_cache_mb > 0:
+        cache = prefix_cache.PrefixCache(int(args.prefix_cache_mb * 2**20),
+                                         identity=data.checkpoint_identity(args.checkpoint))
+        if args.prefix_cache and os.path.exists(args.prefix_cache) and not cache.load(args.prefix_cache, device):
+            print('WARNING: {} was saved for another model, starting with an empty prefix cache.'.format(
+                args.prefix_cache))
+    server = LanguageModelServer(model, dictionary, device, args.max_batch_size,
+                                 args.max_wait_ms / 1000, args.max_words, cache)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print('| Server stopped')
+    if args.prefix_cache:
+        cache.save(args.prefix_cache)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+###############################################################################
+# Language Modeling on Wikitext-2
+#
+# This file runs a hyperparameter sweep: it launches main.py trials as parallel
+# processes, each limited to a share of the CPU cores, and prunes trials whose
+# validation loss falls behind the others. The sweep is described by a JSON
+# spec whose keys are main.py options without the leading dashes:
+#
+#   {
+#       "method": "random",
+#       "trials": 8,
+#       "fixed": {"epochs": 6, "data": "../data/wikitext-2"},
+#       "parameters": {
+#           "nlayers": [2, 4],
+#           "dropout": {"min": 0.1, "max": 0.5},
+#           "lr": {"min": 1, "max": 20, "log": true}
+#       }
+#   }
+#
+# With "method": "grid", every parameter must be a list of values and all
+# combinations are tried. Every trial writes the usual report.json to
+# <sweep-dir>/trial-NNN/ and the sweep summary goes to <sweep-dir>/sweep.json.
+#
+###############################################################################
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+import torch
+
+import data
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep over Wikitext-2 Language Models')
+    parser.add_argument('--spec', type=str, required=True,
+                        help='JSON file describing the sweep')
+    parser.add_argument('--sweep-dir', type=str, default='sweep',
+                        help='directory for the trial reports, checkpoints and logs')
+    parser.add_argument('--parallel', type=int, default=2,
+                        help='number of trials running at the same time')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='torch threads per trial (default: the cores divided among the parallel trials)')
+    parser.add_argument('--corpus-cache', type=str, default='',
+                        help='tokenized corpus shared by all trials (default: <sweep-dir>/corpus.pt)')
+    parser.add_argument('--prune', action='store_true',
+                        help='stop trials whose validation loss is worse than the median of the others')
+    parser.add_argument('--prune-after', type=int, default=2,
+                        help='never prune a trial before this many epochs')
+    parser.add_argument('--prune-min-trials', type=int, default=3,
+                        help='only prune at epochs that at least this many other trials have reached')
+    parser.add_argument('--seed', type=int, default=1111,
+                        help='random seed of the random search')
+    args = parser.parse_args()
+
+    if args.parallel < 1:
+        parser.error("--parallel has to be greater or equal 1.")
+
+    return args
+
+
+def sample_value(spec, rng):
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    if spec.get('log'):
+        value = math.exp(rng.uniform(math.log(spec['min']), math.log(spec['max'])))
+    else:
+        value = rng.uniform(spec['min'], spec['max'])
+    return int(round(value)) if spec.get('int') else value
+
+
+def trial_params(spec, seed):
+    """Returns the list of parameter dicts, one per trial, described by `spec`."""
+    parameters = spec.get('parameters', {})
+    if spec.get('method', 'grid') == 'grid':
+        for name, values in parameters.items():
+            if not isinstance(values, list):
+                raise ValueError("grid search needs a list of values for '{}'".format(name))
+        names = list(parameters)
+        return [dict(zip(names, values)) for values in itertools.product(*parameters.values())]
+    rng = random.Random(seed)
+    return [{name: sample_value(values, rng) for name, values in parameters.items()}
+            for _ in range(spec['trials'])]
+
+
+def command_line(options):
+    # {'lr': 4, 'tied': True, 'cuda': False} -> ['--lr', '4', '--tied']
+    argv = []
+    for name, value in options.items():
+        if value is True:
+            argv.append('--' + name)
+        elif value is not False and value is not None:
+            argv += ['--' + name, str(value)]
+    return argv
+
+
+END_OF_EPOCH = re.compile(r'\| end of epoch\s+(\d+) .*\| valid loss\s+([\d.naif]+)')
+
+
+class Trial(object):
+    """A main.py process, with the validation losses read back from its log."""
+
+    def __init__(self, index, params, sweep_dir):
+        self.index = index
+        self.params = params
+        self.name = 'trial-{:03d}'.format(index)
+        self.report_dir = os.path.join(sweep_dir, self.name)
+        self.checkpoint = os.path.join(sweep_dir, self.name + '.pt')
+        self.log_path = os.path.join(sweep_dir, self.name + '.log')
+        self.process = None
+        self.val_losses = {}
+        self.status = 'pending'
+
+    def start(self, options, threads):
+        # poll() reads the epoch losses from the log, so main.py mustn't block-buffer its stdout.
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads), PYTHONUNBUFFERED='1')
+        argv = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')]
+        argv += command_line(dict(options, save=self.checkpoint, **{'report-dir': self.report_dir}))
+        with open(self.log_path, 'w') as log:
+            self.process = subprocess.Popen(argv, stdout=log, stderr=subprocess.STDOUT, env=env)
+        self.status = 'running'
+
+    def poll(self):
+        """Updates the validation losses, returns True once the process has exited."""
+        with open(self.log_path, 'r', errors='replace') as f:
+            for match in END_OF_EPOCH.finditer(f.read()):
+                self.val_losses[int(match.group(1))] = float(match.group(2))
+        if self.process.poll() is None:
+            return False
+        if self.status == 'running':
+            self.status = 'completed' if self.process.returncode == 0 else 'failed'
+        return True
+
+    def prune(self):
+        # main.py handles Ctrl + C by testing and reporting its best checkpoint.
+        self.process.send_signal(signal.SIGINT)
+        self.status = 'pruned'
+
+    def best_val_loss(self):
+        return min(self.val_losses.values()) if self.val_losses else None
+
+
+def should_prune(trial, trials, args):
+    """Median rule: prune if the trial's best loss so far is worse than the median of the other trials at its epoch."""
+    if not trial.val_losses or trial.status != 'running':
+        return False
+    epoch = max(trial.val_losses)
+    if epoch < args.prune_after:
+        return False
+    others = [min(loss for e, loss in t.val_losses.items() if e <= epoch)
+              for t in trials if t is not trial and epoch in t.val_losses]
+    if len(others) < args.prune_min_trials:
+        return False
+    return trial.best_val_loss() > statistics.median(others)
+
+
+def main():
+    args = get_args()
+    with open(args.spec, 'r') as f:
+        spec = json.load(f)
+    os.makedirs(args.sweep_dir, exist_ok=True)
+
+    # Tokenize once; the trials memory-map the cached tensors.
+    fixed = dict(spec.get('fixed', {}))
+    fixed['corpus-cache'] = args.corpus_cache or os.path.join(args.sweep_dir, 'corpus.pt')
+    data.load_corpus(fixed.get('data', '../data/wikitext-2'), fixed['corpus-cache'])
+
+    threads = args.threads or max(1, torch.get_num_threads() // args.parallel)
+    trials = [Trial(i, params, args.sweep_dir) for i, params in enumerate(trial_params(spec, args.seed))]
+    print('| {} trials, {} in parallel with {} threads each'.format(len(trials), args.parallel, threads))
+
+    queue = list(trials)
+    running = []
+    try:
+        while queue or running:
+            while queue and len(running) < args.parallel:
+                trial = queue.pop(0)
+                trial.start(dict(fixed, **trial.params), threads)
+                running.append(trial)
+                print('| started {} {}'.format(trial.name, json.dumps(trial.params)))
+            time.sleep(1)
+            for trial in list(running):
+                if trial.poll():
+                    running.remove(trial)
+                    print('| {} {} | best valid loss {}'.format(trial.name, trial.status, trial.best_val_loss()))
+                elif args.prune and should_prune(trial, trials, args):
+                    trial.prune()
+                    print('| pruning {} after epoch {}'.format(trial.name, max(trial.val_losses)))
+    except KeyboardInterrupt:
+        for trial in running:
+            trial.process.send_signal(signal.SIGINT)
+        for trial in running:
+            trial.process.wait()
+            trial.poll()
+        print('Exiting from the sweep early')
+
+    summary = []
+    for trial in trials:
+        summary.append({
+            'trial': trial.name,
+            'params': trial.params,
+            'status': trial.status,
+            'best_val_loss': trial.best_val_loss(),
+            'report': os.path.join(trial.report_dir, 'report.json'),
+        })
+    with open(os.path.join(args.sweep_dir, 'sweep.json'), 'w') as f:
+        json.dump({'spec': spec, 'args': vars(args), 'trials': summary}, f, indent=4)
+
+    print('=' * 89)
+    finished = [t for t in summary if t['best_val_loss'] is not None]
+    for t in sorted(finished, key=lambda t: t['best_val_loss']):
+        print('| {} | {:9s} | valid loss {:5.2f} | {}'.format(
+            t['trial'], t['status'], t['best_val_loss'], json.dumps(t['params'])))
+    print('=' * 89)
+
+
+if __name__ == '__main__':
+    main()
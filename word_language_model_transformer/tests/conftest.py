@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The modules of this example import each other by name (import data, import model),
+# as when the scripts run from this directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# building_blocks lives next to this example, see export_numpy.py.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
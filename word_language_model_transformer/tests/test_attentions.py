@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from building_blocks.attentions import attention, elu_feature_map, linear_attention, linformer_attention
+
+
+def random_qkv(length, num_keys=None, dim=8, seed=0):
+    rng = np.random.default_rng(seed)
+    num_keys = num_keys or length
+    return (rng.standard_normal((2, length, dim)), rng.standard_normal((2, num_keys, dim)),
+            rng.standard_normal((2, num_keys, dim + 2)))
+
+
+def quadratic_linear_attention(query, key, value, mask=None, eps=1e-6):
+    # linear_attention written as the [num queries, num keys] similarity matrix it avoids.
+    similarity = elu_feature_map(query) @ np.swapaxes(elu_feature_map(key), -1, -2)
+    if mask is not None:
+        similarity = similarity * mask
+    return (similarity @ value) / (similarity.sum(axis=-1, keepdims=True) + eps)
+
+
+@pytest.mark.parametrize('num_keys', [5, 11])
+def test_linformer_attention_is_exact_with_a_full_rank(num_keys):
+    query, key, value = random_qkv(7, num_keys)
+    for rank in [num_keys, num_keys + 3]:
+        np.testing.assert_allclose(linformer_attention(query, key, value, rank=rank),
+                                   attention(query, key, value), atol=1e-6)
+
+
+def test_linformer_attention_rejects_causal():
+    with pytest.raises(ValueError):
+        linformer_attention(*random_qkv(4), causal=True)
+
+
+def test_linear_attention_matches_its_quadratic_form():
+    query, key, value = random_qkv(9, 13)
+    np.testing.assert_allclose(linear_attention(query, key, value),
+                               quadratic_linear_attention(query, key, value), atol=1e-6)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 4, 10, 64])
+def test_causal_linear_attention_matches_the_masked_quadratic_form(chunk_size):
+    query, key, value = random_qkv(10)
+    mask = np.tri(10, dtype=bool)
+    np.testing.assert_allclose(linear_attention(query, key, value, causal=True, chunk_size=chunk_size),
+                               quadratic_linear_attention(query, key, value, mask), atol=1e-6)
@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+import compress
+from model import RNNModel, TransformerModel
+
+
+def models():
+    torch.manual_seed(0)
+    return [RNNModel('LSTM', 30, 8, 8, 1, dropout=0.0).eval(),
+            RNNModel('GRU', 30, 8, 8, 1, dropout=0.0, tie_weights=True).eval(),
+            TransformerModel(30, 8, 2, 16, 2, dropout=0.0).eval()]
+
+
+def log_probs(model, src):
+    with torch.no_grad():
+        if getattr(model, 'model_type', None) == 'Transformer':
+            return model(src).view(-1, 30)
+        return model(src, model.init_hidden(src.size(1)))[0]
+
+
+@pytest.mark.parametrize('index', [0, 1, 2])
+def test_full_rank_compression_keeps_the_outputs(index):
+    model = models()[index]
+    src = torch.randint(30, (6, 2))
+    compressed = compress.compress_model(model, rank=8, keep=1.0)
+    torch.testing.assert_close(log_probs(compressed, src), log_probs(model, src), atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.parametrize('index', [0, 1, 2])
+def test_pruning_features_that_are_zero_keeps_the_outputs(index):
+    model = models()[index]
+    embedding = model.input_emb if index == 2 else model.encoder
+    with torch.no_grad():
+        embedding.weight[:, ::2] = 0
+        model.decoder.weight[:, ::2] = 0
+    src = torch.randint(30, (6, 2))
+    compressed = compress.compress_model(model, keep=0.5)
+    torch.testing.assert_close(log_probs(compressed, src), log_probs(model, src), atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.parametrize('rank, keep', [(4, 1.0), (0, 0.5), (3, 0.5)])
+def test_tied_compression_keeps_the_weights_shared(rank, keep):
+    model = compress.compress_model(models()[1], rank=rank, keep=keep)
+    embedding = model.encoder.embedding if keep < 1 else model.encoder
+    decoder = model.decoder.linear if keep < 1 else model.decoder
+    if rank:
+        assert decoder.up.weight is embedding.embedding.weight
+    else:
+        assert decoder.weight is embedding.weight
+    # Fine-tuning updates the shared factor once, it stays shared.
+    compress.finetune(model, torch.randint(30, (20, 2)), 2, 0.1, 0.25, 5)
+    if rank:
+        assert decoder.up.weight is embedding.embedding.weight
+    else:
+        assert decoder.weight is embedding.weight
+    with pytest.raises(ValueError):
+        compress.compress_model(models()[1], targets='decoder', rank=rank, keep=keep)
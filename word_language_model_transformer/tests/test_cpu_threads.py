@@ -0,0 +1,20 @@
+import pytest
+
+import cpu_threads
+
+
+def workload(**options):
+    return cpu_threads.make_workload('Transformer', 30, 16, 32, 2, 2, 'train', 2, 6, **options)
+
+
+def test_step_options_change_the_workload_key():
+    keys = {cpu_threads.workload_key(workload(**options))
+            for options in [{}, {'positions': 'rotary'}, {'positions': 'rotary', 'mem_len': 4},
+                            {'checkpoint_every': 1}, {'sparse_embedding': True}, {'accum_steps': 2}]}
+    assert len(keys) == 6
+
+
+@pytest.mark.parametrize('options', [{'positions': 'rotary', 'mem_len': 4, 'checkpoint_every': 1},
+                                     {'sparse_embedding': True, 'accum_steps': 2}])
+def test_benchmark_runs_the_step_options(options):
+    assert cpu_threads.benchmark(workload(**options), {}, steps=1, warmup=1) > 0
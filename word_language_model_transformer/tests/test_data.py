@@ -0,0 +1,48 @@
+import torch
+
+import data
+
+
+def dictionary():
+    dictionary = data.Dictionary()
+    for word in '<unk> <eos> the game was played'.split():
+        dictionary.add_word(word)
+    return dictionary
+
+
+def test_encode_ends_every_line_with_eos():
+    ids = dictionary().encode('the game\nwas replayed\n')
+    assert ids.tolist() == [2, 3, 1, 4, 0, 1]
+    assert ids.dtype == torch.long
+
+
+def test_encode_prompt_continues_the_last_line():
+    assert dictionary().encode('the game\nwas', final_eos=False).tolist() == [2, 3, 1, 4]
+    assert dictionary().encode('', final_eos=False).tolist() == []
+
+
+def write_corpus(path, text):
+    path.mkdir()
+    for split in ['train', 'valid', 'test']:
+        (path / (split + '.txt')).write_text(text, encoding='utf8')
+    return str(path)
+
+
+def test_load_corpus_rebuilds_the_cache_of_another_corpus(tmp_path):
+    cache = str(tmp_path / 'corpus.pt')
+    first = write_corpus(tmp_path / 'first', 'the game was played\n')
+    second = write_corpus(tmp_path / 'second', 'a different corpus altogether\n')
+    assert data.load_corpus(first, cache).dictionary.idx2word == data.Corpus(first).dictionary.idx2word
+    corpus = data.load_corpus(second, cache)
+    assert corpus.dictionary.idx2word == data.Corpus(second).dictionary.idx2word
+    assert torch.equal(data.load_corpus(second, cache).train, corpus.train)
+
+
+def test_encode_splits_lines_like_the_corpus(tmp_path):
+    text = 'the game\x0cwas played\nthe\x85game\n'
+    path = tmp_path / 'train.txt'
+    path.write_text(text, encoding='utf8')
+    corpus = data.Corpus.__new__(data.Corpus)
+    corpus.dictionary = data.Dictionary()
+    ids = corpus.tokenize(str(path))
+    assert corpus.dictionary.encode(text).tolist() == ids.tolist()
@@ -0,0 +1,44 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+import distillation
+from model import TransformerModel
+
+
+def teacher():
+    torch.manual_seed(0)
+    return TransformerModel(30, 16, 2, 32, 2, dropout=0.0).eval()
+
+
+def test_teacher_cache_holds_the_teacher_predictions(tmp_path):
+    model = teacher()
+    source = torch.randint(30, (12, 2))
+    path = str(tmp_path / 'teacher.pt')
+    distillation.build_teacher_cache(model, source, 16, 8, 5, path, {'teacher': 1}, {'data': 1})
+    indices, log_probs = distillation.load_teacher_cache(path, source, 16, 8, 5, {'teacher': 1}, {'data': 1})
+    expected_indices, expected_log_probs = distillation.soft_targets(model, source[:-1], 5)
+    assert torch.equal(indices.reshape(-1, 5).long(), expected_indices)
+    torch.testing.assert_close(log_probs.reshape(-1, 5).float(), expected_log_probs, atol=1e-2, rtol=1e-3)
+
+
+def test_teacher_cache_of_other_data_or_teacher_is_not_used(tmp_path):
+    model = teacher()
+    source = torch.randint(30, (12, 2))
+    path = str(tmp_path / 'teacher.pt')
+    distillation.build_teacher_cache(model, source, 4, 2, 5, path, {'teacher': 1}, {'data': 1})
+    assert distillation.load_teacher_cache(path, source, 4, 2, 5, {'teacher': 1}, {'data': 1}) is not None
+    assert distillation.load_teacher_cache(path, source, 4, 2, 5, {'teacher': 1}, {'data': 2}) is None
+    assert distillation.load_teacher_cache(path, source, 4, 2, 5, {'teacher': 2}, {'data': 1}) is None
+    assert distillation.load_teacher_cache(path, source, 4, 1, 5, {'teacher': 1}, {'data': 1}) is None
+
+
+def test_distillation_loss_without_topk_is_the_soft_cross_entropy():
+    torch.manual_seed(0)
+    output = F.log_softmax(torch.randn(6, 30), dim=-1)
+    teacher_log_probs = F.log_softmax(torch.randn(6, 30), dim=-1)
+    hard_loss = torch.tensor(2.5)
+    soft_loss = -(teacher_log_probs.exp() * output).sum(-1).mean()
+    loss = distillation.distillation_loss(output, hard_loss, None, teacher_log_probs, 0.75, 1.0)
+    assert loss.item() == pytest.approx(0.75 * soft_loss.item() + 0.25 * 2.5, rel=1e-5)
+    assert distillation.distillation_loss(output, hard_loss, None, teacher_log_probs, 0., 2.0).item() == 2.5
@@ -0,0 +1,137 @@
+import os
+import subprocess
+import sys
+
+import pytest
+import torch
+
+import evaluation
+from model import RNNModel, TransformerModel
+
+
+def transformer(fastpath):
+    torch.manual_seed(0)
+    model = TransformerModel(50, 16, 2, 32, 2, dropout=0.0)
+    return model.enable_fastpath() if fastpath else model
+
+
+@pytest.mark.parametrize('fastpath', [False, True])
+def test_sequence_log_probs_padded_batch_matches_unpadded(fastpath):
+    model = transformer(fastpath).eval()
+    sequences = [torch.randint(50, (length,)) for length in [9, 3, 6, 2]]
+    padded = evaluation.sequence_log_probs(model, sequences)
+    for sequence, log_probs in zip(sequences, padded):
+        expected, = evaluation.sequence_log_probs(model, [sequence])
+        assert log_probs.shape == (len(sequence) - 1,)
+        torch.testing.assert_close(log_probs, expected, atol=1e-5, rtol=1e-5)
+
+
+@pytest.mark.parametrize('fastpath', [False, True])
+def test_document_log_probs_padded_windows_match_unpadded(fastpath):
+    model = transformer(fastpath).eval()
+    documents = [torch.randint(50, (length,)) for length in [20, 4, 11]]
+    batched = evaluation.document_log_probs(model, documents, 8, 4, batch_size=16)
+    for document, log_probs in zip(documents, batched):
+        expected, = evaluation.document_log_probs(model, [document], 8, 4, batch_size=1)
+        torch.testing.assert_close(log_probs, expected, atol=1e-5, rtol=1e-5)
+
+
+def test_document_log_probs_empty_first_document():
+    model = transformer(False).eval()
+    documents = [torch.randint(50, (0,)), torch.randint(50, (7,)), torch.randint(50, (1,))]
+    empty, full, single = evaluation.document_log_probs(model, documents, 8, 4, batch_size=4)
+    assert empty.shape == (0,)
+    assert full.shape == (6,)
+    assert single.shape == (0,)
+
+
+def baseline_evaluate(model, data_source, bptt):
+    # evaluate() of the original main.py, on batchified data.
+    model.eval()
+    criterion = torch.nn.NLLLoss()
+    total_loss = 0.
+    hidden = model.init_hidden(data_source.size(1))
+    with torch.no_grad():
+        for i in range(0, data_source.size(0) - 1, bptt):
+            seq_len = min(bptt, len(data_source) - 1 - i)
+            data, targets = data_source[i:i + seq_len], data_source[i + 1:i + 1 + seq_len].view(-1)
+            output, hidden = model(data, hidden)
+            total_loss += len(data) * criterion(output, targets).item()
+    return total_loss / (len(data_source) - 1)
+
+
+@pytest.mark.parametrize('rnn_type', ['LSTM', 'GRU'])
+def test_rnn_disjoint_windows_match_baseline_evaluate(rnn_type):
+    torch.manual_seed(0)
+    model = RNNModel(rnn_type, 50, 16, 16, 2)
+    source = torch.randint(50, (1003,))
+    loss = evaluation.sliding_window_loss(model, source, 35, 35, 10)
+    expected = baseline_evaluate(model, evaluation.stream_columns(source, 10), 35)
+    assert loss == pytest.approx(expected, rel=1e-5)
+    # Only the hidden state carried across windows gives the baseline numbers.
+    assert evaluation.sliding_window_loss(model, source, 35, 34, 10) != pytest.approx(expected, rel=1e-5)
+
+
+PARALLEL_EVALUATION = """
+import torch
+import evaluation
+from model import TransformerModel
+
+torch.set_num_threads(4)
+torch.manual_seed(0)
+model = TransformerModel(50, 16, 2, 32, 2)
+source = torch.randint(50, (2000,))
+# The parent's intra-op thread pool has run before the workers start.
+expected = evaluation.sliding_window_loss(model, source, 35, 35, 10)
+evaluator = evaluation.ParallelEvaluator(2)
+loss = evaluator.submit(model, source, 35, 35, 10).result()
+evaluator.shutdown()
+assert abs(loss - expected) < 1e-5, (loss, expected)
+"""
+
+
+def test_parallel_evaluator_with_several_parent_threads():
+    # In a fresh process, since a deadlocked worker would hang the test run itself.
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    subprocess.run([sys.executable, '-c', PARALLEL_EVALUATION], cwd=directory, check=True, timeout=120)
+
+
+def test_memory_model_evaluation_carries_the_memory():
+    torch.manual_seed(0)
+    model = TransformerModel(50, 16, 2, 32, 2, dropout=0.0, positions='rotary', mem_len=4).eval()
+    source = torch.randint(50, (41,))
+    columns = evaluation.stream_columns(source, 2)
+    expected = 0.
+    mems = model.init_mems()
+    for i in range(0, columns.size(0) - 1, 5):
+        seq_len = min(5, columns.size(0) - 1 - i)
+        output, mems = model(columns[i:i + seq_len], mems=mems)
+        targets = columns[i + 1:i + 1 + seq_len]
+        expected -= output.gather(2, targets.unsqueeze(2)).sum().item()
+    assert evaluation.carries_hidden(model, 5, 5)
+    loss = evaluation.sliding_window_loss(model, source, 5, 5, batch_size=2)
+    assert loss == pytest.approx(expected / ((columns.size(0) - 1) * 2), rel=1e-5)
+
+
+def test_weights_snapshot_leaves_out_the_gradients():
+    model = transformer(False)
+    model(torch.randint(50, (5, 2))).sum().backward()
+    grads = [param.grad for param in model.parameters()]
+    snapshot = evaluation.weights_snapshot(model)
+    assert all(param.grad is None for param in snapshot.parameters())
+    assert all(param.grad is grad for param, grad in zip(model.parameters(), grads))
+    for param, copied in zip(model.parameters(), snapshot.parameters()):
+        assert torch.equal(param, copied) and param is not copied
+
+
+@pytest.mark.parametrize('num_tokens', [0, 1])
+def test_sliding_window_loss_rejects_too_few_tokens(num_tokens):
+    with pytest.raises(ValueError):
+        evaluation.sliding_window_loss(transformer(False), torch.randint(50, (num_tokens,)), 8, 4, batch_size=2)
+
+
+def test_stream_loss_rejects_streams_of_one_token():
+    torch.manual_seed(0)
+    model = RNNModel('LSTM', 50, 8, 8, 1, dropout=0.0)
+    with pytest.raises(ValueError):
+        evaluation.sliding_window_loss(model, torch.randint(50, (3,)), 8, 8, batch_size=2)
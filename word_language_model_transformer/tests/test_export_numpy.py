@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+import torch
+
+import export_numpy
+from building_blocks.transformer import TransformerLM
+from model import TransformerModel
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'positions': 'rotary'}, {'positions': 'rotary', 'mem_len': 3}])
+def test_numpy_model_matches_torch(tmp_path, kwargs):
+    torch.manual_seed(0)
+    model = TransformerModel(40, 16, 2, 32, 2, **kwargs).eval()
+    path = str(tmp_path / 'model.npz')
+    export_numpy.export_weights(model, path)
+    numpy_model = TransformerLM.load(path)
+    src = torch.randint(40, (7, 3))
+    with torch.no_grad():
+        expected, expected_past = model.forward_with_cache(src)
+    log_probs, past = numpy_model.forward(src.numpy())
+    np.testing.assert_allclose(log_probs, expected.numpy(), atol=1e-4, rtol=1e-4)
+    if not kwargs.get('mem_len'):
+        np.testing.assert_allclose(numpy_model(src.numpy()), model(src).detach().numpy(), atol=1e-4, rtol=1e-4)
+    # Decoding one more token from the cached keys and values.
+    token = torch.randint(40, (1, 3))
+    with torch.no_grad():
+        expected, _ = model.forward_with_cache(token, expected_past)
+    np.testing.assert_allclose(numpy_model.forward(token.numpy(), past)[0], expected.numpy(), atol=1e-4, rtol=1e-4)
@@ -0,0 +1,80 @@
+import pytest
+import torch
+
+import data
+import generate
+import prefix_cache
+import sampling
+from model import RNNModel, TransformerModel
+
+
+class RecordingSampler(sampling.Sampler):
+    """Greedy sampler that keeps the distributions it was asked to sample from."""
+
+    def __init__(self):
+        super(RecordingSampler, self).__init__(greedy=True)
+        self.log_probs = []
+
+    def __call__(self, log_probs):
+        self.log_probs.append(log_probs.reshape(-1))
+        return super(RecordingSampler, self).__call__(log_probs)
+
+
+def models():
+    torch.manual_seed(0)
+    target = TransformerModel(50, 16, 2, 32, 2).eval()
+    draft = RNNModel('LSTM', 50, 16, 16, 1).eval()
+    return target, draft
+
+
+PROMPT = torch.tensor([3, 14, 15, 9, 26]).view(-1, 1)
+
+
+def test_plain_and_cached_decoding_sample_from_the_same_distribution():
+    target, _ = models()
+    plain, cached = RecordingSampler(), RecordingSampler()
+    expected = list(generate.sample_tokens(target, PROMPT, 8, plain))
+    assert list(generate.sample_tokens_cached(target, PROMPT.view(-1).tolist(), 8, cached, None)) == expected
+    for log_probs, cached_log_probs in zip(plain.log_probs, cached.log_probs):
+        torch.testing.assert_close(log_probs, cached_log_probs, atol=1e-5, rtol=1e-5)
+
+
+def test_batched_and_speculative_decoding_match_plain_decoding():
+    # Greedy decoding follows the argmax of the target's distribution.
+    target, draft = models()
+    sampler = sampling.Sampler(greedy=True)
+    expected = list(generate.sample_tokens(target, PROMPT, 12, sampler))
+    assert generate.generate_batch(target, [PROMPT.view(-1)], [12], [sampler]) == [expected]
+    assert list(sampling.speculative_decode(target, draft, PROMPT, 12, sampler, draft_tokens=3)) == expected
+
+
+def test_speculative_decoding_rejects_a_prefix_cache():
+    target, draft = models()
+    dictionary = data.Dictionary()
+    for i in range(50):
+        dictionary.add_word('w{}'.format(i))
+    with pytest.raises(ValueError):
+        list(generate.generate_stream(target, dictionary, 'w1 w2', 3, draft_model=draft,
+                                      cache=prefix_cache.PrefixCache()))
+
+
+@pytest.mark.parametrize('model_index', [0, 1])
+def test_cached_batch_matches_uncached_batch(model_index):
+    model = models()[model_index]
+    sampler = sampling.Sampler(greedy=True)
+    prompts = [PROMPT.view(-1), PROMPT.view(-1)[:3], torch.tensor([7])]
+    num_words = [6, 2, 4]
+    expected = generate.generate_batch(model, prompts, num_words, [sampler] * 3)
+    cache = prefix_cache.PrefixCache(block=2)
+    for _ in range(2):
+        assert generate.generate_batch(model, prompts, num_words, [sampler] * 3, cache) == expected
+    assert cache.hits
+
+
+def test_batched_decoding_of_a_memory_model_matches_plain_decoding():
+    torch.manual_seed(0)
+    model = TransformerModel(50, 16, 2, 32, 2, positions='rotary', mem_len=3).eval()
+    sampler = sampling.Sampler(greedy=True)
+    prompts = [PROMPT.view(-1), torch.tensor([7, 8])]
+    expected = [list(generate.sample_tokens(model, prompt.view(-1, 1), 6, sampler)) for prompt in prompts]
+    assert generate.generate_batch(model, prompts, [6, 6], [sampler] * 2) == expected
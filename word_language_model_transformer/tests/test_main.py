@@ -0,0 +1,101 @@
+import time
+
+import main
+
+
+def trainer(tmp_path, *argv):
+    # A one-layer model on a tiny corpus, small enough to train a few epochs in a test.
+    path = tmp_path / 'corpus'
+    path.mkdir()
+    for split in ['train', 'valid', 'test']:
+        (path / (split + '.txt')).write_text('the game was played on a small field\n' * 20, encoding='utf8')
+    args = main.get_args(['--data', str(path), '--save', str(tmp_path / 'model.pt'), '--emsize', '16',
+                          '--nhid', '16', '--nlayers', '1', '--nhead', '2', '--batch_size', '2', '--bptt', '5',
+                          '--dropout', '0', '--log-interval', '1000'] + list(argv))
+    return main.Trainer(args)
+
+
+def test_token_budget_stops_in_the_middle_of_an_epoch(tmp_path):
+    result = trainer(tmp_path, '--epochs', '3', '--max-tokens', '20').fit()
+    assert result['stop_reason'] == 'token_budget'
+    # The budget is checked after every update of batch_size x bptt tokens.
+    assert 20 <= result['tokens_trained'] < 30
+    assert len(result['records']) == 1
+
+
+def test_time_budget():
+    trainer = main.Trainer.__new__(main.Trainer)
+    trainer.args = main.get_args(['--max-time', '1'])
+    trainer.distributed = False
+    trainer.tokens_trained = 0
+    trainer.train_start_time = time.time()
+    assert trainer.budget_exhausted() is None
+    trainer.train_start_time = time.time() - 61
+    assert trainer.budget_exhausted() == 'time_budget'
+
+
+def test_patience_stops_once_the_validation_loss_stops_improving(tmp_path):
+    # Without updates, every epoch after the first one has the same validation loss.
+    result = trainer(tmp_path, '--epochs', '10', '--lr', '0', '--patience', '2').fit()
+    assert result['stop_reason'] == 'early_stopping'
+    assert len(result['records']) == 3
+
+
+def batches(num_tokens, epoch, *argv):
+    trainer = main.Trainer.__new__(main.Trainer)
+    trainer.args = main.get_args(list(argv))
+    return trainer.epoch_batches(num_tokens, epoch)
+
+
+def assert_cover(batches, num_tokens):
+    # Consecutive batches, which together predict every token after the first one.
+    starts = [i for i, _ in batches]
+    assert starts == [0] + [i + seq_len for i, seq_len in batches[:-1]]
+    assert sum(seq_len for _, seq_len in batches) == num_tokens - 1
+
+
+def test_epoch_batches_have_bptt_tokens():
+    assert batches(101, 1, '--bptt', '35') == [(0, 35), (35, 35), (70, 30)]
+
+
+def test_bptt_warmup_grows_the_sequences():
+    argv = ['--bptt', '32', '--bptt-warmup', '2', '--bptt-min', '8']
+    first = batches(1001, 1, *argv)
+    assert_cover(first, 1001)
+    lengths = [seq_len for _, seq_len in first[:-1]]
+    assert lengths[0] == 8
+    assert lengths == sorted(lengths) and lengths[-1] < 32
+    second = batches(1001, 2, *argv)
+    assert second[0][1] >= lengths[-1]
+    assert all(seq_len == 32 for _, seq_len in batches(1001, 3, *argv)[:-1])
+
+
+def test_variable_bptt_is_seeded_by_the_epoch():
+    argv = ['--bptt', '35', '--variable-bptt']
+    first = batches(2001, 1, *argv)
+    assert_cover(first, 2001)
+    assert all(seq_len >= 5 for _, seq_len in first[:-1])
+    assert len({seq_len for _, seq_len in first}) > 1
+    assert first == batches(2001, 1, *argv)
+    assert first != batches(2001, 2, *argv)
+
+
+def test_get_args_ignores_the_command_line(monkeypatch):
+    monkeypatch.setattr('sys.argv', ['pytest', '--no-such-option'])
+    assert main.get_args(['--lr', '5']).lr == 5
+    assert main.get_args([]).lr == 20
+
+
+def test_trainers_run_in_process_on_a_shared_corpus(tmp_path):
+    first = trainer(tmp_path, '--epochs', '2', '--report-dir', str(tmp_path / 'report'))
+    result = first.fit()
+    assert result['stop_reason'] == 'max_epochs'
+    assert [record['epoch'] for record in result['records']] == [1, 2]
+    assert result['best_val_loss'] == min(record['val_loss'] for record in result['records'])
+    assert (tmp_path / 'report' / 'report.json').exists()
+    args = main.get_args(['--data', first.args.data, '--save', str(tmp_path / 'second.pt'), '--model', 'LSTM',
+                          '--emsize', '16', '--nhid', '16', '--nlayers', '1', '--batch_size', '2', '--bptt', '5',
+                          '--epochs', '1'])
+    second = main.Trainer(args, first.corpus)
+    assert second.corpus is first.corpus
+    assert second.fit()['tokens_trained'] > 0
@@ -0,0 +1,72 @@
+import pytest
+import torch
+
+from model import TransformerModel
+
+
+def transformer(**kwargs):
+    torch.manual_seed(0)
+    return TransformerModel(50, 16, 2, 32, 3, dropout=0.0, **kwargs)
+
+
+def test_rotary_forward_matches_incremental_forward_with_cache():
+    model = transformer(positions='rotary').eval()
+    src = torch.randint(50, (9, 2))
+    expected = model(src)
+    output, past = model.forward_with_cache(src[:4])
+    outputs = [output]
+    for t in range(4, 9):
+        output, past = model.forward_with_cache(src[t:t+1], past)
+        outputs.append(output)
+    torch.testing.assert_close(torch.cat(outputs), expected, atol=1e-5, rtol=1e-5)
+
+
+def test_memory_forward_matches_forward_with_cache():
+    # Segments of mem_len tokens: both keep exactly the keys and values of the previous segment.
+    model = transformer(positions='rotary', mem_len=4).eval()
+    src = torch.randint(50, (12, 2))
+    mems = model.init_mems()
+    past = None
+    for t in range(0, 12, 4):
+        expected, mems = model(src[t:t+4], mems=mems)
+        output, past = model.forward_with_cache(src[t:t+4], past)
+        torch.testing.assert_close(output, expected, atol=1e-5, rtol=1e-5)
+
+
+def gradients(model, src, **kwargs):
+    model.zero_grad()
+    output = model(src, **kwargs)
+    if isinstance(output, tuple):
+        output = output[0]
+    output.sum().backward()
+    return [p.grad.clone() for p in model.parameters()]
+
+
+@pytest.mark.parametrize('every', [1, 2, 3, 5])
+@pytest.mark.parametrize('kwargs', [{'positions': 'rotary'}, {'positions': 'rotary', 'mem_len': 4}])
+def test_checkpointed_attention_gradients_match(kwargs, every):
+    model = transformer(**kwargs).train()
+    src = torch.randint(50, (8, 2))
+    mems = model.init_mems() if kwargs.get('mem_len') else None
+    expected = gradients(model, src, mems=mems)
+    model.set_checkpointing(every)
+    for grad, expected_grad in zip(gradients(model, src, mems=mems), expected):
+        torch.testing.assert_close(grad, expected_grad, atol=1e-6, rtol=1e-5)
+
+
+@pytest.mark.parametrize('every', [1, 2, 3])
+def test_checkpointed_encoder_gradients_match(every):
+    model = transformer().train()
+    src = torch.randint(50, (8, 2))
+    expected = gradients(model, src)
+    model.set_checkpointing(every)
+    for grad, expected_grad in zip(gradients(model, src), expected):
+        torch.testing.assert_close(grad, expected_grad, atol=1e-6, rtol=1e-5)
+
+
+def test_checkpointing_is_off_in_eval_mode():
+    model = transformer().set_checkpointing(1).eval()
+    src = torch.randint(50, (8, 2))
+    with torch.no_grad():
+        output = model(src)
+    torch.testing.assert_close(output, transformer().eval()(src), atol=1e-6, rtol=1e-5)
@@ -0,0 +1,95 @@
+import pytest
+import torch
+import torch.nn as nn
+
+import optimization
+from model import RNNModel
+
+
+def train(model, optimizer, steps=3):
+    torch.manual_seed(1)
+    criterion = nn.NLLLoss()
+    for _ in range(steps):
+        data = torch.randint(30, (6, 2))
+        targets = torch.randint(30, (12,))
+        optimizer.zero_grad()
+        output, _ = model(data, model.init_hidden(2))
+        criterion(output, targets).backward()
+        if model.encoder.sparse:
+            model.encoder.weight.grad = model.encoder.weight.grad.coalesce()
+        optimizer.step()
+    return model
+
+
+@pytest.mark.parametrize('momentum', [0., 0.9])
+def test_sparse_embedding_sgd_matches_dense_sgd(momentum):
+    torch.manual_seed(0)
+    dense = RNNModel('LSTM', 30, 8, 8, 1, dropout=0.0)
+    sparse = RNNModel('LSTM', 30, 8, 8, 1, dropout=0.0)
+    sparse.load_state_dict(dense.state_dict())
+    sparse.encoder.sparse = True
+    # The sparse embedding is updated without momentum, the dense reference does the same.
+    others = [p for name, p in dense.named_parameters() if not name.startswith('encoder.')]
+    dense_optimizer = torch.optim.SGD([{'params': others}, {'params': [dense.encoder.weight], 'momentum': 0.}],
+                                      lr=0.5, momentum=momentum)
+    sparse_optimizer = optimization.build_optimizer('sgd', sparse.parameters(), 0.5, momentum=momentum,
+                                                    sparse_params=[sparse.encoder.weight])
+    train(dense, dense_optimizer)
+    train(sparse, sparse_optimizer)
+    for (name, expected), actual in zip(dense.state_dict().items(), sparse.state_dict().values()):
+        torch.testing.assert_close(actual, expected, atol=1e-6, rtol=1e-6, msg=name)
+    assert sparse_optimizer.state[sparse.encoder.weight].get('momentum_buffer') is None
+
+
+def scheduled_lrs(schedule, steps, **kwargs):
+    optimizer = torch.optim.SGD([nn.Parameter(torch.zeros(1))], lr=2.0)
+    scheduler = optimization.LRScheduler(optimizer, schedule, **kwargs)
+    lrs = []
+    for _ in range(steps):
+        scheduler.step()
+        lrs.append(scheduler.get_lr())
+    return lrs
+
+
+def test_lr_schedules():
+    assert scheduled_lrs('constant', 6, warmup_steps=4) == pytest.approx([0.5, 1.0, 1.5, 2.0, 2.0, 2.0])
+    assert scheduled_lrs('cosine', 5, total_steps=4) == pytest.approx([1.0 + 2 ** -0.5, 1.0, 1.0 - 2 ** -0.5, 0., 0.])
+    assert scheduled_lrs('inverse_sqrt', 6, warmup_steps=2) == pytest.approx(
+        [1.0, 2.0, 2.0 * (2 / 3) ** 0.5, 2.0 * (2 / 4) ** 0.5, 2.0 * (2 / 5) ** 0.5, 2.0 * (2 / 6) ** 0.5])
+
+
+def test_plateau_anneals_and_resumes():
+    optimizer = torch.optim.SGD([nn.Parameter(torch.zeros(1))], lr=2.0)
+    scheduler = optimization.LRScheduler(optimizer, 'plateau')
+    scheduler.step()
+    scheduler.plateau()
+    scheduler.step(scale=0.5)
+    assert scheduler.get_lr() == pytest.approx(0.25)
+    resumed = optimization.LRScheduler(torch.optim.SGD([nn.Parameter(torch.zeros(1))], lr=2.0), 'plateau')
+    resumed.load_state_dict(scheduler.state_dict())
+    resumed.step()
+    assert resumed.get_lr() == pytest.approx(0.5)
+    # The other schedules ignore plateaus.
+    constant = optimization.LRScheduler(torch.optim.SGD([nn.Parameter(torch.zeros(1))], lr=2.0), 'constant')
+    constant.plateau()
+    constant.step()
+    assert constant.get_lr() == 2.0
+
+
+@pytest.mark.parametrize('name', ['sgd', 'adamw'])
+def test_optimizer_group_steps_dense_and_sparse_parameters(name):
+    torch.manual_seed(0)
+    model = RNNModel('LSTM', 30, 8, 8, 1, dropout=0.0)
+    model.encoder.sparse = True
+    optimizer = optimization.build_optimizer(name, model.parameters(), 0.1, sparse_params=[model.encoder.weight])
+    before = {key: value.clone() for key, value in model.state_dict().items()}
+    train(model, optimizer, steps=1)
+    # The tokens of the batch that train() drew.
+    torch.manual_seed(1)
+    data = torch.randint(30, (6, 2))
+    untouched = sorted(set(range(30)) - set(data.view(-1).tolist()))
+    after = model.state_dict()
+    assert torch.equal(after['encoder.weight'][untouched], before['encoder.weight'][untouched])
+    assert not torch.equal(after['decoder.weight'], before['decoder.weight'])
+    with pytest.raises(ValueError):
+        optimization.build_optimizer('adagrad', model.parameters(), 0.1)
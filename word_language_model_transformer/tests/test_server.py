@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+import torch
+
+import data
+from model import RNNModel
+from server import HTTPError, LanguageModelServer
+
+
+def make_server():
+    torch.manual_seed(0)
+    dictionary = data.Dictionary()
+    for word in '<unk> <eos> the game was played'.split():
+        dictionary.add_word(word)
+    model = RNNModel('LSTM', len(dictionary), 8, 8, 1, dropout=0.0).eval()
+    return LanguageModelServer(model, dictionary, torch.device('cpu'), max_wait=0)
+
+
+def generate(server, body):
+    async def run():
+        worker = asyncio.ensure_future(server.generate_batcher.run())
+        try:
+            return await server.generate(body)
+        finally:
+            worker.cancel()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('greedy', ['false', 'true', 0, 1, None])
+def test_generate_rejects_non_boolean_greedy(greedy):
+    with pytest.raises(HTTPError) as error:
+        generate(make_server(), {'prompt': 'the game', 'words': 3, 'greedy': greedy})
+    assert error.value.status == 400
+
+
+@pytest.mark.parametrize('option', ['temperature', 'top_p'])
+@pytest.mark.parametrize('value', [float('nan'), float('inf'), 'NaN', '-inf'])
+def test_generate_rejects_non_finite_numbers(option, value):
+    with pytest.raises(HTTPError) as error:
+        generate(make_server(), {'prompt': 'the game', 'words': 3, option: value})
+    assert error.value.status == 400
+
+
+@pytest.mark.parametrize('option', ['words', 'top_k'])
+@pytest.mark.parametrize('value', [float('inf'), float('-inf'), float('nan'), 2.7, '3.5', 'many'])
+def test_generate_rejects_non_integers(option, value):
+    with pytest.raises(HTTPError) as error:
+        generate(make_server(), {'prompt': 'the game', 'words': 3, option: value})
+    assert error.value.status == 400
+
+
+def test_generate_accepts_boolean_greedy():
+    server = make_server()
+    text = generate(server, {'prompt': 'the game', 'words': 3, 'greedy': True})['text']
+    assert text == generate(server, {'prompt': 'the game', 'words': 3, 'greedy': True})['text']
+    assert len(text.split()) == 3
+
+
+def test_generate_accepts_integral_floats():
+    assert len(generate(make_server(), {'prompt': 'the game', 'words': 3.0, 'top_k': 2.0})['text'].split()) == 3
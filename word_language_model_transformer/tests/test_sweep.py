@@ -0,0 +1,73 @@
+import argparse
+import math
+
+import pytest
+
+import sweep
+
+
+def trial(index, losses, status='running'):
+    trial = sweep.Trial(index, {}, 'sweep')
+    trial.val_losses = dict(enumerate(losses, 1))
+    trial.status = status
+    return trial
+
+
+def prune_args(prune_after=2, prune_min_trials=3):
+    return argparse.Namespace(prune_after=prune_after, prune_min_trials=prune_min_trials)
+
+
+def test_end_of_epoch_reads_the_main_py_log_line():
+    # The line printed by main.Trainer.end_of_epoch.
+    line = ('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f} | '
+            'valid ppl {:8.2f}'.format(3, 12.5, 5.25, 190.57))
+    match = sweep.END_OF_EPOCH.search(line)
+    assert (int(match.group(1)), float(match.group(2))) == (3, 5.25)
+    # A diverged trial logs a nan loss.
+    line = line.replace(' 5.25', '{:5.2f}'.format(float('nan')))
+    assert math.isnan(float(sweep.END_OF_EPOCH.search(line).group(2)))
+
+
+def test_prunes_a_trial_worse_than_the_median():
+    others = [trial(i, [6.0, 5.0 + i / 10]) for i in range(1, 4)]
+    worse = trial(0, [6.0, 5.5])
+    better = trial(4, [6.0, 5.0])
+    trials = others + [worse, better]
+    assert sweep.should_prune(worse, trials, prune_args())
+    assert not sweep.should_prune(better, trials, prune_args())
+
+
+def test_compares_the_other_trials_at_the_same_epoch():
+    # The others were worse at epoch 2, their later improvements don't count against the trial.
+    others = [trial(i, [6.0, 5.6, 4.0]) for i in range(1, 4)]
+    current = trial(0, [6.0, 5.5])
+    assert not sweep.should_prune(current, others + [current], prune_args())
+
+
+@pytest.mark.parametrize('args,status,num_others', [
+    (prune_args(prune_after=3), 'running', 3),
+    (prune_args(), 'running', 2),
+    (prune_args(), 'completed', 3),
+])
+def test_does_not_prune_early_or_without_enough_trials(args, status, num_others):
+    others = [trial(i, [6.0, 5.0]) for i in range(1, num_others + 1)]
+    current = trial(0, [6.0, 5.5], status)
+    assert not sweep.should_prune(current, others + [current], args)
+
+
+def test_trial_params():
+    grid = sweep.trial_params({'method': 'grid', 'parameters': {'nlayers': [2, 4], 'tied': [True, False]}}, 1)
+    assert grid == [{'nlayers': 2, 'tied': True}, {'nlayers': 2, 'tied': False},
+                    {'nlayers': 4, 'tied': True}, {'nlayers': 4, 'tied': False}]
+    spec = {'method': 'random', 'trials': 5,
+            'parameters': {'lr': {'min': 1, 'max': 20, 'log': True}, 'nhid': {'min': 100, 'max': 200, 'int': True}}}
+    params = sweep.trial_params(spec, 1)
+    assert params == sweep.trial_params(spec, 1)
+    assert len(params) == 5
+    assert all(1 <= p['lr'] <= 20 and isinstance(p['nhid'], int) and 100 <= p['nhid'] <= 200 for p in params)
+    with pytest.raises(ValueError):
+        sweep.trial_params({'method': 'grid', 'parameters': {'lr': {'min': 1, 'max': 20}}}, 1)
+
+
+def test_command_line():
+    assert sweep.command_line({'lr': 4, 'tied': True, 'cuda': False}) == ['--lr', '4', '--tied']